@@ -0,0 +1,46 @@
+"""Cost of CallbackList dispatch, on a per-entry callback list
+
+The old dispatcher (emulated below) built a new argument list and keyword
+dict for every callback call.
+"""
+
+from passerd.callbacks import CallbackList
+from common import timeit, report
+
+CALLS = 100000
+
+class OldCallbackList(CallbackList):
+    def callback(self, *args, **kwargs):
+        for cb, ca, ckw, weak in self._cbs:
+            a = []
+            a.extend(args)
+            a.extend(ca)
+            kw = {}
+            kw.update(kwargs)
+            kw.update(ckw)
+            cb(*a, **kw)
+
+class Channel:
+    def got_entry(self, e):
+        pass
+
+def run(cbs, weak):
+    c = Channel()
+    if weak:
+        cbs.addWeakCallback(c.got_entry)
+    else:
+        cbs.addCallback(c.got_entry)
+    def dispatch():
+        for i in xrange(CALLS):
+            cbs.callback(i)
+    return timeit(dispatch)
+
+def main():
+    for name, cbs, weak in [('old dispatch', OldCallbackList(), False),
+                            ('fast path', CallbackList(), False),
+                            ('fast path, weak', CallbackList(), True),
+                            ('fast path, timing', CallbackList(timing=True), False)]:
+        report(name, run(cbs, weak), 'call', CALLS)
+
+if __name__ == '__main__':
+    main()
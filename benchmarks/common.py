@@ -0,0 +1,102 @@
+"""Helpers shared by the Passerd benchmark scripts
+
+The benchmarks run without network access: a PasserdProtocol object is
+connected to a fake transport, and uses an in-memory database.
+
+Run them from the top of the source tree, e.g.:
+
+    PYTHONPATH=. python benchmarks/entry_pipeline.py
+"""
+
+import time
+
+from twisted.test.proto_helpers import StringTransport
+
+from passerd import ircd
+from passerd.data import DataStore
+from passerd.history import StatusStore
+from passerd.members import MemberLists
+from passerd import memory
+
+
+class O:
+    """Automatic kwargs->attributes object"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeOptions:
+    api_timeout = 60
+    memory_budget = memory.MEMORY_BUDGET
+
+
+class BenchFactory(ircd.PasserdFactory):
+    def __init__(self):
+        self.opts = FakeOptions()
+        self.data = DataStore('sqlite://')
+        self.data.create_tables()
+        self.global_twuser_cache = ircd.TwitterUserCache(self)
+        self.status_store = StatusStore()
+        self.member_lists = MemberLists(self.data)
+        self.memory = memory.MemoryGovernor(self.opts.memory_budget)
+
+
+class CountingTransport(StringTransport):
+    """StringTransport that counts write calls"""
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringTransport.write(self, data)
+
+    def writeSequence(self, seq):
+        self.writes += 1
+        StringTransport.write(self, ''.join(seq))
+
+
+def make_proto(factory=None):
+    """Create an authenticated PasserdProtocol object, with a fake transport"""
+    if factory is None:
+        factory = BenchFactory()
+    p = factory.buildProtocol(None)
+    p.hostname = 'bench.client'
+    p.makeConnection(CountingTransport())
+    u = O(id='1', screen_name='me', name='Me')
+    p.set_authenticated_user(u)
+    return p
+
+
+def make_status(id, user_id, text=None):
+    user = O(id=str(user_id), screen_name='user%d' % (user_id),
+             name=u'User %d' % (user_id))
+    if text is None:
+        text = u'status &amp;lt;%d&amp;gt; from user %d: caf\xe9 &amp; more' % (id, user_id)
+    return O(id=str(id), text=text, user=user, retweeted_status=None,
+             in_reply_to_status_id=None,
+             created_at='Mon Jan 04 12:00:00 +0000 2010')
+
+
+def make_page(first_id, count=100, users=20):
+    """A page of statuses, in chronological order"""
+    return [make_status(first_id+i, 1000+(i % users)) for i in range(count)]
+
+
+def timeit(fn, repeat=5):
+    """Run fn() `repeat` times, returning the best time, in seconds"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def report(name, seconds, unit=None, count=1):
+    if unit:
+        print '%-40s %10.3f ms  (%.1f us/%s)' % (name, seconds*1000, seconds*1e6/count, unit)
+    else:
+        print '%-40s %10.3f ms' % (name, seconds*1000)
@@ -0,0 +1,47 @@
+"""Microbenchmark: HTML entity decoding of tweet texts
+
+Compares the previous implementation (alternation regex of all entity
+names, built on every call, and run twice) with passerd.utils.
+"""
+
+import re
+from htmlentitydefs import name2codepoint
+
+from passerd.utils import full_entity_decode
+
+from common import timeit, report
+
+ROUNDS = 2000
+
+TEXTS = [
+    u'just a plain tweet, nothing to decode here at all',
+    u'RT @someone: &amp;lt;3 this &amp;amp; that http://example.com/?a=1&amp;b=2',
+    u'caf&amp;eacute; com p&amp;atilde;o de queijo &amp;#8212; delicious',
+]
+
+
+def old_htmlentitydecode(s):
+    s = re.sub(
+        '&(%s);' % '|'.join(name2codepoint),
+        lambda m: unichr(name2codepoint[m.group(1)]), s)
+    s = re.sub('&#([0-9]+);', lambda m: unichr(int(m.group(1))), s)
+    return s
+
+def old_full_entity_decode(s):
+    return old_htmlentitydecode(old_htmlentitydecode(s))
+
+
+def main():
+    for text in TEXTS:
+        assert old_full_entity_decode(text) == full_entity_decode(text)
+
+    for name, fn in [('old', old_full_entity_decode), ('new', full_entity_decode)]:
+        for i, text in enumerate(TEXTS):
+            def doit():
+                for j in xrange(ROUNDS):
+                    fn(text)
+            t = timeit(doit)
+            report('%s, text %d' % (name, i), t, 'call', ROUNDS)
+
+if __name__ == '__main__':
+    main()
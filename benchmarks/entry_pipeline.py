@@ -0,0 +1,41 @@
+"""Benchmark: cost of delivering a page of timeline entries to a channel
+
+Compares the per-entry path (one got_entry() call per entry) with the
+batched path used by the feeds (one got_entries() call per page).
+
+got_entry() is now just a got_entries() call with a single entry, so the
+per-entry case measures one-entry batches (one write and one user info
+update per entry), not the old per-entry pipeline.
+"""
+
+from common import make_proto, make_page, timeit, report
+
+PAGES = 10
+PAGE_SIZE = 100
+
+
+def run(batched):
+    p = make_proto()
+    chan = p.get_channel('#twitter')
+    pages = [make_page(1000*i, PAGE_SIZE) for i in range(1, PAGES+1)]
+
+    def doit():
+        for page in pages:
+            if batched:
+                chan.got_entries(page)
+            else:
+                for e in page:
+                    chan.got_entry(e)
+
+    t = timeit(doit, repeat=1)
+    return t, p.transport.writes
+
+
+def main():
+    for name, batched in [('per-entry', False), ('batched', True)]:
+        t, writes = run(batched)
+        report('%s (%d pages)' % (name, PAGES), t, 'page', PAGES)
+        print '    transport writes per page: %d' % (writes/PAGES)
+
+if __name__ == '__main__':
+    main()
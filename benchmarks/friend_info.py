@@ -0,0 +1,35 @@
+"""Cost of finding the unknown users on a 5,000-friend list
+
+Compares the bulk unknown_ids() check with a has_data() call (one
+database query) for each friend, the old behavior. The friends are new
+user objects every time, as they are for each NAMES reply, and the
+database session doesn't have the user records loaded.
+"""
+
+from passerd import ircd
+from common import make_proto, make_status, timeit, report
+
+FRIENDS = 5000
+UNKNOWN = 3
+
+def main():
+    p = make_proto()
+    cache = p.global_twuser_cache
+    cache.got_api_users_info([make_status(0, id).user for id in range(UNKNOWN, FRIENDS)])
+    session = p.data.session
+
+    def friends():
+        session.expunge_all()
+        return [ircd.CachedTwitterIrcUser(p, cache, id, p.twitter_users) for id in range(FRIENDS)]
+    def old():
+        assert len([u for u in friends() if not u.has_data()]) == UNKNOWN
+    def new(clear):
+        if clear:
+            cache.clear_known_ids()
+        assert len(cache.unknown_ids([u._twitter_id for u in friends()])) == UNKNOWN
+    report('has_data() per friend', timeit(old, repeat=3), 'friend', FRIENDS)
+    report('unknown_ids(), first time', timeit(lambda: new(True), repeat=3), 'friend', FRIENDS)
+    report('unknown_ids(), known ids cached', timeit(lambda: new(False), repeat=3), 'friend', FRIENDS)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Cost of finding a post by substring on a full channel history"""
+
+from passerd.history import HistoryEntry, ChannelHistory
+from passerd.utils import full_entity_decode
+from common import timeit, report
+
+LOOKUPS = 1000
+
+def make_history(size, users):
+    h = ChannelHistory(size)
+    raw = {}
+    for i in range(size):
+        uid = i % users
+        text = u'status number %d from user %d, with some words: caf&#233; &amp; more' % (i, uid)
+        h.add(HistoryEntry(i, uid, 'user%d' % (uid), full_entity_decode(text).lower()))
+        raw.setdefault(uid, []).append(text)
+    return h,raw
+
+def scan(posts, substring):
+    # what recent_post() used to do, on the raw API text
+    return [t for t in reversed(posts) if substring.lower() in full_entity_decode(t).lower()]
+
+def main():
+    for size,users in [(100, 20), (2000, 20), (2000, 2)]:
+        h,raw = make_history(size, users)
+        target = size-users
+        sub = u'number %d from' % (target)
+        uid = target % users
+        assert len(h.find(uid, sub)) == 1
+        assert len(scan(raw[uid], sub)) == 1
+
+        def do_find():
+            for i in xrange(LOOKUPS):
+                h.find(uid, sub)
+        def do_scan():
+            for i in xrange(LOOKUPS):
+                scan(raw[uid], sub)
+        name = '%d posts, %d users' % (size, users)
+        report('old scan, %s' % (name), timeit(do_scan), 'lookup', LOOKUPS)
+        report('find(), %s' % (name), timeit(do_find), 'lookup', LOOKUPS)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Memory used by the channel history: API status objects vs HistoryEntry
+
+The statuses are parsed by twittytwister from XML similar to what the
+Twitter API returns, so they have all the fields (and nested user objects)
+that the old history kept alive.
+"""
+
+import sys
+
+from twittytwister import txml
+
+from passerd.history import HistoryEntry
+
+COUNT = 10000
+USERS = 500
+
+STATUS_XML = """<status>
+<created_at>Mon Jan 04 12:%02d:%02d +0000 2010</created_at>
+<id>%d</id>
+<text>status &amp;lt;%d&amp;gt; from user %d: caf&#233; &amp;amp; more, with some more words to make it look real</text>
+<source>&lt;a href="http://example.com/"&gt;Some client&lt;/a&gt;</source>
+<truncated>false</truncated>
+<in_reply_to_status_id></in_reply_to_status_id>
+<in_reply_to_user_id></in_reply_to_user_id>
+<favorited>false</favorited>
+<in_reply_to_screen_name></in_reply_to_screen_name>
+<user>
+<id>%d</id>
+<name>User %d</name>
+<screen_name>user%d</screen_name>
+<location>Somewhere</location>
+<description>Just a test user</description>
+<profile_image_url>http://example.com/images/%d.png</profile_image_url>
+<url>http://example.com/</url>
+<protected>false</protected>
+<followers_count>100</followers_count>
+<friends_count>100</friends_count>
+<created_at>Mon Jan 04 12:00:00 +0000 2009</created_at>
+<favourites_count>0</favourites_count>
+<utc_offset>-10800</utc_offset>
+<time_zone>Brasilia</time_zone>
+<statuses_count>1000</statuses_count>
+<following>true</following>
+<verified>false</verified>
+</user>
+<geo/>
+</status>
+"""
+
+def make_xml(count, users):
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<statuses type="array">\n']
+    for i in range(count):
+        id = 7000000000+i
+        uid = 1000+(i % users)
+        parts.append(STATUS_XML % ((i/60) % 60, i % 60, id, i, uid, uid, uid, uid, uid))
+    parts.append('</statuses>\n')
+    return ''.join(parts)
+
+def parse(xml):
+    statuses = []
+    p = txml.Statuses(statuses.append)
+    p.write(xml)
+    p.close()
+    return statuses
+
+def deep_size(o, seen):
+    """Approximate number of bytes used by o and everything it references"""
+    if id(o) in seen:
+        return 0
+    seen.add(id(o))
+    size = sys.getsizeof(o)
+    if isinstance(o, dict):
+        for k,v in o.iteritems():
+            size += deep_size(k, seen) + deep_size(v, seen)
+    elif isinstance(o, (list, tuple)):
+        for v in o:
+            size += deep_size(v, seen)
+    elif hasattr(o, '__dict__'):
+        size += deep_size(o.__dict__, seen)
+    elif hasattr(o, '__slots__'):
+        for a in o.__slots__:
+            if a != '__weakref__':
+                size += deep_size(getattr(o, a, None), seen)
+    return size
+
+def main():
+    statuses = parse(make_xml(COUNT, USERS))
+    assert len(statuses) == COUNT
+    entries = [HistoryEntry.from_status(s) for s in statuses]
+
+    # objects shared by every entry (None, small ints, interned names of a
+    # few users) are counted only once, as they would be in the server:
+    old = deep_size(statuses, set())
+    new = deep_size(entries, set())
+    print '%-40s %10.1f KiB  (%d bytes/post)' % ('%d API status objects' % (COUNT), old/1024., old/COUNT)
+    print '%-40s %10.1f KiB  (%d bytes/post)' % ('%d HistoryEntry records' % (COUNT), new/1024., new/COUNT)
+    print '%-40s %10.1fx' % ('reduction', float(old)/new)
+
+if __name__ == '__main__':
+    main()
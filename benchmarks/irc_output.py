@@ -0,0 +1,42 @@
+"""Benchmark: throughput of IRC output for bursts of channel messages
+
+Compares writing each line directly to the transport with the coalesced
+output buffer used by PasserdProtocol.
+"""
+
+from twisted.words.protocols.irc import IRC
+
+from common import make_proto, timeit, report
+
+BURSTS = 20
+BURST_SIZE = 100
+
+
+def run(coalesced):
+    p = make_proto()
+    chan = p.get_channel('#twitter')
+    p.global_twuser_cache.update_user_info(1000, 'someone', u'Some One')
+    sender = p.get_twitter_user(1000)
+    if not coalesced:
+        # old behavior: one transport write per line
+        p.sendLine = lambda line, droppable=False: IRC.sendLine(p, line)
+
+    def doit():
+        for i in range(BURSTS):
+            for j in range(BURST_SIZE):
+                p.send_privmsg(sender, chan, u'tweet number %d: caf\xe9 au lait' % (j))
+            p.flush_output()
+
+    p.transport.writes = 0
+    t = timeit(doit, repeat=1)
+    return t, p.transport.writes
+
+
+def main():
+    for name, coalesced in [('line-by-line', False), ('coalesced', True)]:
+        t, writes = run(coalesced)
+        report('%s (%dx%d lines)' % (name, BURSTS, BURST_SIZE), t, 'line', BURSTS*BURST_SIZE)
+        print '    transport writes per burst: %d' % (writes/BURSTS)
+
+if __name__ == '__main__':
+    main()
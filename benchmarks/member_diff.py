@@ -0,0 +1,43 @@
+"""Memory and diff cost of a 50,000-member friend list
+
+Compares sets of Python ints (what the member lists used to be) with the
+sorted ID arrays used by MemberLists, for a refresh where a few friends
+were added and removed.
+"""
+
+import sys
+
+from passerd.members import id_array, diff_ids
+from common import timeit, report
+
+FRIENDS = 50000
+CHANGES = 10
+FIRST_ID = 10**9
+
+def main():
+    old = range(FIRST_ID, FIRST_ID+FRIENDS*7, 7)
+    new = old[CHANGES:]+range(FIRST_ID+FRIENDS*7, FIRST_ID+FRIENDS*7+CHANGES)
+
+    old_set, new_set = set(old), set(new)
+    old_arr, new_arr = id_array(old), id_array(new)
+    set_bytes = sys.getsizeof(old_set)+sum([sys.getsizeof(i) for i in old])
+    arr_bytes = sys.getsizeof(old_arr)
+    print '%-40s %10.1f KiB' % ('set of %d IDs' % (FRIENDS), set_bytes/1024.)
+    print '%-40s %10.1f KiB' % ('array of %d IDs' % (FRIENDS), arr_bytes/1024.)
+
+    def set_diff():
+        assert len(new_set-old_set) == CHANGES
+        assert len(old_set-new_set) == CHANGES
+    def arr_diff():
+        added, removed = diff_ids(old_arr, new_arr)
+        assert len(added) == len(removed) == CHANGES
+    same_arr = id_array(old)
+    def arr_same():
+        added, removed = diff_ids(old_arr, same_arr)
+        assert len(added) == len(removed) == 0
+    report('set difference', timeit(set_diff), 'id', FRIENDS)
+    report('diff_ids(), %d changes' % (CHANGES), timeit(arr_diff), 'id', FRIENDS)
+    report('diff_ids(), no changes', timeit(arr_same), 'id', FRIENDS)
+
+if __name__ == '__main__':
+    main()
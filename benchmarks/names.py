@@ -0,0 +1,85 @@
+"""Allocation of user objects during NAMES on a 2,000-member channel
+
+Compares the current TwitterIrcUserCache, that keeps a single
+CachedTwitterIrcUser per Twitter ID, to creating a new object on every
+lookup (the old behavior, emulated below).
+"""
+
+from twisted.internet import defer
+
+from passerd import ircd
+from common import make_proto, make_page, make_status, timeit, report
+
+MEMBERS = 2000
+
+class FakeApi:
+    def __init__(self, ids):
+        self.ids = ids
+
+    def friends_ids(self, delegate, params={}, page_delegate=None):
+        for id in self.ids:
+            delegate(str(id))
+        page_delegate('0', '0')
+        return defer.succeed(None)
+
+created = [0]
+lookups = [0]
+
+orig_init = ircd.CachedTwitterIrcUser.__init__
+def counting_init(self, *args, **kwargs):
+    created[0] += 1
+    orig_init(self, *args, **kwargs)
+ircd.CachedTwitterIrcUser.__init__ = counting_init
+
+orig_lookup_id = ircd.TwitterUserCache.lookup_id
+def counting_lookup_id(self, id):
+    lookups[0] += 1
+    return orig_lookup_id(self, id)
+ircd.TwitterUserCache.lookup_id = counting_lookup_id
+
+def old_get_user(self, id):
+    return ircd.CachedTwitterIrcUser(self.proto, self.cache, id, self)
+
+def old_watch_user_id(self, id):
+    self._watched_ids[int(id)] = True
+
+def old_user_changed(self, id, old_info, new_info):
+    if id in self._watched_ids:
+        self._get_user(id).data_changed(old_info, new_info)
+    self._prefixes.pop(id, None)
+
+def make_channel(old):
+    p = make_proto()
+    if old:
+        users = p.twitter_users
+        users._get_user = lambda id: old_get_user(users, id)
+        users.watch_user_id = lambda id: old_watch_user_id(users, id)
+        users._user_changed = lambda *args: old_user_changed(users, *args)
+    ids = range(1000, 1000+MEMBERS)
+    p.global_twuser_cache.got_api_users_info(
+            [make_status(0, id).user for id in ids])
+    p.api = FakeApi(ids)
+    return p, p.channels['#twitter']
+
+def run(old):
+    p, chan = make_channel(old)
+    def names():
+        chan.sendNames()
+        p.output.discard()
+    # first NAMES, and then a few timeline pages from channel members
+    created[0] = lookups[0] = 0
+    t = timeit(names, repeat=3)
+    pages = [make_page(10000+i*100, 100, MEMBERS) for i in range(5)]
+    for page in pages:
+        chan.got_entries(page)
+    p.output.discard()
+    return t, created[0], lookups[0]
+
+def main():
+    for old, name in [(True, 'new object per lookup'), (False, 'interned')]:
+        t, c, l = run(old)
+        report('%s: NAMES, %d members' % (name, MEMBERS), t, 'member', MEMBERS)
+        print '    user objects created: %d. user info lookups: %d' % (c, l)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Cost of user info updates after many connections came and went
+
+The old code registered a global TwitterUserCache callback for every
+connection, and never removed it. That is emulated below, and compared
+to the per-ID watcher index.
+"""
+
+import gc
+
+from twisted.internet import error
+from twisted.python import failure
+
+from common import BenchFactory, make_proto, make_status, timeit, report
+
+OLD_CONNECTIONS = 200
+LIVE_CONNECTIONS = 20
+WATCHED = 100
+UPDATES = 1000
+
+def old_callback(users):
+    def user_changed(id, old_info, new_info):
+        if id in users._watched_ids:
+            users.user_changed(id, old_info, new_info)
+    return user_changed
+
+def run(old):
+    factory = BenchFactory()
+    cache = factory.global_twuser_cache
+    live = []
+    for i in range(OLD_CONNECTIONS+LIVE_CONNECTIONS):
+        p = make_proto(factory)
+        p.twitter_users.watch_user_ids(range(1000+i, 1000+i+WATCHED))
+        if old:
+            cache.addCallback(old_callback(p.twitter_users))
+        if i >= OLD_CONNECTIONS:
+            live.append(p)
+        else:
+            p.connectionLost(failure.Failure(error.ConnectionDone()))
+    del p
+    gc.collect()
+
+    users = [make_status(0, 5000+i).user for i in range(UPDATES)]
+    counter = [0]
+    def update():
+        # new screen names every time, so every update is a real change
+        counter[0] += 1
+        for u in users:
+            u.screen_name = 'user%d_%d' % (int(u.id), counter[0])
+        cache.got_api_users_info(users)
+    return timeit(update, repeat=3), len(cache.callbacks._cbs), cache.watched_ids()
+
+def main():
+    for old, name in [(True, 'global callbacks'), (False, 'per-id watchers')]:
+        t, callbacks, watched = run(old)
+        report('%s: %d updates' % (name, UPDATES), t, 'update', UPDATES)
+        print '    global callbacks: %d. watched ids: %d' % (callbacks, watched)
+
+if __name__ == '__main__':
+    main()
@@ -24,38 +24,148 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import time
 import traceback
+import types
+import weakref
+
+
+class WeakMethod:
+    """Weak reference to a bound method
+
+    Only the object the method is bound to is weakly referenced. Calling
+    the reference returns a new bound method, or None if the object is
+    gone.
+    """
+    def __init__(self, cb):
+        self.func = cb.im_func
+        self.cls = cb.im_class
+        self.obj = weakref.ref(cb.im_self)
+
+    def __call__(self):
+        o = self.obj()
+        if o is None:
+            return None
+        return types.MethodType(self.func, o, self.cls)
+
+    def matches(self, cb):
+        return getattr(cb, 'im_func', None) is self.func and \
+               getattr(cb, 'im_self', None) is self.obj()
+
+
+def _cb_name(cb):
+    """Name used for the callback on the timing stats"""
+    if isinstance(cb, WeakMethod):
+        return '%s.%s' % (cb.cls.__name__, cb.func.__name__)
+    o = getattr(cb, 'im_self', None)
+    if o is not None:
+        return '%s.%s' % (o.__class__.__name__, cb.__name__)
+    return getattr(cb, '__name__', repr(cb))
 
 
 # maybe Twisted has something equivalent to this, already?
 class CallbackList:
-    def __init__(self, ignore_exceptions=True, print_exceptions=True):
+    """A list of callbacks, all called by callback()
+
+    Callbacks registered with extra arguments get them appended to the
+    callback() arguments. If `timing` is set, the number of calls and the
+    time spent on each callback are kept, see stats().
+    """
+    def __init__(self, ignore_exceptions=True, print_exceptions=True, timing=False):
+        # list of (callback, args, kwargs, weak) tuples. The list is
+        # replaced, never changed in place, when callbacks are removed, so
+        # callback() can iterate over it safely:
         self._cbs = []
         self._ignore_exceptions = ignore_exceptions
         self._print_exceptions = print_exceptions
+        self._timing = timing
+        # callback name -> [calls, seconds]
+        self._times = {}
 
     def _doCall(self, cb, cbargs, cbkwargs, *args, **kwargs):
-        a = []
-        a.extend(args)
-        a.extend(cbargs)
-
-        kw = {}
-        kw.update(kwargs)
-        kw.update(cbkwargs)
-        return cb(*a, **kw)
+        if cbargs:
+            args = args + cbargs
+        if cbkwargs:
+            kwargs.update(cbkwargs)
+        return cb(*args, **kwargs)
 
     def addCallback(self, cb, *args, **kwargs):
-        self._cbs.append( (cb, args, kwargs) )
+        self._cbs.append( (cb, args, kwargs, False) )
+
+    def addWeakCallback(self, cb, *args, **kwargs):
+        """Add a callback, keeping only a weak reference to its object
+
+        If cb is a bound method, the callback is dropped when the object
+        it is bound to goes away. Other callables are referenced normally.
+        """
+        if getattr(cb, 'im_self', None) is None:
+            return self.addCallback(cb, *args, **kwargs)
+        self._cbs.append( (WeakMethod(cb), args, kwargs, True) )
+
+    def _purge(self):
+        """Drop weak callbacks whose objects are gone"""
+        self._cbs = [e for e in self._cbs if not e[3] or e[0]() is not None]
+
+    def removeCallback(self, cb):
+        """Remove all registrations of callback cb"""
+        def same(e):
+            if e[3]:
+                return e[0].matches(cb)
+            return e[0] == cb
+        self._cbs = [e for e in self._cbs if not same(e)]
+
+    def __len__(self):
+        self._purge()
+        return len(self._cbs)
+
+    def _timedCall(self, cb, ca, ckw, args, kwargs):
+        start = time.time()
+        try:
+            self._doCall(cb, ca, ckw, *args, **kwargs)
+        finally:
+            t = self._times.setdefault(_cb_name(cb), [0, 0.0])
+            t[0] += 1
+            t[1] += time.time()-start
 
     def callback(self, *args, **kwargs):
-        for cb, ca, ckw in self._cbs:
+        timing = self._timing
+        dead = False
+        for cb, ca, ckw, weak in self._cbs:
             try:
-                self._doCall(cb, ca, ckw, *args, **kwargs)
+                if weak:
+                    obj = cb.obj()
+                    if obj is None:
+                        dead = True
+                        continue
+                    if not (timing or ca or ckw):
+                        # call the function directly, instead of building
+                        # a new bound method:
+                        cb.func(obj, *args, **kwargs)
+                        continue
+                    cb = cb()
+                if timing:
+                    self._timedCall(cb, ca, ckw, args, kwargs)
+                elif ca or ckw:
+                    self._doCall(cb, ca, ckw, *args, **kwargs)
+                else:
+                    # common case: no extra arguments, nothing to build
+                    cb(*args, **kwargs)
             except:
                 if not self._ignore_exceptions:
                     raise
                 elif self._print_exceptions:
                     traceback.print_exc()
+        if dead:
+            self._purge()
+
+    def stats(self):
+        """Return (name, calls, seconds) for each callback, slowest first"""
+        r = [(name, c, t) for name, (c, t) in self._times.items()]
+        r.sort(key=lambda s: (-s[2], s[0]))
+        return r
+
+    def reset_stats(self):
+        self._times.clear()
 
 
-__all__ = ['CallbackList']
+__all__ = ['CallbackList', 'WeakMethod']
@@ -83,6 +83,15 @@ class TwitterUserData(Base):
     twitter_screen_name = Column(String)
     twitter_name = Column(String)
 
+class MemberList(Base):
+    """Cached member list (friend IDs, list members) of a channel"""
+    __tablename__ = 'member_lists'
+    key = Column(String, primary_key=True)
+    # comma-separated Twitter user IDs:
+    ids = Column(String)
+    # time of the last full fetch, in seconds since the epoch:
+    updated = Column(Integer)
+
 
 
 MIGRATIONS = []
@@ -209,10 +218,30 @@ class DataStore:
             v.value = value
         self.session.commit()
 
+    def get_member_list(self, key):
+        """Return (ids, updated) for a stored member list, or None"""
+        m = self.session.query(MemberList).get(key)
+        if m is None:
+            return None
+        if m.ids:
+            ids = [int(id) for id in m.ids.split(',')]
+        else:
+            ids = []
+        return ids, m.updated
+
+    def set_member_list(self, key, ids, updated):
+        m = self.session.query(MemberList).get(key)
+        if m is None:
+            m = MemberList(key=key)
+            self.session.add(m)
+        m.ids = ','.join(['%d' % (id) for id in ids])
+        m.updated = int(updated)
+        self.session.commit()
+
     def commit(self):
         self.session.commit()
 
-__all__ = ['DataStore', 'TwitterUserData']
+__all__ = ['DataStore', 'TwitterUserData', 'MemberList']
 
 if __name__ == '__main__':
     import logging, sys
@@ -113,6 +113,7 @@ class TwitterFeed:
         self.proto = proto
         self.updater = None
         self.entry_cb = CallbackList()
+        self.batch_cb = CallbackList()
         self.errbacks = CallbackList()
         self.raw_errbacks = CallbackList()
         self.continue_refreshing = False
@@ -120,6 +121,12 @@ class TwitterFeed:
         self.loading = False
         self._last_id = None
         self._error_handler = ErrorThrottler(self.report_error)
+        # pages waiting for the proto output to be resumed:
+        self._held_pages = []
+        # (feed, match) pairs, for feeds that get entries from this one:
+        self._routes = []
+        # the feed we get entries from, instead of polling:
+        self.routed_from = None
 
     def _last_id_var(self):
         return self.LAST_ID_VAR
@@ -135,16 +142,27 @@ class TwitterFeed:
         return self._last_id
 
     def addEntryCallback(self, *args, **kwargs):
-        """Add a callback for new entries"""
-        self.entry_cb.addCallback(*args, **kwargs)
+        """Add a callback for new entries
+
+        Like the other callbacks below, bound methods are weakly referenced,
+        so the feed doesn't keep its owner alive.
+        """
+        self.entry_cb.addWeakCallback(*args, **kwargs)
+
+    def addBatchCallback(self, *args, **kwargs):
+        """Add a callback for whole pages of new entries
+
+        The callback gets a list of entries, in chronological order.
+        """
+        self.batch_cb.addWeakCallback(*args, **kwargs)
 
     def addErrback(self, *args, **kwargs):
         """Add a callbck for loading errors"""
-        self.errbacks.addCallback(*args, **kwargs)
+        self.errbacks.addWeakCallback(*args, **kwargs)
 
     def addRawErrback(self, *args, **kwargs):
         """Add a "raw" error callback, without error throttling"""
-        self.raw_errbacks.addCallback(*args, **kwargs)
+        self.raw_errbacks.addWeakCallback(*args, **kwargs)
 
     @property
     def api(self):
@@ -179,23 +197,56 @@ class TwitterFeed:
 
         # store the entries and then show them in chronological order:
         def got_entry(e):
-            dbg("got an entry")
-            entries.insert(0, e)
+            entries.append(e)
 
         def finished(*args):
-            dbg("finished loading %r" % (args,))
+            dbg("finished loading %r", args)
 
             # tell the error throttler that things are ok, now:
             self._error_handler.ok()
 
-            for e in entries:
-                self.entry_cb.callback(e)
-                if self.last_id is None or int(e.id) > int(self.last_id):
-                    self.update_last_id(e.id)
+            # the API returns the newest entries first
+            entries.reverse()
+            self.deliver_entries(entries)
             return len(entries)
 
         return doit()
 
+    def deliver_entries(self, entries):
+        """Hand a page of entries (in chronological order) to the callbacks
+
+        Batch callbacks get the whole page at once, and last_id is updated
+        only once per page.
+        """
+        if not entries:
+            return
+
+        if self.proto.output_paused():
+            dbg("output is paused. holding %d entries", len(entries))
+            if not self._held_pages:
+                self.proto.when_output_resumed(self._deliver_held_pages)
+            self._held_pages.append(entries)
+            return
+
+        self.batch_cb.callback(entries)
+        for e in entries:
+            self.entry_cb.callback(e)
+
+        newest = max([int(e.id) for e in entries])
+        if self.last_id is None or newest > int(self.last_id):
+            self.update_last_id(str(newest))
+
+        for feed, match in self._routes:
+            routed = [e for e in entries if match(e)]
+            if routed:
+                feed.deliver_entries(routed)
+
+    def _deliver_held_pages(self):
+        pages = self._held_pages
+        self._held_pages = []
+        for entries in pages:
+            self.deliver_entries(entries)
+
     def report_error(self, e):
         """Send an error message back to interested parties"""
         self.errbacks.callback(e)
@@ -225,13 +276,47 @@ class TwitterFeed:
 
         return doit()
 
+    def is_refreshing(self):
+        return self.updater is not None
+
+    def add_route(self, feed, match):
+        """Deliver the entries for which match(e) is true to another feed"""
+        self._routes.append( (feed, match) )
+
+    def remove_route(self, feed):
+        self._routes = [r for r in self._routes if r[0] is not feed]
+
+    def start_routed(self, source, match):
+        """Get entries from the `source` feed, instead of polling the API
+
+        The feed is refreshed once, to get the entries posted since the
+        last refresh, and after that it gets the entries from `source` for
+        which match(e) is true. If `source` stops refreshing, this feed
+        starts polling on its own.
+        """
+        if self.routed_from is source:
+            return
+        self.stop_refreshing()
+        self.routed_from = source
+        source.add_route(self, match)
+        self.refresh()
+
     def stop_refreshing(self):
+        if self.routed_from is not None:
+            self.routed_from.remove_route(self)
+            self.routed_from = None
         if self.updater is not None:
             self.updater.destroy()
             self.updater = None
+            # feeds routed from this one need to poll by themselves:
+            routes = self._routes
+            self._routes = []
+            for feed, match in routes:
+                feed.routed_from = None
+                feed.start_refreshing()
 
     def start_refreshing(self):
-        if self.updater is None:
+        if self.updater is None and self.routed_from is None:
             self.updater = self.scheduler.new_updater(self.refresh)
             # yes, this is cheating, but I don't want to make the user wait for
             # too long
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+#
+# Passerd - An IRC server as a gateway to Twitter
+#
+# Recent post history data structures
+#
+# Author: Eduardo Habkost <ehabkost@raisama.net>
+#
+# Copyright (c) 2009 Eduardo Pereira Habkost <ehabkost@raisama.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import re
+import time
+import rfc822
+import weakref
+from bisect import bisect_left
+from collections import deque
+
+from passerd.utils import full_entity_decode
+
+# number of status IDs kept by SeenIds, by default:
+SEEN_IDS_SIZE = 5000
+
+class SeenIds:
+    """A bounded set of recently seen status IDs
+
+    Only the `size` highest IDs are kept, on a sorted list. As status IDs
+    grow over time, those are the most recent ones.
+    """
+    def __init__(self, size=SEEN_IDS_SIZE):
+        self.size = size
+        self._ids = []
+
+    def __contains__(self, id):
+        ids = self._ids
+        i = bisect_left(ids, id)
+        return i < len(ids) and ids[i] == id
+
+    def __len__(self):
+        return len(self._ids)
+
+    def trim(self, size):
+        """Drop all but the `size` highest IDs"""
+        if len(self._ids) > size:
+            del self._ids[:len(self._ids)-size]
+
+    def add(self, id):
+        """Add id to the set. Returns False if it was already there"""
+        ids = self._ids
+        if not ids or id > ids[-1]:
+            # common case: a new status
+            ids.append(id)
+        else:
+            i = bisect_left(ids, id)
+            if i < len(ids) and ids[i] == id:
+                return False
+            if i == 0 and len(ids) >= self.size:
+                # too old to be kept
+                return True
+            ids.insert(i, id)
+
+        if len(ids) > self.size:
+            del ids[:len(ids)-self.size]
+        return True
+
+
+def _parse_date(s):
+    """Convert a Twitter API date to an epoch timestamp"""
+    if not s:
+        return None
+    t = rfc822.parsedate_tz(s)
+    if t is None:
+        return None
+    return rfc822.mktime_tz(t)
+
+def _intern_name(n):
+    if isinstance(n, unicode):
+        n = n.encode('utf-8')
+    return intern(n)
+
+NON_WORD_RE = re.compile(r'\W+', re.UNICODE)
+
+def normalize_text(s):
+    """Lowercase text, with punctuation and repeated spaces collapsed to a single space
+
+    Used both for post text and for the text the user is looking for, so
+    that matches ignore case, punctuation and spacing.
+    """
+    return NON_WORD_RE.sub(u' ', s.lower()).strip()
+
+def trigrams(s):
+    return set([s[i:i+3] for i in xrange(len(s)-2)])
+
+class HistoryEntry(object):
+    """Compact record of a post kept on the channel history
+
+    Status objects from the API keep every field that was parsed, including
+    nested user and retweeted_status objects. Only what is needed to find a
+    post again is kept here. The text is entity-decoded and lowercase, and
+    `norm` is the same text as returned by normalize_text().
+    """
+    __slots__ = ('id', 'user_id', 'screen_name', 'text', 'norm',
+                 'created_at', 'in_reply_to', '__weakref__')
+
+    def __init__(self, id, user_id, screen_name, text, created_at=None,
+                 in_reply_to=None):
+        self.id = id
+        self.user_id = user_id
+        self.screen_name = screen_name
+        self.text = text
+        self.norm = normalize_text(text)
+        self.created_at = created_at
+        self.in_reply_to = in_reply_to
+
+    @classmethod
+    def from_status(klass, e):
+        reply = e.in_reply_to_status_id
+        return klass(int(e.id), int(e.user.id),
+                     _intern_name(e.user.screen_name),
+                     full_entity_decode(e.text).lower(),
+                     _parse_date(e.created_at),
+                     reply and int(reply) or None)
+
+    @classmethod
+    def from_post(klass, id, user, text, in_reply_to=None):
+        """Record for a post just sent by `user`, with unicode `text`"""
+        return klass(int(id), int(user.id), _intern_name(user.screen_name),
+                     text.lower(), time.time(),
+                     in_reply_to and int(in_reply_to) or None)
+
+    def __repr__(self):
+        return '<HistoryEntry %d by %s>' % (self.id, self.screen_name)
+
+
+class StatusStore:
+    """Process-wide store of HistoryEntry records, keyed by status ID
+
+    The same post is usually seen on many channels of many connections.
+    Interning the records here means each post is decoded and kept in
+    memory only once. Records are weakly referenced, so they go away once
+    no channel history references them anymore.
+    """
+    def __init__(self):
+        self._records = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, id):
+        return self._records.get(id)
+
+    def record(self, e):
+        """Return the record for the status object `e`, creating it if needed"""
+        id = int(e.id)
+        r = self._records.get(id)
+        if r is None:
+            self.misses += 1
+            r = HistoryEntry.from_status(e)
+            self._records[id] = r
+        else:
+            self.hits += 1
+        return r
+
+
+# number of posts kept on each channel history, by default:
+HISTORY_SIZE = 100
+
+# find() just checks every post by the user if there are only a few of them:
+SCAN_POSTS = 16
+
+# approximate memory used by the history, not including the records. The
+# trigram index is the largest part of it:
+HISTORY_SLOT_BYTES = 150
+TRIGRAM_BYTES = 800
+TRIGRAM_ENTRY_BYTES = 60
+
+class ChannelHistory:
+    """Fixed-size history of recent posts, with a per-user index
+
+    Posts (HistoryEntry objects) are kept on a ring buffer. When a post is
+    evicted from the ring, it is removed from the indexes too, and users
+    without any post left are dropped. So the memory usage is bounded by
+    `size`, no matter how many different users are seen.
+
+    Besides the per-user index, there is an index of screen names, and a
+    trigram index of the normalized text, used by find().
+    """
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.clear()
+
+    def __len__(self):
+        return self._count
+
+    def users(self):
+        """Number of users on the per-user index"""
+        return len(self._by_user)
+
+    def add(self, post):
+        """Add a post, evicting the oldest one if full"""
+        ring = self._ring
+        i = self._next
+        old = ring[i]
+        if old is not None:
+            self._evict(old)
+        else:
+            self._count += 1
+        ring[i] = post
+        self._next = (i+1) % self.size
+
+        uid = post.user_id
+        self._by_user.setdefault(uid, deque()).append(post)
+        self._names[post.screen_name.lower()] = uid
+
+        # records are shared, so the same post may be added twice
+        copies = self._copies.get(post, 0)
+        self._copies[post] = copies+1
+        if not copies:
+            index = self._trigrams
+            tris = trigrams(post.norm)
+            for t in tris:
+                index.setdefault(t, set()).add(post)
+            self._index_entries += len(tris)
+
+    def _evict(self, post):
+        uid = post.user_id
+        posts = self._by_user.get(uid)
+        # both the ring and the per-user lists are FIFO, so the evicted
+        # post is always the oldest one on the user list
+        if posts and posts[0] is post:
+            posts.popleft()
+            if not posts:
+                del self._by_user[uid]
+                name = post.screen_name.lower()
+                if self._names.get(name) == uid:
+                    del self._names[name]
+
+        copies = self._copies.pop(post) - 1
+        if copies:
+            self._copies[post] = copies
+            return
+
+        index = self._trigrams
+        tris = trigrams(post.norm)
+        self._index_entries -= len(tris)
+        for t in tris:
+            s = index.get(t)
+            if s is not None:
+                s.discard(post)
+                if not s:
+                    del index[t]
+
+    def approx_bytes(self):
+        """Approximate memory used by the history and its indexes
+
+        The records themselves are shared between channels, so they are
+        not included.
+        """
+        return (self._count*HISTORY_SLOT_BYTES +
+                len(self._trigrams)*TRIGRAM_BYTES +
+                self._index_entries*TRIGRAM_ENTRY_BYTES)
+
+    def user_id(self, screen_name):
+        """Return the ID of the user with a post on the history, or None"""
+        return self._names.get(screen_name.lower())
+
+    def by_user(self, uid):
+        """Return the posts by user `uid`, oldest first"""
+        return list(self._by_user.get(uid, ()))
+
+    def latest_by_user(self, uid):
+        posts = self._by_user.get(uid)
+        if not posts:
+            return None
+        return posts[-1]
+
+    def find(self, uid, substring):
+        """Find posts by user `uid` containing `substring`, newest first
+
+        The text is compared after normalize_text(). If the user has more
+        than SCAN_POSTS posts, substrings of 3 or more characters are looked
+        up on the trigram index instead of checking every post.
+
+        Substrings made only of punctuation (e.g. ":)") are compared with
+        the lowercase text, as they normalize to an empty string, that would
+        match every post.
+        """
+        sub = normalize_text(substring)
+        candidates = self._by_user.get(uid, ())
+        if not sub:
+            sub = substring.lower()
+            return self._matches(uid, candidates, lambda p: sub in p.text)
+        if len(sub) >= 3 and len(candidates) > SCAN_POSTS:
+            index = self._trigrams
+            sets = []
+            for t in trigrams(sub):
+                s = index.get(t)
+                if not s:
+                    return []
+                sets.append(s)
+            sets.sort(key=len)
+            candidates = sets[0]
+            for s in sets[1:]:
+                if len(candidates) <= SCAN_POSTS:
+                    break
+                candidates = candidates & s
+        return self._matches(uid, candidates, lambda p: sub in p.norm)
+
+    def _matches(self, uid, candidates, match):
+        found = {}
+        for p in candidates:
+            # a post may be on the history twice, if it was re-sent
+            if p.user_id == uid and match(p):
+                found[p.id] = p
+        return [found[id] for id in sorted(found, reverse=True)]
+
+    def posts(self):
+        """Return all posts, oldest first"""
+        ring = self._ring
+        i = self._next
+        return [p for p in ring[i:]+ring[:i] if p is not None]
+
+    def resize(self, size):
+        """Change the history size, keeping the most recent posts"""
+        if size == self.size:
+            return
+        posts = self.posts()
+        self.size = size
+        self.clear()
+        for p in posts[-size:]:
+            self.add(p)
+
+    def clear(self):
+        self._ring = [None]*self.size
+        self._next = 0
+        self._count = 0
+        # user ID -> deque of posts, oldest first:
+        self._by_user = {}
+        # lowercase screen_name -> user ID:
+        self._names = {}
+        # trigram -> set of posts:
+        self._trigrams = {}
+        # post -> number of times it is on the ring:
+        self._copies = {}
+        # total size of the trigram sets:
+        self._index_entries = 0
+
+
+__all__ = ['SeenIds', 'HistoryEntry', 'StatusStore', 'ChannelHistory', 'normalize_text']
@@ -38,12 +38,24 @@ pinfo = logger.info
 perror = logger.error
 
 
-class IrcTarget:
+def build_line(prefix, command, target, text):
+    """Build a ":prefix COMMAND target :text" IRC line
+
+    All arguments must be already-encoded byte strings. No validation is
+    done, so text must not contain newlines.
+    """
+    return ''.join([':', prefix, ' ', command, ' ', target, ' :', text])
+
+class IrcTarget(object):
     """Common class for IRC channels and users
 
     This may contain some common operations that work for both users and
     channels.
     """
+    # subclasses without __slots__ still get a __dict__. The slots are
+    # needed only by small, numerous objects like CachedTwitterIrcUser
+    __slots__ = ('proto', 'msg_notifiers', '__weakref__')
+
     def __init__(self, proto):
         self.proto = proto
         self.msg_notifiers  = []
@@ -131,6 +143,8 @@ class IrcTarget:
 
 
 class IrcUser(IrcTarget):
+    __slots__ = ('nick', 'username', 'hostname', 'real_name', '_irc_prefix')
+
     supported_modes = ''
 
     def __cmp__(self, o):
@@ -152,6 +166,23 @@ class IrcUser(IrcTarget):
     def full_id(self):
         return '%s!%s@%s' % (self.nick, self.username, self.hostname)
 
+    def irc_prefix(self):
+        """Return full_id() as an encoded string, for use as message prefix
+
+        The result is cached. prefix_changed() must be called when nick,
+        username or hostname changes.
+        """
+        p = getattr(self, '_irc_prefix', None)
+        if p is None:
+            p = self._irc_prefix = str(self.full_id())
+        return p
+
+    def prefix_changed(self):
+        try:
+            del self._irc_prefix
+        except AttributeError:
+            pass
+
     def notifyNickChange(self, new_nick):
         """Must be called before self.nick value changes, so the sender ID is correct"""
         self.proto.send_message(self, 'NICK', new_nick)
@@ -160,6 +191,7 @@ class IrcUser(IrcTarget):
         if self.nick != new_nick:
             self.notifyNickChange(new_nick)
             self.nick = new_nick
+            self.prefix_changed()
 
 class IrcChannel(IrcTarget):
     supported_modes = 'b'
@@ -223,34 +255,34 @@ class IrcChannel(IrcTarget):
         self.proto.send_reply(irc.RPL_CHANNELMODEIS, self.name, self.fullModeSpec())
 
     def _sendNames(self, members):
-        namelist = []
-        def flush():
-            names = ' '.join(namelist)
-            self.proto.send_reply(irc.RPL_NAMREPLY, '=', self.name, ':%s' % (names))
-            namelist[:] = []
+        r = NamesReply(self)
+        r.add(members)
+        r.end()
 
-        for m in members:
-            namelist.append('%s%s' % (self.userModeChar(m), m.nick))
-            if len(namelist) > 30:
-                flush()
-        flush()
-        self.proto.send_reply(irc.RPL_ENDOFNAMES, self.name, ':End of NAMES list')
+    def stream_members(self, members_cb):
+        """Call members_cb(members) as parts of the member list arrive
+
+        Returns a Deferred that fires after the last part. By default, the
+        whole list returned by list_members() is delivered at once.
+        """
+        return defer.maybeDeferred(self.list_members).addCallback(members_cb)
 
     def sendNames(self):
-        def doit():
-            d = defer.maybeDeferred(self.list_members)
-            d.addCallback(send_names).addErrback(error)
+        """Send the NAMES reply, part by part, as the members arrive"""
+        r = NamesReply(self)
 
-        def send_names(members):
-            dbg("got member list: %d members" % (len(members)))
-            self._sendNames(members)
+        def done(*args):
+            dbg("sent member list: %d members" % (r.count))
+            r.end()
 
         def error(e):
             self.proto.notice("ERROR: failure getting member names for %s -- %s" % (self.name, e.value))
             #FIXME: include the_user only if the user already joined
-            self._sendNames([self.proto.the_user])
+            if r.count == 0:
+                r.add([self.proto.the_user])
+            r.end()
 
-        doit()
+        self.stream_members(r.add).addCallbacks(done, error)
 
     @hooks
     def userJoined(self, user):
@@ -281,6 +313,46 @@ class IrcChannel(IrcTarget):
             self.kickUser(sender, u)
 
 
+# maximum length of an IRC line, including CR-LF:
+MAX_LINE_LENGTH = 512
+
+class NamesReply:
+    """Sends RPL_NAMREPLY lines for a channel, packed up to the line limit"""
+    def __init__(self, chan):
+        self.chan = chan
+        proto = chan.proto
+        header = ':%s %s %s %s %s :' % (proto.my_irc_server.irc_prefix(),
+                irc.RPL_NAMREPLY, proto.the_user.nick, chan.typeChar(), chan.name)
+        self.room = MAX_LINE_LENGTH-len(header)-2
+        self.names = []
+        self.size = 0
+        self.count = 0
+
+    def add(self, members):
+        """Add members, sending the lines that are full"""
+        mode_char = self.chan.userModeChar
+        for m in members:
+            n = '%s%s' % (mode_char(m), m.nick)
+            if self.names and self.size+1+len(n) > self.room:
+                self.flush()
+            if self.names:
+                self.size += 1
+            self.size += len(n)
+            self.names.append(n)
+            self.count += 1
+
+    def flush(self):
+        if self.names:
+            self.chan.proto.send_reply(irc.RPL_NAMREPLY, self.chan.typeChar(), self.chan.name,
+                                       ':%s' % (' '.join(self.names)))
+            self.names = []
+            self.size = 0
+
+    def end(self):
+        self.flush()
+        self.chan.proto.send_reply(irc.RPL_ENDOFNAMES, self.chan.name, ':End of NAMES list')
+
+
 class IrcServer(IrcTarget):
     """An IrcTarget used for server messages"""
     def __init__(self, proto, name):
@@ -290,5 +362,8 @@ class IrcServer(IrcTarget):
     def full_id(self):
         return self.name
 
+    def irc_prefix(self):
+        return self.name
+
 
 
@@ -27,8 +27,9 @@
 import sys, os, logging, time, re, random
 import fcntl, signal
 import gc
+import weakref
 import optparse
-import rfc822 # for date/time parsing
+from bisect import bisect_left
 
 from twisted.words.protocols import irc
 from twisted.words.protocols.irc import IRC
@@ -44,10 +45,17 @@ from passerd.callbacks import CallbackList
 from passerd.utils import full_entity_decode
 from passerd.feeds import HomeTimelineFeed, ListTimelineFeed, UserTimelineFeed, MentionsFeed, DirectMessagesFeed, ThrottlerMessage
 from passerd.scheduler import ApiScheduler
+from passerd.output import OutputBuffer
+from passerd.memory import MemoryGovernor
+from passerd import memory
+from passerd.history import SeenIds, HistoryEntry, StatusStore, ChannelHistory
+from passerd.members import MemberLists, diff_ids
+from passerd.paging import CursorPaginator
+from passerd.postqueue import PostQueue
 from passerd import dialogs
 from passerd.dialogs import Dialog, CommandDialog, CommandHelpMixin, attach_dialog_to_channel, attach_dialog_to_bot
-from passerd.util import try_unicode, to_str
-from passerd.irc import IrcUser, IrcChannel, IrcServer
+from passerd.util import try_unicode, to_str, LRUCache
+from passerd.irc import IrcUser, IrcChannel, IrcServer, build_line
 from passerd.poauth import OAuthClient, oauth_consumer
 from passerd import version
 import oauth.oauth as oauth
@@ -90,14 +98,37 @@ LENGTH_LIMIT = 140
 
 # keep latest 100 post on each channel, to create in_reply_to field.
 REPLY_HISTORY_SIZE = 100
+# the history size can be changed for each channel, up to:
+MAX_HISTORY_SIZE = 2000
+# history size for idle connections, when the memory budget is exceeded:
+IDLE_HISTORY_SIZE = 20
+# number of seen status IDs kept for idle connections:
+IDLE_SEEN_IDS = 500
+
+# number of status IDs kept on the per-channel seen-id window:
+CHANNEL_SEEN_IDS = 1000
+
+# unknown friends are fetched using one /users/show request per user if that
+# takes fewer requests than paging through the friend list
+# (/statuses/friends), and no more than MAX_USER_INFO_REQS requests:
+MAX_USER_INFO_REQS = 10
+# /users/show requests running at the same time:
+USER_LOOKUP_CONCURRENCY = 4
+
+# users on each page of the friend list:
+FRIEND_PAGE_SIZE = 100
+# the maximum number of sequential friend list page requests:
+MAX_FRIEND_PAGE_REQS = 10
 
-# if more than MAX_USER_INFO_FETCH users are unknown, use /statuses/friends to fetch user info.
-# otherwise, just fetch individual user info
+# maximum number of IDs on a single "IN (...)" database query
+LOOKUP_CHUNK_SIZE = 500
 
-MAX_USER_INFO_FETCH = 0  # individual fetch is not implemented yet...
+# maximum number of cached message prefixes of Twitter users, per connection
+PREFIX_CACHE_SIZE = 5000
 
-# the maximum number of sequential friend list page requests:
-MAX_FRIEND_PAGE_REQS = 10
+# number of rendered posts kept, per connection, so posts shown on multiple
+# channels are rendered only once
+RENDER_CACHE_SIZE = 200
 
 
 # minimum post age (in seconds) to allow it to be used for RTs.
@@ -156,6 +187,10 @@ class TwitterUserInfo:
         d.twitter_name = self.name
         return self
 
+    def same_as(self, o):
+        return (o is not None and self.screen_name == o.screen_name
+                and self.name == o.name)
+
     def __repr__(self):
         return 'TwitterUserInfo(%r, %r)' % (self.screen_name, self.name)
 
@@ -168,6 +203,14 @@ class TwitterUserCache:
     def __init__(self, proto):
         self.proto = proto
         self.callbacks = CallbackList()
+        # lowercase screen_name -> Twitter ID, for known users:
+        self._names = {}
+        # IDs of users known to have info stored on the database:
+        self._known_ids = set()
+        # Twitter ID -> set of watcher keys:
+        self._watchers = {}
+        # watcher key -> (weak reference to watcher, set of watched IDs):
+        self._watcher_refs = {}
 
     def addCallback(self, cb, *args, **kwargs):
         """Add a new callback function
@@ -177,11 +220,98 @@ class TwitterUserCache:
         """
         self.callbacks.addCallback(cb, *args, **kwargs)
 
+    def addWeakCallback(self, cb, *args, **kwargs):
+        """Like addCallback(), but bound methods are weakly referenced"""
+        self.callbacks.addWeakCallback(cb, *args, **kwargs)
+
+    def removeCallback(self, cb):
+        self.callbacks.removeCallback(cb)
+
+    def watch(self, twid, watcher):
+        """Notify watcher about changes on the info of user `twid`
+
+        watcher.user_changed(twitter_id, old_info, new_info) is called
+        before the data is updated, like the addCallback() callbacks. Only
+        a weak reference to the watcher is kept, so watchers that go away
+        are dropped automatically.
+        """
+        key = id(watcher)
+        entry = self._watcher_refs.get(key)
+        if entry is None:
+            ref = weakref.ref(watcher, lambda r: self._forget(key))
+            entry = self._watcher_refs[key] = (ref, set())
+        twid = int(twid)
+        entry[1].add(twid)
+        self._watchers.setdefault(twid, set()).add(key)
+
+    def unwatch(self, twid, watcher):
+        key = id(watcher)
+        entry = self._watcher_refs.get(key)
+        if entry is None:
+            return
+        twid = int(twid)
+        entry[1].discard(twid)
+        self._drop_watcher(twid, key)
+
+    def unwatch_all(self, watcher):
+        """Stop notifying watcher about any user"""
+        self._forget(id(watcher))
+
+    def _drop_watcher(self, twid, key):
+        keys = self._watchers.get(twid)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._watchers[twid]
+
+    def _forget(self, key):
+        entry = self._watcher_refs.pop(key, None)
+        if entry is None:
+            return
+        for twid in entry[1]:
+            self._drop_watcher(twid, key)
+
+    def watched_ids(self):
+        """Number of user IDs being watched"""
+        return len(self._watchers)
+
+    def _notify_watchers(self, twid, old_info, new_info):
+        keys = self._watchers.get(twid)
+        if not keys:
+            return
+        # the set may change while the watchers run:
+        for key in list(keys):
+            entry = self._watcher_refs.get(key)
+            if entry is None:
+                continue
+            w = entry[0]()
+            if w is None:
+                continue
+            try:
+                w.user_changed(twid, old_info, new_info)
+            except:
+                logger.exception("error notifying user info change")
+
     def _change_data(self, d, old_info, new_info):
         # callbacks must becalled _before_ updating the data:
         self.callbacks.callback(d.twitter_id, old_info, new_info)
+        self._notify_watchers(d.twitter_id, old_info, new_info)
 
         new_info.to_data(d)
+        if old_info is not None:
+            old_name = old_info.screen_name.lower()
+            if self._names.get(old_name) == d.twitter_id:
+                del self._names[old_name]
+        name = new_info.screen_name.lower()
+        other = self._names.get(name)
+        if other is not None and other != d.twitter_id:
+            # the screen name was reused, and we may not know the new
+            # name of the other user yet. Don't guess: screen_name_id()
+            # will check the database, like lookup_screen_name() does
+            del self._names[name]
+        else:
+            self._names[name] = d.twitter_id
+        self._known_ids.add(d.twitter_id)
 
     def _new_user(self, id, info):
         d = TwitterUserData(twitter_id=id)
@@ -198,6 +328,8 @@ class TwitterUserCache:
             return self._new_user(id, new_info)
 
         old_info = TwitterUserInfo().from_data(d)
+        if new_info.same_as(old_info):
+            return d
         self._change_data(d, old_info, new_info)
         #FIXME: encapsulate the following session operation, somehow:
         self.proto.data.session.commit()
@@ -213,6 +345,48 @@ class TwitterUserCache:
     def got_api_user_info(self, u):
         self.update_user_info(u.id, u.screen_name, u.name)
 
+    def got_api_users_info(self, users):
+        """Bulk version of got_api_user_info()
+
+        Existing records are loaded using a single query, and all changes
+        are committed at once.
+        """
+        ids = []
+        infos = {}
+        for u in users:
+            id = int(u.id)
+            if id not in infos:
+                ids.append(id)
+            i = infos[id] = TwitterUserInfo()
+            i.screen_name = u.screen_name
+            i.name = u.name
+
+        if not ids:
+            return
+
+        existing = dict([(d.twitter_id, d) for d in self.lookup_ids(ids)])
+        #FIXME: encapsulate the following session operations, somehow:
+        session = self.proto.data.session
+        changed = False
+        for id in ids:
+            new_info = infos[id]
+            d = existing.get(id)
+            if d is None:
+                d = TwitterUserData(twitter_id=id)
+                self._change_data(d, None, new_info)
+                session.add(d)
+                changed = True
+                continue
+
+            old_info = TwitterUserInfo().from_data(d)
+            if new_info.same_as(old_info):
+                continue
+            self._change_data(d, old_info, new_info)
+            changed = True
+
+        if changed:
+            session.commit()
+
     def lookup_id(self, id):
         id = int(id)
         #FIXME: encapsulate the following session operations, somehow:
@@ -222,6 +396,64 @@ class TwitterUserCache:
 
         return d
 
+    def lookup_ids(self, ids):
+        """Look up multiple user IDs at once, returning the known ones"""
+        ids = [int(id) for id in ids]
+        r = []
+        # keep below the SQLite limit of variables per statement
+        for i in range(0, len(ids), LOOKUP_CHUNK_SIZE):
+            chunk = ids[i:i+LOOKUP_CHUNK_SIZE]
+            #FIXME: encapsulate the following session operations, somehow:
+            q = self.proto.data.query(TwitterUserData).filter(TwitterUserData.twitter_id.in_(chunk))
+            r.extend(q.all())
+        return r
+
+    def unknown_ids(self, ids):
+        """Return the set of user IDs from `ids` that have no info stored
+
+        IDs already known are checked in memory. Only the remaining ones are
+        looked up, loading just the ID column, using a few "IN (...)"
+        queries instead of a query for each user.
+        """
+        unknown = set([int(id) for id in ids])
+        unknown.difference_update(self._known_ids)
+        ids = list(unknown)
+        for i in range(0, len(ids), LOOKUP_CHUNK_SIZE):
+            chunk = ids[i:i+LOOKUP_CHUNK_SIZE]
+            #FIXME: encapsulate the following session operations, somehow:
+            q = self.proto.data.query(TwitterUserData.twitter_id).filter(TwitterUserData.twitter_id.in_(chunk))
+            found = [r[0] for r in q]
+            unknown.difference_update(found)
+            self._known_ids.update(found)
+        return unknown
+
+    def cached_known_ids(self):
+        return len(self._known_ids)
+
+    def clear_known_ids(self):
+        self._known_ids.clear()
+
+    def screen_name_id(self, name):
+        """Return the Twitter ID for a screen_name, or None if unknown
+
+        Looks at the in-memory index first, and queries the database only
+        for names that are not on the index.
+        """
+        key = name.lower()
+        id = self._names.get(key)
+        if id is None:
+            u = self.lookup_screen_name(name)
+            if u is None:
+                return None
+            id = self._names[key] = u.twitter_id
+        return id
+
+    def cached_names(self):
+        return len(self._names)
+
+    def clear_names(self):
+        self._names.clear()
+
     def lookup_screen_name(self, name):
         # not 
         try:
@@ -238,6 +470,8 @@ class TwitterUserCache:
 
 class TwitterIrcUser(IrcUser):
     """Common class for multiple methods of contacting IRC users"""
+    __slots__ = ()
+
     def _target_params(self, params):
         """Must return a dictionary containing user_id or screen_name, depending on
         how much information we already have about the user.
@@ -292,19 +526,23 @@ class CachedTwitterIrcUser(TwitterIrcUser):
     """An IrcUser object for cached Twitter user info
 
     Objects of this class may be short-lived, just to return info of a random
-    Twitter user for which we don't have much data.
+    Twitter user for which we don't have much data. TwitterIrcUserCache keeps
+    a single object for each Twitter user ID, while it is referenced.
     """
-    def __init__(self, proto, cache, id):
+    __slots__ = ('_twitter_id', 'cache', 'irc_users', '_data')
+
+    def __init__(self, proto, cache, id, irc_users=None):
         IrcUser.__init__(self, proto)
         self._twitter_id = id
         self.cache = cache
+        self.irc_users = irc_users
         self._data = None
 
     def _target_params(self):
         return {'user_id':self._twitter_id}
 
     def data_changed(self, old_info, new_info):
-        dbg("CachedTwitterIrcUser.data_changed! %r %r" % (old_info, new_info))
+        dbg("CachedTwitterIrcUser.data_changed! %r %r", old_info, new_info)
         if (old_info is None) or (old_info.screen_name != new_info.screen_name):
             self.notifyNickChange(str(new_info.screen_name))
 
@@ -330,6 +568,15 @@ class CachedTwitterIrcUser(TwitterIrcUser):
     real_name = property(lambda self: self.data.twitter_name.encode('utf-8'))
     hostname = property(lambda self: 'twitter.com')
 
+    def full_id(self):
+        nick = self.nick
+        return '%s!%s@twitter.com' % (nick, nick)
+
+    def irc_prefix(self):
+        if self.irc_users is None:
+            return IrcUser.irc_prefix(self)
+        return self.irc_users.prefix(self)
+
 
 class UnknownTwitterUser(TwitterIrcUser):
     """An IrcUser object for an user we don't know anything about, but may be a valid Twitter user"""
@@ -355,22 +602,58 @@ class TwitterIrcUserCache:
     def __init__(self, proto, cache):
         self.proto = proto
         self.cache = cache
-        self.cache.addCallback(self._user_changed)
+        # watched user objects are kept alive, so channel members are
+        # reused by NAMES, message rendering and change notifications:
         self._watched_ids = {}
-
-    def _user_changed(self, id, old_info, new_info):
-        dbg("user_changed: %r, %r, %r" % (id, old_info, new_info))
-        if id in self._watched_ids:
-            dbg("user_changed (%s): is being watched." % (id))
-            u = self._get_user(id).data_changed(old_info, new_info)
+        # encoded message prefix for each Twitter user ID:
+        self._prefixes = {}
+        # CachedTwitterIrcUser object for each Twitter user ID:
+        self._users = weakref.WeakValueDictionary()
+
+    def user_changed(self, id, old_info, new_info):
+        """Called by TwitterUserCache when a watched user changes"""
+        dbg("user_changed: %r, %r, %r", id, old_info, new_info)
+        u = self._watched_ids.get(id)
+        if u is not None:
+            dbg("user_changed (%s): is being watched.", id)
+            u.data_changed(old_info, new_info)
+        # the NICK message above still needs the old prefix. drop it only now:
+        self._prefixes.pop(id, None)
 
     def _get_user(self, id):
-        u = CachedTwitterIrcUser(self.proto, self.cache, id)
+        id = int(id)
+        u = self._users.get(id)
+        if u is None:
+            u = self._users[id] = CachedTwitterIrcUser(self.proto, self.cache, id, self)
         return u
 
+    def prefix(self, u):
+        """Return the cached message prefix for a CachedTwitterIrcUser"""
+        id = u._twitter_id
+        p = self._prefixes.get(id)
+        if p is None:
+            if len(self._prefixes) >= PREFIX_CACHE_SIZE:
+                self.clear_prefixes()
+            p = self._prefixes[id] = u.full_id()
+            # the prefix must be dropped if the user changes its name
+            self.cache.watch(id, self)
+        return p
+
+    def cached_prefixes(self):
+        return len(self._prefixes)
+
+    def clear_prefixes(self):
+        for id in self._prefixes:
+            if id not in self._watched_ids:
+                self.cache.unwatch(id, self)
+        self._prefixes.clear()
+
     def watch_user_id(self, id):
         """Start watching user ID for changes"""
-        self._watched_ids[id] = True
+        id = int(id)
+        if id not in self._watched_ids:
+            self._watched_ids[id] = self._get_user(id)
+            self.cache.watch(id, self)
 
     def watch_user_ids(self, ids):
         for id in ids:
@@ -384,65 +667,82 @@ class TwitterIrcUserCache:
 
 
     def fetch_individual_user_info(self, unknown_users):
-        #TODO: implement me
-        pass
-
-    def fetch_all_friend_info(self, user, unknown_users):
-        #TODO: unify this paging code with the one on FriendlistMixIn
-        reqs = []
-        def request_cursor(cursor):
-            self.proto.dbg("requesting a page from the friend list: %s" % (str(cursor)))
-            reqs.append(cursor)
-            self.proto.api.list_friends(got_user, user=user, params={'cursor':cursor},
-                                        page_delegate=end_page).addCallbacks(done, error)
+        """Fetch info for a list of users, one /users/show request per user
 
-        def got_user(u):
-            self.proto.global_twuser_cache.got_api_user_info(u)
+        Up to USER_LOOKUP_CONCURRENCY requests run at the same time.
+        """
+        api = self.proto.api
+        cache = self.proto.global_twuser_cache
+        ids = [str(u._twitter_id) for u in unknown_users]
+        failed = []
 
-        def end_page(next, prev):
-            unk = [u for u in unknown_users if not u.has_data()]
-            num = len(unk)
+        def lookup(id):
+            self.proto.dbg("looking up info for user %s" % (id))
+            return api.show_user(id).addCallback(lambda u: cache.got_api_users_info([u]))
 
-            if num == 0:
-                self.proto.notice("I know all friends of %s, now!" % (user))
-                return
+        def error(e, id):
+            self.proto.dbg("user lookup error: %s" % (e))
+            failed.append(id)
 
-            self.proto.dbg("%d users are still unknown" % (num))
+        def done(r):
+            if failed:
+                self.proto.notice("I couldn't fetch info for %d users" % (len(failed)))
+            else:
+                self.proto.notice("I know all those %d users, now!" % (len(ids)))
 
-            if not next or next == '0':
-                self.proto.dbg("yay! that was the last page!")
-                if num > 0:
-                    self.proto.notice("something seems to be wrong: I fetched all pages and I still don't know all of your friends")
-                return
+        sem = defer.DeferredSemaphore(USER_LOOKUP_CONCURRENCY)
+        ds = [sem.run(lookup, id).addErrback(error, id) for id in ids]
+        return defer.DeferredList(ds).addCallback(done)
 
-            if len(reqs) > MAX_FRIEND_PAGE_REQS:
-                self.proto.notice("I already fetched %d pages of detailed friend info. I won't fetch more, sorry.")
-                return
+    def fetch_all_friend_info(self, user, unknown_users):
+        # IDs still unknown, updated as pages arrive:
+        unknown = set([u._twitter_id for u in unknown_users])
 
-            request_cursor(next)
+        def request(delegate, cursor, page_delegate):
+            self.proto.dbg("requesting a page from the friend list: %s" % (str(cursor)))
+            return self.proto.api.list_friends(delegate, user=user, params={'cursor':cursor},
+                                               page_delegate=page_delegate)
+
+        def got_page(page):
+            self.proto.global_twuser_cache.got_api_users_info(page)
+            unknown.difference_update([int(u.id) for u in page])
+            if not unknown:
+                pager.cancel()
+            else:
+                self.proto.dbg("%d users are still unknown" % (len(unknown)))
 
-        def done(*args):
-            self.proto.dbg("list_friends api request finished")
+        def done(r):
+            if not unknown:
+                self.proto.notice("I know all friends of %s, now!" % (user))
+            elif pager.complete:
+                self.proto.notice("something seems to be wrong: I fetched all pages and I still don't know all of your friends")
+            else:
+                self.proto.notice("I already fetched %d pages of detailed friend info. I won't fetch more, sorry." % (pager.pages))
 
         def error(e):
             self.proto.dbg("list_friends error: %s" % (e))
 
-        request_cursor('-1')
+        pager = CursorPaginator(request, got_page, max_pages=MAX_FRIEND_PAGE_REQS, keep_items=False)
+        return pager.start().addCallbacks(done, error)
 
     def fetch_friend_info(self, user, friends):
         dbg("fetch_friend_info: begin:")
-        unknown_users = [u for u in friends if not u.has_data()]
+        unknown = self.proto.global_twuser_cache.unknown_ids([u._twitter_id for u in friends])
+        unknown_users = [u for u in friends if u._twitter_id in unknown]
         dbg("fetch_friend_info: got unknown friends...")
         if len(unknown_users) == 0:
             self.proto.notice("I already know all friends of %s. cool!" % (user))
             return
 
         dbg("%d unknown users..." % (len(unknown_users)))
-        self.proto.notice("There are %d users I don't know about. I will fetch the detailed friend list" % (len(unknown_users)))
-
-        if len(unknown_users) < MAX_USER_INFO_FETCH:
+        # pick whatever takes fewer requests:
+        lookup_reqs = len(unknown_users)
+        page_reqs = (len(friends)+FRIEND_PAGE_SIZE-1)/FRIEND_PAGE_SIZE
+        if lookup_reqs <= MAX_USER_INFO_REQS and lookup_reqs <= page_reqs:
+            self.proto.notice("There are %d users I don't know about. I will fetch their info" % (len(unknown_users)))
             self.fetch_individual_user_info(unknown_users)
         else:
+            self.proto.notice("There are %d users I don't know about. I will fetch the detailed friend list" % (len(unknown_users)))
             self.fetch_all_friend_info(user, unknown_users)
 
 
@@ -452,14 +752,15 @@ class TwitterChannel(IrcChannel):
     def __init__(self, proto, name):
         IrcChannel.__init__(self, proto, name)
 
-        # REPLY_HISTORY_SIZE recent posts
-        self.recent_posts = []
-        # last post by each user ID
-        self.recent_by_user = {}
+        # recent posts, indexed by user ID. The size is set by start(),
+        # as it depends on the user config
+        self.history = ChannelHistory(REPLY_HISTORY_SIZE)
+        # posts already shown on this channel:
+        self.seen_ids = SeenIds(CHANNEL_SEEN_IDS)
 
         self.feeds = self._createFeeds()
         for f in self.feeds:
-            f.addEntryCallback(self.got_entry)
+            f.addBatchCallback(self.got_entries)
             f.addErrback(self.refresh_error)
             f.addRawErrback(self.raw_refresh_error)
 
@@ -477,7 +778,12 @@ class TwitterChannel(IrcChannel):
             return '@'
         return ''
 
-    def printEntry(self, entry):
+    def render_opts(self):
+        """User config affecting how posts are rendered: (rt_inline, multiline)"""
+        return (self.proto.user_cfg_var_b('rt_inline'),
+                self.proto.user_cfg_var_b('multiline'))
+
+    def printEntry(self, entry, resent=False, opts=None):
         e = entry
         is_rt = False
         if entry.retweeted_status:
@@ -486,68 +792,66 @@ class TwitterChannel(IrcChannel):
             dbg("Retweet! RT ID: %r", entry.id)
         u = self.proto.get_twitter_user(e.user.id)
         dbg("entry id: %r", e.id)
-        text = e.text
-        dbg('entry text: %r' % (text))
 
-        if is_rt:
-            rt_inline = self.proto.user_cfg_var_b('rt_inline')
+        if opts is None:
+            opts = self.render_opts()
+        rt_inline,multiline = opts
+        rt_inline = is_rt and rt_inline
+        # the same post may appear on multiple channels. render it only once:
+        key = (entry.id, rt_inline, multiline, resent)
+        lines = self.proto.render_cache.get(key)
+        if lines is None:
+            text = e.text
+            dbg('entry text: %r', text)
             if rt_inline:
                 #TODO: make RT inline format configurable
                 text = '%s \x02[RT by @%s]\x02' % (text, entry.user.screen_name)
+            if resent:
+                text = '%s \x02[re-sent]\x02' % (text)
+            lines = self.proto.render_text(text, multiline)
+            self.proto.render_cache.put(key, lines)
 
-        self.proto.send_text(u, self, text)
+        self.proto.send_lines(u, self, lines, droppable=True)
         if is_rt:
             if not rt_inline:
                 self.bot_msg("(%s retweeted by %s)" % (e.user.screen_name, entry.user.screen_name))
 
-    def _drop_one_old_entry(self):
-        #FIXME: Claudio reported a memory leak, I think it's here.
+    def history_size(self):
+        """Number of recent posts kept for this channel"""
+        v = self.proto.user_var('history_size:%s' % (self.name))
+        try:
+            size = int(v)
+        except (TypeError, ValueError):
+            return REPLY_HISTORY_SIZE
+        return max(1, min(size, MAX_HISTORY_SIZE))
+
+    def set_history_size(self, size):
+        size = max(1, min(size, MAX_HISTORY_SIZE))
+        self.proto.set_user_var('history_size:%s' % (self.name), str(size))
+        self.history.resize(size)
+        return size
 
-        # remove from two lists:
-        # - recent_posts
-        # - last_post_by_user
-        drop = self.recent_posts.pop(0)
-        uid = int(drop.user.id)
+    def shrink_history(self):
+        """Keep only a few posts on the history, to save memory"""
+        if self.history.size > IDLE_HISTORY_SIZE:
+            self.history.resize(IDLE_HISTORY_SIZE)
 
-        # check if it is on the recent_by_user list, too:
-        urec = self.recent_by_user.get(uid, [])
-        if len(urec) > 0:
-            # we always remove entries from recent_by_user, so
-            # it should be the first on the list:
-            if int(urec[0].id) == int(drop.id):
-                urec.pop(0)
+    def restore_history(self):
+        self.history.resize(self.history_size())
 
     def _add_to_history(self, e):
-        self.recent_posts.append(e)
-        if self.recent_posts > REPLY_HISTORY_SIZE:
-            self._drop_one_old_entry()
-        uid = int(e.user.id)
-        self.recent_by_user.setdefault(uid, []).append(e)
+        self.history.add(self.proto.status_store.record(e))
 
     def recent_post(self, nick, substring=None, min_age=None):
-        u = self.proto.global_twuser_cache.lookup_screen_name(nick)
-        if u is None:
-            dbg("nickname %s not found", nick)
-            # nickname not found
-            return None
-        uid = u.twitter_id
-        recent = self.recent_by_user.get(uid, [])
-        if len(recent) < 1:
-            dbg("no posts by uid %s", uid)
+        # users without posts on the history can't have a recent post, so
+        # only the history needs to be checked
+        uid = self.history.user_id(nick)
+        if uid is None:
+            dbg("no posts by %s", nick)
             return None
 
-
         if substring:
-            matches = []
-            i = 1
-            while i <= len(recent):
-                r = recent[-i]
-                text = full_entity_decode(r.text)
-                #TODO: make it more flexible, ignoring punctuation and spaces
-                if substring.lower() in text.lower():
-                    matches.append(r)
-                i += 1
-
+            matches = self.history.find(uid, substring)
             if not matches:
                 return None
 
@@ -557,13 +861,11 @@ class TwitterChannel(IrcChannel):
             # yay, single match:
             r = matches[0]
         else:
-            r = recent[-1]
-            if min_age:
-                #FIXME: add date parsing support to twitty-twister
+            r = self.history.latest_by_user(uid)
+            if min_age and r.created_at:
                 #FIXME: show a list of alternatives to the user
                 #       (how to do that for replies?)
-                t = rfc822.mktime_tz(rfc822.parsedate_tz(r.created_at))
-                if t > time.time() - min_age:
+                if r.created_at > time.time() - min_age:
                     raise Exception("latest post by %s is too recent, I don't know if it's the one you want. Use words from the text to identify it" % (nick))
 
         return r
@@ -572,19 +874,50 @@ class TwitterChannel(IrcChannel):
         r = self.recent_post(nick)
         if r is None:
             return None
-        return int(r.id)
-
-    def cache_entry(self, e):
-        u = e.user
-        self.proto.global_twuser_cache.got_api_user_info(u)
-        self._add_to_history(e)
+        return r.id
 
     def got_entry(self, e):
-        dbg("%s got_entry. id: %s", self.name, e.id)
-        self.cache_entry(e)
-        if e.retweeted_status:
-            self.cache_entry(e.retweeted_status)
-        self.printEntry(e)
+        self.got_entries([e])
+
+    def got_entries(self, entries):
+        """Handle a page of new entries, in chronological order"""
+        dbg("%s got %d entries", self.name, len(entries))
+
+        # posts already shown on this channel (e.g. on a refetch) may be
+        # hidden. Posts already seen on the connection (on any channel)
+        # skip the user info update:
+        show_dups = (self.proto.user_cfg_var('duplicates') == 'show')
+        seen = self.proto.seen_ids
+        shown = []
+        new = []
+        users = []
+        for e in entries:
+            id = int(e.id)
+            if self.seen_ids.add(id):
+                shown.append( (e, False) )
+                new.append(e)
+            elif show_dups:
+                shown.append( (e, True) )
+            if seen.add(id):
+                users.append(e.user)
+                if e.retweeted_status:
+                    users.append(e.retweeted_status.user)
+
+        self.proto.global_twuser_cache.got_api_users_info(users)
+        for e in new:
+            self._add_to_history(e)
+            if e.retweeted_status:
+                self._add_to_history(e.retweeted_status)
+
+        # send all lines of the page in a single write
+        # the config is read once per page, not once per post:
+        opts = self.render_opts()
+        self.proto.hold_output()
+        try:
+            for e,resent in shown:
+                self.printEntry(e, resent, opts)
+        finally:
+            self.proto.release_output()
 
 
     def bot_msg(self, msg):
@@ -623,9 +956,45 @@ class TwitterChannel(IrcChannel):
                 'you can check the rate limit using `!rate`.')
         self.proto.scheduler.wait_rate_limit()
 
+    def home_route(self):
+        """Return a function matching the home timeline entries for this channel
+
+        Should return None unless all posts of the channel also appear on
+        the home timeline.
+        """
+        return None
+
     def start(self):
+        self.history.resize(self.history_size())
+        self._start_feeds()
+
+    def _start_feeds(self):
+        # use the home timeline entries, if possible, instead of polling.
+        # The routed entries were already seen by #twitter, but duplicates
+        # are checked per channel (see got_entries()), so they're shown:
+        home = self.proto.home_feed()
+        match = None
+        if home is not None and home.is_refreshing():
+            match = self.home_route()
         for f in self.feeds:
-            f.start_refreshing()
+            if match is not None:
+                if f.routed_from is not home:
+                    dbg("%s: getting posts from the home timeline", self.name)
+                f.start_routed(home, match)
+            else:
+                if f.routed_from is not None:
+                    dbg("%s: can't use the home timeline anymore", self.name)
+                    f.stop_refreshing()
+                f.start_refreshing()
+
+    def update_route(self):
+        """Check again if the channel can get its posts from the home timeline
+
+        Called when the friend list or the list members change, as the
+        result of home_route() may change too.
+        """
+        if self in self.proto.joined_channels:
+            self._start_feeds()
 
     def stop(self):
         dbg("stopping refresh of %s channel", self.name)
@@ -740,65 +1109,183 @@ class TwitterChannel(IrcChannel):
         args = {}
         msg = self._add_in_reply_to(msg, args)
         dbg("msg: %r. args: %r", msg, args)
-        return self.proto.send_twitter_post(msg, args)
+        return self.proto.send_twitter_post(msg, args).addCallback(self._posted, msg, args)
+
+    def _posted(self, id, msg, args):
+        """Add a post just sent by the user to the history
+
+        The post can be used by !re and !thread right away, and is not shown
+        again on this channel when it comes back on the timeline. Other
+        channels add it to their history when it arrives. The record is
+        built from the text the user typed, so it is kept only on this
+        channel, not on the process-wide status store.
+
+        The since_id of the feeds is not advanced to the new post: posts by
+        other users with lower IDs may not have been fetched yet.
+        """
+        if not id:
+            return id
+        if not isinstance(msg, unicode):
+            msg = try_unicode(msg, IRC_ENCODING)
+        u = self.proto.authenticated_user
+        reply = args.get('in_reply_to_status_id')
+        r = HistoryEntry.from_post(id, u, msg, reply)
+        self.history.add(r)
+        self.seen_ids.add(int(id))
+        return id
 
 
 class FriendlistMixIn:
-    """An extension to TwitterChannel to handle list of friends/members"""
+    """An extension to TwitterChannel to handle list of friends/members
+
+    The member list is kept on proto.member_lists. NAMES is answered from
+    it, and stale lists are fetched again in the background.
+
+    init_members() must be called by the channel constructor.
+    """
+
+    def init_members(self):
+        # paginator of the member list fetch in progress, or that failed:
+        self._members_pager = None
+        # IDs fetched by self._members_pager so far:
+        self._members_fetched = None
+        # Deferreds and page callbacks waiting for the fetch:
+        self._members_waiting = []
+        self._members_page_cbs = []
 
     def _friendList(self, delegate, params={}, page_delegate=None):
         raise NotImplementedError("_friendList not implemented")
 
-    def _handleUserRefs(self, userrefs):
-        users = []
-        for u in userrefs:
-            users.append(self._user_object(u))
-        return users
+    def member_list_key(self):
+        raise NotImplementedError("member_list_key not implemented")
+
+    def _ref_ids(self, userrefs):
+        """Return the user IDs for the refs returned by _friendList()
+
+        Can be overriden when get_friend_list() contains only user IDs
+        """
+        self.proto.global_twuser_cache.got_api_users_info(userrefs)
+        return [int(u.id) for u in userrefs]
 
     def _fetch_user_info(self, users):
         """Can be used to trigger fetching of complete user info, if needed"""
         pass
 
-    def _user_object(self, tu):
-        """Can be overriden when get_friend_list() contains only user IDs"""
-        self.proto.global_twuser_cache.got_api_user_info(tu)
-        return self.proto.get_twitter_user(tu.id, watch=True)
-
     def _get_friend_list(self):
-        d = defer.Deferred()
-        friends = set()
-
-        def got_page(next, prev):
-            self.proto.dbg("%s user list: got page: %s<-%s" % (self.name, next, prev))
-            self.proto.dbg("%s friends so far: %d" % (self.name, len(friends)))
-            if not next or next == "0":
-                self.proto.dbg("%s user list: this was the last page" % (self.name))
-                d.callback(friends)
-                return
-            doit(next)
+        """Fetch the whole member list, returning a Deferred for the IDs
+
+        The IDs of each page are sent to the functions on
+        self._members_page_cbs as they arrive. If the previous fetch failed,
+        it is resumed from the page that failed.
+        """
+        pager = self._members_pager
+        if pager is None:
+            fetched = self._members_fetched = []
+
+            def request(delegate, cursor, page_delegate):
+                return self._friendList(delegate, {'cursor':cursor}, page_delegate=page_delegate)
 
-        def doit(cursor):
-            params = {"cursor": cursor}
-            self._friendList(got_friend, params, page_delegate=got_page).addErrback(d.errback)
+            def got_page(page):
+                ids = self._ref_ids(page)
+                for cb in self._members_page_cbs:
+                    cb(ids)
+                # if a callback fails, the page will be fetched again:
+                fetched.extend(ids)
+                self.proto.dbg("%s user list: got page. friends so far: %d" % (self.name, len(fetched)))
 
-        def got_friend(ref):
-            friends.add(ref)
+            pager = self._members_pager = CursorPaginator(request, got_page, keep_items=False)
+
+        def done(r):
+            self.proto.dbg("%s user list: this was the last page" % (self.name))
+            ids = self._members_fetched
+            self._members_pager = self._members_fetched = None
+            return ids
 
         self.proto.dbg("I will fetch the list of users for %s" % (self.name))
-        doit("-1")
+        return pager.start().addCallback(done)
+
+    def refresh_members(self, page_cb=None):
+        """Fetch the whole member list again, and store it
+
+        Returns a Deferred that fires with the array of member IDs. Only one
+        fetch runs at a time, other callers just wait for it. page_cb(ids),
+        if set, gets the member IDs as they arrive, including the ones
+        fetched before the call.
+        """
+        d = defer.Deferred()
+        waiting = self._members_waiting
+        page_cbs = self._members_page_cbs
+        waiting.append(d)
+        if page_cb is not None:
+            if self._members_fetched:
+                page_cb(self._members_fetched[:])
+            page_cbs.append(page_cb)
+        if len(waiting) > 1:
+            return d
+
+        def got_list(ids):
+            dbg("Finished getting friend IDs for %s", self.name)
+            key = self.member_list_key()
+            old = self.proto.member_lists.get(key)
+            self.proto.member_lists.set(key, ids)
+            new = self.proto.member_lists.get(key)
+            if old is not None and self in self.proto.joined_channels:
+                self._members_changed(old, new)
+            self.proto.update_routes()
+            return new
+
+        def finish(r):
+            # errors on got_list() are delivered to the waiters too, so
+            # the next refresh_members() call starts a new fetch:
+            ds = waiting[:]
+            del waiting[:]
+            del page_cbs[:]
+            for wd in ds:
+                wd.callback(r)
+
+        defer.maybeDeferred(self._get_friend_list).addCallback(got_list).addBoth(finish)
         return d
 
+    def _members_changed(self, old, new):
+        """Send JOIN and PART messages for changes on the member list
+
+        Only the users that joined or left are looked up.
+        """
+        added, removed = diff_ids(old, new)
+        dbg("%s: %d members joined, %d left", self.name, len(added), len(removed))
+        for id in removed:
+            self.notifyPart(self.proto.get_twitter_user(id), None)
+        users = [self.proto.get_twitter_user(id, watch=True) for id in added]
+        for u in users:
+            self.notifyJoin(u)
+        if users:
+            self._fetch_user_info(users)
+
+    def _cached_members(self):
+        """Return the stored member IDs, refreshing them if they are stale"""
+        key = self.member_list_key()
+        ids = self.proto.member_lists.get(key)
+        if ids is not None and self.proto.member_lists.is_stale(key):
+            dbg("member list of %s is stale. refreshing it", self.name)
+            self.refresh_members().addErrback(self._refresh_members_error)
+        return ids
+
+    def _member_users(self, ids):
+        return [self.proto.get_twitter_user(id, watch=True) for id in ids]
+
     def list_members(self):
         #FIXME: return a empty (or almost-empty) list, if the user is not authenticated yet
-        d = defer.Deferred()
-        ids = []
+        return self._list_ids(self._cached_members())
 
-        def doit():
-            self._get_friend_list().addCallbacks(got_list, d.errback)
+    def _list_ids(self, ids):
+        """Return a Deferred for the members, given the stored IDs (or None)"""
+        if ids is None:
+            d = self.refresh_members()
+        else:
+            d = defer.succeed(ids)
 
-        def got_list(userrefs):
-            dbg("Finished getting friend IDs for %s", self.name)
-            users = self._handleUserRefs(userrefs)
+        def got_ids(ids):
+            users = self._member_users(ids)
 
             #FIXME: call _fetch_user_info() on JOIN time, not on list_members() time
             self._fetch_user_info(users)
@@ -806,16 +1293,36 @@ class FriendlistMixIn:
             #FIXME: 1) show the_user only if it really has joined the channel
             #FIXME: 2) check if the_user is on the list used as input, and don't include it,
             #          to avoid duplicate entries on the list
-            users = [self.proto.the_user, self.proto.passerd_bot]+users
-            d.callback(users)
+            return [self.proto.the_user, self.proto.passerd_bot]+users
 
-        doit()
-        return d
+        return d.addCallback(got_ids)
+
+    def stream_members(self, members_cb):
+        """Deliver the members page by page, if the list is not stored yet"""
+        ids = self._cached_members()
+        if ids is not None:
+            return self._list_ids(ids).addCallback(members_cb)
+
+        members_cb([self.proto.the_user, self.proto.passerd_bot])
+        users = []
+        def got_page(ids):
+            page = self._member_users(ids)
+            users.extend(page)
+            members_cb(page)
+
+        def done(ids):
+            # users that are still unknown get their nicks fixed later:
+            self._fetch_user_info(users)
+
+        return self.refresh_members(got_page).addCallback(done)
+
+    def _refresh_members_error(self, e):
+        self.proto.notice("error refreshing the member list of %s: %s" % (self.name, e.value))
 
 class FriendIDsMixIn:
     """MixIn that can be used when the friend list is just a list of IDs"""
-    def _user_object(self, id):
-        return self.proto.get_twitter_user(int(id), watch=True)
+    def _ref_ids(self, ids):
+        return [int(id) for id in ids]
 
 
 #TODO: make mentions appear on #twitter, if configured to do so
@@ -823,6 +1330,10 @@ class FriendIDsMixIn:
 class MainChannel(FriendIDsMixIn, FriendlistMixIn, TwitterChannel):
     """The #twitter channel"""
 
+    def __init__(self, proto, name):
+        TwitterChannel.__init__(self, proto, name)
+        self.init_members()
+
     def topic(self):
         return "Passerd -- Twitter home timeline channel"
 
@@ -834,6 +1345,9 @@ class MainChannel(FriendIDsMixIn, FriendlistMixIn, TwitterChannel):
         params['user_id'] = self.proto.authenticated_user.id
         return self.proto.api.friends_ids(delegate, params=params, page_delegate=page_delegate)
 
+    def member_list_key(self):
+        return 'friends:%s' % (self.proto.authenticated_user.id)
+
     def inviteUser(self, nickname):
         #TODO: send a better error message if user is already being followed
 
@@ -845,6 +1359,8 @@ class MainChannel(FriendIDsMixIn, FriendlistMixIn, TwitterChannel):
         def got_user_info(u):
             user_ids.append(u.id)
             self.proto.global_twuser_cache.got_api_user_info(u)
+            self.proto.member_lists.add(self.member_list_key(), u.id)
+            self.proto.update_routes()
             u = self.proto.get_twitter_user(u.id, watch=True)
             self.notifyJoin(u)
 
@@ -870,6 +1386,8 @@ class MainChannel(FriendIDsMixIn, FriendlistMixIn, TwitterChannel):
         def got_user_info(u):
             user_ids.append(u.id)
             self.proto.global_twuser_cache.got_api_user_info(u)
+            self.proto.member_lists.remove(self.member_list_key(), u.id)
+            self.proto.update_routes()
             u = self.proto.get_twitter_user(u.id)
             self.notifyKick(sender, u)
 
@@ -905,6 +1423,7 @@ class ListChannel(FriendlistMixIn, TwitterChannel):
         self.list_user = list_user
         self.list_name = list_name
         TwitterChannel.__init__(self, proto, self._channelName())
+        self.init_members()
 
     def _createFeeds(self):
         return [ListTimelineFeed(self.proto, self.list_user, self.list_name)]
@@ -919,6 +1438,24 @@ class ListChannel(FriendlistMixIn, TwitterChannel):
         return self.proto.api.list_members(delegate, self.list_user,
                 self.list_name, params=params, page_delegate=page_delegate)
 
+    def member_list_key(self):
+        # private lists may have different members for each account:
+        return 'list:%s:%s/%s' % (self.proto.authenticated_user.id,
+                                  self.list_user.lower(), self.list_name.lower())
+
+    def home_route(self):
+        key = self.member_list_key()
+        members = self.proto.member_lists.get(key)
+        friends = self.proto.friend_ids()
+        if members is None or friends is None:
+            return None
+        # members that are not followed (except the user):
+        missing, unused = diff_ids(friends, members)
+        if [id for id in missing if id != int(self.proto.authenticated_user.id)]:
+            return None
+        # the current list, as members may be added or removed later:
+        return lambda e: self.proto.member_lists.contains(key, e.user.id)
+
 
 class UserChannel(TwitterChannel):
 
@@ -932,15 +1469,23 @@ class UserChannel(TwitterChannel):
     def _createFeeds(self):
         return [UserTimelineFeed(self.proto, self.user)]
 
+    def home_route(self):
+        uid = self.proto.global_twuser_cache.screen_name_id(self.user)
+        friends = self.proto.friend_ids()
+        if uid is None or friends is None:
+            return None
+        i = bisect_left(friends, uid)
+        if (i == len(friends) or friends[i] != uid) and uid != int(self.proto.authenticated_user.id):
+            return None
+        return lambda e: int(e.user.id) == uid
+
     def topic(self):
         return "User timeline -- %s" % (self.user)
 
     def list_members(self):
         #FIXME: only include the_user if the user really joined the channel
 
-        #FIXME: use a self.proto.get_user()-like function that uses lookup_screen_name
-        #       and return it if info is available (see similar FIXME note on proto.get_user())
-        return [self.proto.passerd_bot, self.proto.the_user, UnknownTwitterUser(self.proto, self.user)]
+        return [self.proto.passerd_bot, self.proto.the_user, self.proto.get_twitter_user_by_nick(self.user)]
 
     #TODO: this was enabled in the past, but it just polluted the channel,
     #      as we don't see any messages from the people that follow the user.
@@ -965,11 +1510,12 @@ class ProtoDialog:
 class ConfigInfo:
     """Just a namespace for definitions of configuration options
     """
-    OPTIONS = set('rt_inline multiline careful'.split())
+    OPTIONS = set('rt_inline multiline careful duplicates'.split())
 
     help_rt_inline = 'Show inline "[RT by @user]" info on Retweets'
     help_multiline = 'Show multi-line posts as multiple IRC messages'
     help_careful = "Don't post non-command channel messages to Twitter directly"
+    help_duplicates = 'Posts already shown on this channel: "hide" (default) or "show" as re-sent'
 
     @classmethod
     def all_opts(klass):
@@ -1084,6 +1630,11 @@ class DebugCommands(CommandDialog):
         self.proto = proto
         self.chan = chan
 
+    shorthelp_output = 'Show output queue statistics'
+    def command_output(self, args):
+        for name,value in self.proto.output.stats():
+            self.message('%s: %s' % (name, value))
+
     shorthelp_gc = 'Run Python garbage collection (debugging/testing command)'
     def command_gc(self, args):
         self.message("Object counts: %r" % (gc.get_count(),))
@@ -1091,6 +1642,15 @@ class DebugCommands(CommandDialog):
         self.message("Garbage collection run. %d objects freed" % (r))
         self.message("New object counts: %r" % (gc.get_count(),))
 
+        governor = self.proto.factory.memory
+        self.message("Approximate cache memory usage:")
+        total = 0
+        for name,size in governor.usage():
+            self.message("%-20s %8d KiB" % (name, size/1024))
+            total += size
+        self.message("%-20s %8d KiB (budget: %d KiB)" % ('total', total/1024, governor.budget/1024))
+        self.message("Connections shrunk: %d. Caches shrunk: %d" % (governor.shrunk_connections, governor.shrunk_subsystems))
+
     #TODO: add 'needs_chan' decorator
     shorthelp_recent = "Debug the recent-post matching code"
     def command_recent(self, args):
@@ -1103,7 +1663,7 @@ class DebugCommands(CommandDialog):
             return
 
         if r:
-            self.message("match: id: %r. text: %r" % (r.id, full_entity_decode(r.text)))
+            self.message("match: id: %r. text: %r" % (r.id, r.text))
         else:
             self.message("no match...")
 
@@ -1162,6 +1722,36 @@ class PasserdCommands(CommandHelpMixin, CommandDialog):
             return
         self.message('Rate limit: %s. remaining: %s. reset: %s' % (api.rate_limit_limit, api.rate_limit_remaining, time.ctime(api.rate_limit_reset)))
 
+    shorthelp_queue = 'Show info about the posts being sent'
+    importance_queue = dialogs.CMD_IMP_ADVANCED
+    def command_queue(self, args):
+        q = self.proto.post_queue
+        self.message('Queued posts: %d. sending: %d. sent: %d. failed: %d. retries: %d' % (len(q), q.in_flight(), q.sent, q.failed, q.retried))
+        l = q.latency()
+        if l is not None:
+            self.message('Latency of the last %d posts: avg. %.1fs. max. %.1fs' % (len(q.latencies), l[0], l[1]))
+
+    shorthelp_history = 'Show or change the number of recent posts kept for the channel'
+    importance_history = dialogs.CMD_IMP_ADVANCED
+    def help_history(self, args):
+        self.cmd_syntax('history', '[size]')
+        self.message('Recent posts are used by commands like rt, re and thread (max. %d)' % (MAX_HISTORY_SIZE))
+    def command_history(self, args):
+        if not self.chan:
+            self.message("The 'history' command only works in a channel")
+            return
+
+        h = self.chan.history
+        if args:
+            try:
+                size = int(args)
+            except ValueError:
+                return self.help_history(None)
+            size = self.chan.set_history_size(size)
+            self.message('History size set to %d' % (size))
+        else:
+            self.message('History size: %d. %d posts by %d users' % (h.size, len(h), h.users()))
+
     shorthelp_post = 'Post an update to Twitter'
     def help_post(self, args):
         self.cmd_syntax('post', 'text')
@@ -1278,7 +1868,9 @@ class PasserdCommands(CommandHelpMixin, CommandDialog):
         def error(e):
             self.message("Error while replying: %s" % (e.value))
 
-        self.proto.send_twitter_post(msg, args).addCallback(done).addErrback(error)
+        d = self.proto.send_twitter_post(msg, args)
+        d.addCallback(self.chan._posted, msg, args)
+        d.addCallback(done).addErrback(error)
 
     shorthelp_spam = "Report spam"
     importance_spam = dialogs.CMD_IMP_INTERESTING
@@ -1373,8 +1965,17 @@ class PasserdCommands(CommandHelpMixin, CommandDialog):
         def error(e):
             self.message("Error getting thread: %s" % (e.value))
 
+        # the history keeps only a summary of the post, so the full post
+        # is fetched again
+        roots = []
+        def got_root(*args):
+            if not roots:
+                self.message('Post %s not found' % (r.id))
+                return
+            return get_thread(roots[0], 5).addCallback(got_thread)
+
         self.message('fetching reply thread for message ID %s...' % (r.id))
-        get_thread(r, 5).addCallback(got_thread).addErrback(error)
+        self.proto.api.status_get(str(r.id), roots.append).addCallback(got_root).addErrback(error)
 
 class PasserdBot(IrcUser):
     """The Passerd IRC bot, that is used for Passerd messages on the channel"""
@@ -1460,7 +2061,7 @@ class NewUserDialog(ProtoDialog, Dialog):
 
             # change the user nickname to Twitter screen_name
             nick = str(u.screen_name)
-            self.proto.the_user.force_nick(nick)
+            self.proto.force_nick(nick)
             bm("Welcome to Passerd, %s" % (nick))
 
             self.user_data = self.proto.set_user_token(u, token)
@@ -1556,11 +2157,9 @@ def check_aborted(fn):
     """A decorator to make a function not do anything if the object is "aborted"
     """
     def wrapper(self, *args, **kwargs):
-        dbg("aborted wrapper for %r called", fn)
         if self.aborted():
-            dbg("it's aborted")
+            dbg("%r not called: aborted", fn)
             return
-        dbg("calling %r", fn)
         return fn(self, *args, **kwargs)
     return wrapper
 
@@ -1568,6 +2167,10 @@ class PasserdProtocol(IRC):
     def connectionMade(self):
         self.quit_sent = False
         self._aborted = False
+        self.output = OutputBuffer(self.transport)
+        self.output.set_source_funcs(self.pause_sources, self.resume_sources)
+        self._output_resume_funcs = []
+        self.transport.registerProducer(self.output, True)
 
         IRC.connectionMade(self)
         pinfo("Got connection from %s", self.hostname)
@@ -1588,7 +2191,12 @@ class PasserdProtocol(IRC):
         self.got_nick = False
 
         self.global_twuser_cache = self.factory.global_twuser_cache
+        self.status_store = self.factory.status_store
+        self.member_lists = self.factory.member_lists
         self.twitter_users = TwitterIrcUserCache(self, self.global_twuser_cache)
+        self.render_cache = LRUCache(RENDER_CACHE_SIZE)
+        self.seen_ids = SeenIds()
+        self.post_queue = PostQueue(self._send_post)
 
         self.my_irc_server = IrcServer(self, self.myhost)
 
@@ -1600,7 +2208,10 @@ class PasserdProtocol(IRC):
 
         self.passerd_bot = PasserdBot(self, 'passerd-bot')
 
-        self.users = [self.the_user, self.passerd_bot]
+        # lowercase nick -> local IrcUser object:
+        self.users = {}
+        for u in [self.the_user, self.passerd_bot]:
+            self.users[u.nick.lower()] = u
 
         predef_chans = [MainChannel(self, '#twitter'),  MentionsChannel(self, '#mentions'), UserSetupChannel(self, '#new-user-setup')]
 
@@ -1611,13 +2222,16 @@ class PasserdProtocol(IRC):
 
         #FIXME: make the auto-join optional:
         self.autojoin_channels = ['#twitter', '#mentions']
-        #FIXME: make joined_channels a more efficient list of channels
-        self.joined_channels = []
+        self.joined_channels = set()
 
         self.dm_feed = DirectMessagesFeed(self)
         self.dm_feed.addEntryCallback(self.gotDirectMessage)
         self.dm_feed.addErrback(self.dmError)
 
+        self.last_activity = time.time()
+        self.memory_shrunk = False
+        self.factory.memory.add_connection(self)
+
         dbg("Got new client")
 
     def aborted(self):
@@ -1627,6 +2241,8 @@ class PasserdProtocol(IRC):
         """Makes all @check_aborted functions stop doing anything
         """
         dbg("abort")
+        # lines sent before aborting are still welcome:
+        self.flush_output()
         #FIXME: we need to keep track of current requests/connections and
         # abort all of them, instead of letting them continue running,
         # but just ignoring the replies. The scheduler may be a good place
@@ -1669,13 +2285,15 @@ class PasserdProtocol(IRC):
     def _set_scheduler(self, scheduler):
         self._stop_scheduler()
         self.scheduler = scheduler
+        if self.output_paused():
+            scheduler.pause()
 
     def _userQuit(self, reason):
         dbg("_userQuit: %r", reason)
         self.dm_feed.stop_refreshing()
         dbg("joined channels: %r", self.joined_channels)
-        # list will change under our feet, so copy it:
-        joined = self.joined_channels[:]
+        # set will change under our feet, so copy it:
+        joined = list(self.joined_channels)
         for ch in joined:
             dbg("ch: %r", ch)
             self.leave_channel(ch, reason)
@@ -1690,21 +2308,22 @@ class PasserdProtocol(IRC):
     def gotDirectMessage(self, msg):
         self.global_twuser_cache.got_api_user_info(msg.sender)
         sender = self.get_twitter_user(msg.sender.id, watch=True)
-        self.send_text(sender, self.the_user, msg.text)
+        self.send_text(sender, self.the_user, msg.text, droppable=True)
 
     def dmError(self, e):
         dbg("dmError: %r", e)
         self.notice("Error pulling Direct Messages: %s" % (e))
 
-    def send_text(self, sender, target, text):
+    def render_text(self, text, multiline):
+        """Convert post text to a list of encoded IRC message texts"""
         # security:
         #FIXME: create a escape_post() function
         text = full_entity_decode(text)
-        dbg('entities decoded: %r' % (text))
+        dbg('entities decoded: %r', text)
         text = text.replace('\r', '\n')
 
         lines = []
-        if self.user_cfg_var_b('multiline'):
+        if multiline:
             first = True
             # handle newlines as multiple messages
             for line in text.split('\n'):
@@ -1718,14 +2337,69 @@ class PasserdProtocol(IRC):
         else:
             lines = [text.replace('\n', ' ')]
 
+        return [to_str(l, IRC_ENCODING) for l in lines]
+
+    def send_lines(self, sender, target, lines, droppable=False):
         for l in lines:
-            self.send_privmsg(sender, target, l)
+            self.send_privmsg(sender, target, l, droppable)
+
+    def send_text(self, sender, target, text, droppable=False):
+        lines = self.render_text(text, self.user_cfg_var_b('multiline'))
+        self.send_lines(sender, target, lines, droppable)
 
     def connectionLost(self, reason):
         pinfo("connection to %s lost: %s", self.hostname, reason.value)
         self.userQuit(str(reason))
+        # error messages about the dropped posts are discarded below:
+        self.post_queue.stop()
+        self.output.discard()
+        self.factory.memory.remove_connection(self)
+        self.global_twuser_cache.unwatch_all(self.twitter_users)
         IRC.connectionLost(self, reason)
 
+    def _twitter_channels(self):
+        return [c for c in self.channels.values() if isinstance(c, TwitterChannel)]
+
+    def update_routes(self):
+        """Check again which channels can be fed from the home timeline"""
+        for c in self._twitter_channels():
+            c.update_route()
+
+    def memory_usage(self):
+        """Approximate memory used by the connection caches
+
+        Returns a list of (subsystem, bytes) pairs.
+        """
+        chans = self._twitter_channels()
+        history = sum([c.history.approx_bytes() for c in chans])
+        seen = len(self.seen_ids) + sum([len(c.seen_ids) for c in chans])
+        return [('channel history', history),
+                ('render cache', len(self.render_cache)*memory.RENDER_ENTRY_BYTES),
+                ('seen ids', seen*memory.SEEN_ID_BYTES),
+                ('user prefixes', self.twitter_users.cached_prefixes()*memory.USER_PREFIX_BYTES),
+                ('output queue', self.output.bytes)]
+
+    def shrink_memory(self):
+        """Drop cached data, when the memory budget is exceeded
+
+        The history sizes are restored once the user is active again.
+        """
+        dbg("shrinking caches of %s", self.hostname)
+        self.render_cache.clear()
+        self.seen_ids.trim(IDLE_SEEN_IDS)
+        self.twitter_users.clear_prefixes()
+        for c in self._twitter_channels():
+            c.shrink_history()
+            c.seen_ids.trim(IDLE_SEEN_IDS)
+        self.memory_shrunk = True
+
+    def user_active(self):
+        self.last_activity = time.time()
+        if self.memory_shrunk:
+            self.memory_shrunk = False
+            for c in self._twitter_channels():
+                c.restore_history()
+
     def user_var(self, var):
         """Get any user var (config or internal feed state)"""
         return self.data.get_var(self.user_data, var)
@@ -1776,13 +2450,66 @@ class PasserdProtocol(IRC):
 
     @check_aborted
     def sendMessage(self, *args, **kwargs):
-        dbg("sending message: %r %r" % (args, kwargs))
+        dbg("sending message: %r %r", args, kwargs)
         return IRC.sendMessage(self, *args, **kwargs)
 
     @check_aborted
-    def sendLine(self, *args, **kwargs):
-        dbg("sending line: %r %r" % (args, kwargs))
-        return IRC.sendLine(self, *args, **kwargs)
+    def sendLine(self, line, droppable=False):
+        """Queue line on the output buffer
+
+        The output buffer is written to the transport once per reactor turn.
+        Droppable lines are dropped if the output buffer is full.
+        """
+        dbg("sending line: %r", line)
+        self.output.write_line(to_str(line, self.encoding or IRC_ENCODING), droppable)
+
+    def hold_output(self):
+        """Don't write output lines until release_output() is called
+
+        Calls may be nested. Pending lines are written to the transport
+        using a single write when the outermost hold is released.
+        """
+        self.output.hold()
+
+    def release_output(self):
+        self.output.release()
+
+    def flush_output(self):
+        """Write pending output lines immediately"""
+        self.output.flush()
+
+    def close_connection(self):
+        """Write the pending output, and close the connection
+
+        The output buffer is unregistered as producer first. Otherwise, if it
+        was paused, the transport would resume it when its buffer drains,
+        instead of closing the connection.
+        """
+        self.flush_output()
+        self.transport.unregisterProducer()
+        self.transport.loseConnection()
+
+    def output_paused(self):
+        """Check if the output queue is too long to accept more feed entries"""
+        return self.output.sources_paused
+
+    def when_output_resumed(self, fn):
+        """Call fn() once the output queue accepts feed entries again"""
+        self._output_resume_funcs.append(fn)
+
+    def pause_sources(self):
+        dbg("pausing feeds: output queue is too long")
+        if self.scheduler:
+            self.scheduler.pause()
+
+    def resume_sources(self):
+        dbg("resuming feeds")
+        funcs = self._output_resume_funcs
+        self._output_resume_funcs = []
+        for fn in funcs:
+            fn()
+        if self.scheduler:
+            self.scheduler.resume()
 
     def _handleCommand(self, command, prefix, params):
         """Like IRC.handleCommand, but with no exception handling"""
@@ -1793,8 +2520,12 @@ class PasserdProtocol(IRC):
             return self.irc_unknown(prefix, command, params)
 
     def handleCommand(self, *args, **kwargs):
+        # clients send PINGs even when the user is away
+        if args and args[0] not in ('PING', 'PONG'):
+            self.user_active()
+
         def doit():
-            dbg("got command: %r %r" % (args, kwargs))
+            dbg("got command: %r %r", args, kwargs)
             d = defer.maybeDeferred(self._handleCommand, *args, **kwargs)
             d.addErrback(error)
 
@@ -1816,7 +2547,7 @@ class PasserdProtocol(IRC):
         return self.server_message(cmd, self.the_user.nick, *params, **kwargs)
 
     def send_message(self, sender, *params):
-        return self.sendMessage(prefix=sender.full_id(), *params)
+        return self.sendMessage(prefix=sender.irc_prefix(), *params)
 
     def server_message(self, cmd, *params):
         return self.send_message(self.my_irc_server, cmd, *params)
@@ -1828,13 +2559,13 @@ class PasserdProtocol(IRC):
         if '\r' in msg or '\n' in msg: # just in case
             logger.error("Oops! newlines on channel notice: %r", msg)
             msg = msg.replace('\r',' ').replace('\n', ' ')
-        self.send_message(sender, 'NOTICE', target.target_name(), ':%s' % (to_str(msg, IRC_ENCODING)))
+        self.sendLine(build_line(sender.irc_prefix(), 'NOTICE', target.target_name(), to_str(msg, IRC_ENCODING)))
 
-    def send_privmsg(self, sender, target, msg):
+    def send_privmsg(self, sender, target, msg, droppable=False):
         if '\r' in msg or '\n' in msg: # just in case
             logger.error("Oops! newlines on channel privmsg: %r", msg)
             msg = msg.replace('\r',' ').replace('\n', ' ')
-        self.send_message(sender, 'PRIVMSG', target.target_name(), ':%s' % (to_str(msg, IRC_ENCODING)))
+        self.sendLine(build_line(sender.irc_prefix(), 'PRIVMSG', target.target_name(), to_str(msg, IRC_ENCODING)), droppable)
 
     def notice(self, msg):
         self.server_notice(self.the_user, msg)
@@ -1842,7 +2573,7 @@ class PasserdProtocol(IRC):
     def join_channel(self, chan):
         if not (chan in self.joined_channels):
             chan.userJoined(self.the_user)
-            self.joined_channels.append(chan)
+            self.joined_channels.add(chan)
         dbg("joined channels now: %r", self.joined_channels)
 
     def leave_channel(self, chan, reason):
@@ -1850,7 +2581,7 @@ class PasserdProtocol(IRC):
         if chan in self.joined_channels:
             dbg("chan %r is joined", chan)
             chan.userLeft(self.the_user, reason)
-            self.joined_channels.remove(chan)
+            self.joined_channels.discard(chan)
             dbg("joined channels now: %r", self.joined_channels)
 
     def leave_cname(self, cname, reason):
@@ -1913,7 +2644,7 @@ class PasserdProtocol(IRC):
 
         self.userQuit(reason)
         self.sendMessage('ERROR', ':Quit command received')
-        self.transport.loseConnection()
+        self.close_connection()
 
     def irc_WHO(self, p, args):
         for m in self.who_matches(args[0]):
@@ -2157,7 +2888,7 @@ class PasserdProtocol(IRC):
             else:
                 self.send_reply(irc.ERR_PASSWDMISMATCH, ":Error while authenticating - %s" % (e.value))
                 # on the other cases, drop the connection
-                self.transport.loseConnection()
+                self.close_connection()
 
 
         doit()
@@ -2175,9 +2906,12 @@ class PasserdProtocol(IRC):
         dbg("NICK %r" % (params))
         nick = params[0]
         if self.got_nick:
-            self.the_user.force_nick(nick)
+            self.force_nick(nick)
         else:
+            old_nick = self.the_user.nick
             self.the_user.nick = nick
+            self.the_user.prefix_changed()
+            self.user_nick_changed(self.the_user, old_nick)
             self.got_nick = True
             self.try_early_auth()
 
@@ -2190,6 +2924,7 @@ class PasserdProtocol(IRC):
         username,_,_,real_name = params[0:4]
         self.the_user.username = username
         self.the_user.real_name = real_name
+        self.the_user.prefix_changed()
         self.got_user = True
 
         #TODO: accept connections without password, and allow a nickserv-style method of authentication
@@ -2208,23 +2943,43 @@ class PasserdProtocol(IRC):
         if len(msg) > LENGTH_LIMIT:
             return defer.fail(MessageTooLong(msg, len(msg)))
 
+        return self.post_queue.post(msg, args)
+
+    def _send_post(self, msg, args):
         return self.api.update(msg, params=args)
 
 
+    def force_nick(self, nick):
+        """Change the nick of the user, keeping the nick index up to date"""
+        old_nick = self.the_user.nick
+        self.the_user.force_nick(nick)
+        self.user_nick_changed(self.the_user, old_nick)
+
+    def user_nick_changed(self, u, old_nick):
+        """Update the nick index after the nick of a local user changed"""
+        old_key = old_nick.lower()
+        if self.users.get(old_key) is u:
+            del self.users[old_key]
+        self.users[u.nick.lower()] = u
+
+    def get_twitter_user_by_nick(self, nick):
+        id = self.global_twuser_cache.screen_name_id(nick)
+        if id is not None:
+            return self.twitter_users.get_user(id)
+
+        # if not found, consider it's a potential Twitter user we don't know yet
+        return UnknownTwitterUser(self, nick)
+
     def get_user(self, nick):
-        #FIXME; index by nickname
-        for u in self.users:
-            if nick.lower() == u.nick.lower():
-                return u
+        u = self.users.get(nick.lower())
+        if u is not None:
+            return u
 
         # No Twitter user is available, if not authenticated yet
         if not self.is_authenticated():
             return None
 
-        #TODO: use cache lookup_screen_name() method before returning UnknownTwitterUser()
-
-        # if not found, consider it's a potential Twitter user we don't know yet
-        return UnknownTwitterUser(self, nick)
+        return self.get_twitter_user_by_nick(nick)
 
     def create_channel(self, name):
         #TODO make it generic to allow more types of channels
@@ -2256,6 +3011,20 @@ class PasserdProtocol(IRC):
     def get_channel(self, name):
         return self.channels.get(name)
 
+    def home_feed(self):
+        """The home timeline feed, used by channels that can be fed from it"""
+        chan = self.get_channel('#twitter')
+        if chan is None:
+            return None
+        return chan.feeds[0]
+
+    def friend_ids(self):
+        """Sorted array of the IDs followed by the user, or None if unknown"""
+        chan = self.get_channel('#twitter')
+        if chan is None:
+            return None
+        return self.member_lists.get(chan.member_list_key())
+
     def get_target(self, name):
         if name.startswith('#'):
             return self.get_channel(name)
@@ -2314,6 +3083,26 @@ class PasserdFactory(Factory):
         self.data = DataStore(url)
         self.data.create_tables()
         self.global_twuser_cache = TwitterUserCache(self)
+        self.status_store = StatusStore()
+        self.member_lists = MemberLists(self.data)
+        self.memory = MemoryGovernor(opts.memory_budget)
+        self.memory.register('status records',
+                lambda: len(self.status_store)*memory.STATUS_RECORD_BYTES)
+        self.memory.register('screen names',
+                lambda: self.global_twuser_cache.cached_names()*memory.SCREEN_NAME_BYTES,
+                self.global_twuser_cache.clear_names)
+        self.memory.register('known user ids',
+                lambda: self.global_twuser_cache.cached_known_ids()*memory.SEEN_ID_BYTES,
+                self.global_twuser_cache.clear_known_ids)
+        self.memory.register('member lists',
+                lambda: self.member_lists.cached_ids()*memory.ARRAY_ID_BYTES,
+                self.member_lists.clear)
+
+    def startFactory(self):
+        self.memory.start()
+
+    def stopFactory(self):
+        self.memory.stop()
 
 class PasserdGlobalOptions:
     def __init__(self):
@@ -2336,6 +3125,8 @@ class PasserdGlobalOptions:
 
         self.api_timeout = 60
 
+        self.memory_budget = memory.MEMORY_BUDGET
+
         self.daemon_mode = False
         self.pidfile = None
 
@@ -2354,6 +3145,9 @@ def parse_cmdline(args, opts):
     def open_logfile(option, optstr, value, parser):
         opts.logstream = open(value, 'a')
 
+    def set_memory_budget(option, optstr, value, parser):
+        opts.memory_budget = value*1024*1024
+
     parser = optparse.OptionParser("%prog [options] <database path>")
     parser.add_option("-l", "--listen", type="string",
             action="callback", callback=parse_hostport,
@@ -2372,6 +3166,10 @@ def parse_cmdline(args, opts):
     parser.add_option("-p", "--pid-file",
             metavar="FILENAME", type="string",
             dest="pidfile")
+    parser.add_option("--memory-budget",
+            metavar="MB", type="int",
+            action="callback", callback=set_memory_budget,
+            help="approximate memory limit for caches, in MB")
     _, args = parser.parse_args(args, opts)
     if not args:
         parser.error("the database path is needed!")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# Passerd - An IRC server as a gateway to Twitter
+#
+# Cached member lists of channels
+#
+# Author: Eduardo Habkost <ehabkost@raisama.net>
+#
+# Copyright (c) 2009 Eduardo Pereira Habkost <ehabkost@raisama.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+import time
+from array import array
+from bisect import bisect_left
+
+logger = logging.getLogger('passerd.members')
+dbg = logger.debug
+
+# member lists older than this (in seconds) are refreshed in the background:
+MEMBER_LIST_TTL = 60*60
+
+# array type for Twitter IDs. There's no 'q' type code on Python 2, but
+# 'l' is 64-bit on most platforms. Otherwise, doubles keep IDs exact up
+# to 2**53:
+if array('l').itemsize >= 8:
+    ID_TYPECODE = 'l'
+else:
+    ID_TYPECODE = 'd'
+
+
+def id_array(ids):
+    """Return a sorted array of the unique IDs in `ids`"""
+    return array(ID_TYPECODE, sorted(set([int(id) for id in ids])))
+
+def _skip_equal(old, i, new, j):
+    """Return the end (i, j) of the run of equal IDs at old[i:], new[j:]
+
+    Gallops over the run comparing slices, so the IDs are compared in C.
+    """
+    lo = len(old)
+    ln = len(new)
+    step = 1
+    # double the step while the slices are equal...
+    while i+step <= lo and j+step <= ln and old[i:i+step] == new[j:j+step]:
+        i += step
+        j += step
+        step *= 2
+    # ...and then find the end of the run, halving it:
+    while step > 1:
+        step /= 2
+        if i+step <= lo and j+step <= ln and old[i:i+step] == new[j:j+step]:
+            i += step
+            j += step
+    return i, j
+
+def diff_ids(old, new):
+    """Compare two sorted ID arrays, returning (added, removed) ID arrays
+
+    Only the IDs around the changes are compared one by one. Runs of equal
+    IDs (usually most of the list) are skipped by _skip_equal(), even if
+    they are at different positions on the two arrays.
+    """
+    added = array(ID_TYPECODE)
+    removed = array(ID_TYPECODE)
+    if old == new:
+        return added, removed
+
+    i = j = 0
+    lo = len(old)
+    ln = len(new)
+    while i < lo and j < ln:
+        a = old[i]
+        b = new[j]
+        if a == b:
+            i, j = _skip_equal(old, i, new, j)
+        elif a < b:
+            removed.append(a)
+            i += 1
+        else:
+            added.append(b)
+            j += 1
+    removed.extend(old[i:])
+    added.extend(new[j:])
+    return added, removed
+
+
+class MemberLists:
+    """Member lists (friend IDs, list members) of channels, for each account
+
+    The lists are stored on the database with the time of the last full
+    fetch, so NAMES can be answered right away, even after a restart. Lists
+    older than `ttl` seconds are stale, and should be fetched again.
+
+    Lists are identified by a string key, chosen by the channel. Each list
+    is a sorted array of IDs (see id_array()), that is much more compact
+    than a set for accounts following thousands of users.
+    """
+    def __init__(self, data, ttl=MEMBER_LIST_TTL, clock=time.time):
+        self.data = data
+        self.ttl = ttl
+        self.clock = clock
+        # key -> [sorted ID array, time of last fetch]
+        self._lists = {}
+
+    def _load(self, key):
+        l = self._lists.get(key)
+        if l is None:
+            r = self.data.get_member_list(key)
+            if r is None:
+                return None
+            ids, updated = r
+            l = self._lists[key] = [id_array(ids), updated]
+        return l
+
+    def _store(self, key, l):
+        self.data.set_member_list(key, l[0], l[1])
+
+    def get(self, key):
+        """Return the sorted ID array of a list, or None if unknown
+
+        The array must not be changed by the caller.
+        """
+        l = self._load(key)
+        if l is None:
+            return None
+        return l[0]
+
+    def contains(self, key, id):
+        """Whether `id` is on a list. False if the list is unknown"""
+        ids = self.get(key)
+        if ids is None:
+            return False
+        id = int(id)
+        i = bisect_left(ids, id)
+        return i < len(ids) and ids[i] == id
+
+    def is_stale(self, key):
+        l = self._load(key)
+        return l is None or self.clock()-l[1] >= self.ttl
+
+    def set(self, key, ids):
+        """Store a freshly fetched member list"""
+        l = self._lists[key] = [id_array(ids), self.clock()]
+        dbg("member list %s: %d members", key, len(l[0]))
+        self._store(key, l)
+
+    def add(self, key, id):
+        """Add a member to a list, if the list is known"""
+        l = self._load(key)
+        if l is None:
+            return
+        ids = l[0]
+        id = int(id)
+        i = bisect_left(ids, id)
+        if i == len(ids) or ids[i] != id:
+            # a new array, as the old one may be in use by get() callers:
+            l[0] = ids[:i]
+            l[0].append(id)
+            l[0].extend(ids[i:])
+            self._store(key, l)
+
+    def remove(self, key, id):
+        """Remove a member from a list, if the list is known"""
+        l = self._load(key)
+        if l is None:
+            return
+        ids = l[0]
+        id = int(id)
+        i = bisect_left(ids, id)
+        if i < len(ids) and ids[i] == id:
+            l[0] = ids[:i]+ids[i+1:]
+            self._store(key, l)
+
+    def cached_ids(self):
+        """Number of member IDs loaded in memory"""
+        return sum([len(l[0]) for l in self._lists.values()])
+
+    def clear(self):
+        """Drop the in-memory copies. They are loaded again when needed"""
+        self._lists.clear()
+
+
+__all__ = ['MemberLists', 'id_array', 'diff_ids']
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+#
+# Passerd - An IRC server as a gateway to Twitter
+#
+# Process-wide memory budget for caches
+#
+# Author: Eduardo Habkost <ehabkost@raisama.net>
+#
+# Copyright (c) 2009 Eduardo Pereira Habkost <ehabkost@raisama.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+
+from twisted.internet import reactor
+
+logger = logging.getLogger('passerd.memory')
+dbg = logger.debug
+
+# default budget for all caches together:
+MEMORY_BUDGET = 256*1024*1024
+
+# interval between budget checks, in seconds:
+CHECK_INTERVAL = 60
+
+# approximate number of bytes used by each cached item. The numbers are
+# rough measurements on CPython 2.x/amd64, and only need to be good enough
+# to compare subsystems and connections:
+STATUS_RECORD_BYTES = 1000
+SEEN_ID_BYTES = 32
+# IDs stored on array objects (e.g. member lists) use a single machine word:
+ARRAY_ID_BYTES = 8
+RENDER_ENTRY_BYTES = 400
+USER_PREFIX_BYTES = 150
+SCREEN_NAME_BYTES = 150
+
+class MemoryGovernor:
+    """Keeps the approximate size of all caches under a global budget
+
+    Process-wide caches are registered using register(). Connections are
+    added using add_connection(), and must have:
+
+    - a `last_activity` attribute (a timestamp);
+    - a memory_usage() method, returning a list of (subsystem, bytes) pairs;
+    - a shrink_memory() method, that drops as much cached data as possible.
+
+    When the total goes over the budget, the least recently active
+    connections are shrunk first. The process-wide caches are shrunk only
+    if that is not enough.
+    """
+    def __init__(self, budget=MEMORY_BUDGET, clock=reactor):
+        self.budget = budget
+        self.clock = clock
+        self.subsystems = []
+        self.connections = []
+        self.interval = None
+        self.check_call = None
+
+        # statistics:
+        self.checks = 0
+        self.shrunk_connections = 0
+        self.shrunk_subsystems = 0
+
+    def register(self, name, size_func, shrink_func=None):
+        """Register a process-wide cache
+
+        size_func() must return the approximate size in bytes.
+        shrink_func(), if set, is called to drop cached data.
+        """
+        self.subsystems.append( (name, size_func, shrink_func) )
+
+    def add_connection(self, conn):
+        self.connections.append(conn)
+
+    def remove_connection(self, conn):
+        if conn in self.connections:
+            self.connections.remove(conn)
+
+    def _connection_size(self, conn):
+        return sum([size for name,size in conn.memory_usage()])
+
+    def usage(self):
+        """Return a list of (subsystem, bytes) pairs, sorted by name"""
+        usage = {}
+        for name,size_func,shrink_func in self.subsystems:
+            usage[name] = usage.get(name, 0)+size_func()
+        for c in self.connections:
+            for name,size in c.memory_usage():
+                usage[name] = usage.get(name, 0)+size
+        return sorted(usage.items())
+
+    def total(self):
+        return sum([size for name,size in self.usage()])
+
+    def enforce(self):
+        """Shrink caches until the total is under the budget
+
+        Returns the total size after shrinking.
+        """
+        self.checks += 1
+        total = self.total()
+        if total <= self.budget:
+            return total
+
+        dbg("cache memory over budget: %d > %d bytes", total, self.budget)
+        conns = sorted(self.connections, key=lambda c: c.last_activity)
+        for c in conns:
+            before = self._connection_size(c)
+            c.shrink_memory()
+            self.shrunk_connections += 1
+            total -= before-self._connection_size(c)
+            if total <= self.budget:
+                return total
+
+        for name,size_func,shrink_func in self.subsystems:
+            if shrink_func is None:
+                continue
+            before = size_func()
+            shrink_func()
+            self.shrunk_subsystems += 1
+            total -= before-size_func()
+            if total <= self.budget:
+                break
+        return total
+
+    def _check(self):
+        self.check_call = None
+        try:
+            self.enforce()
+        finally:
+            self._schedule()
+
+    def _schedule(self):
+        if self.check_call is None and self.interval is not None:
+            self.check_call = self.clock.callLater(self.interval, self._check)
+
+    def start(self, interval=CHECK_INTERVAL):
+        """Check the budget every `interval` seconds"""
+        self.interval = interval
+        self._schedule()
+
+    def stop(self):
+        self.interval = None
+        if self.check_call is not None:
+            if self.check_call.active():
+                self.check_call.cancel()
+            self.check_call = None
+
+
+__all__ = ['MemoryGovernor']
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+#
+# Passerd - An IRC server as a gateway to Twitter
+#
+# Output buffering code
+#
+# Author: Eduardo Habkost <ehabkost@raisama.net>
+#
+# Copyright (c) 2009 Eduardo Pereira Habkost <ehabkost@raisama.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+from collections import deque
+
+from zope.interface import implements
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+
+logger = logging.getLogger('passerd.output')
+dbg = logger.debug
+
+LINE_DELIMITER = '\r\n'
+
+# limits for the per-connection output queue. Droppable lines beyond those
+# limits are dropped:
+MAX_OUTPUT_LINES = 2000
+MAX_OUTPUT_BYTES = 512*1024
+
+# feeds are paused when the queue reaches 1/HIGH_WATER_DIV of the limits, and
+# resumed once it goes below 1/LOW_WATER_DIV of the limits:
+HIGH_WATER_DIV = 2
+LOW_WATER_DIV = 4
+
+# maximum number of lines written to the transport on each reactor turn:
+DRAIN_LINES = 200
+
+class OutputBuffer:
+    """Per-connection output queue
+
+    Collects output lines and writes them using a single writeSequence()
+    call per reactor turn (at most DRAIN_LINES lines per turn), or when the
+    outermost hold() is released.
+
+    This is registered as a push producer for the transport, so nothing is
+    written while the transport buffer is full. If the queue grows beyond
+    the high-water mark, the pause function is called, so the data sources
+    can stop generating output.
+
+    Lines written with droppable=True (feed and timeline output) are dropped
+    when the queue is over its limits. Other lines (replies and control
+    messages) are always queued, as the client may depend on them.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, transport, clock=reactor, max_lines=MAX_OUTPUT_LINES,
+                 max_bytes=MAX_OUTPUT_BYTES):
+        self.transport = transport
+        self.clock = clock
+        self.lines = deque()
+        self.bytes = 0
+        self.holds = 0
+        self.flush_call = None
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+
+        # producer state:
+        self.producer_paused = False
+        self.sources_paused = False
+        self.pause_func = None
+        self.resume_func = None
+
+        # statistics:
+        self.lines_written = 0
+        self.writes = 0
+        self.dropped_lines = 0
+        self.dropped_bytes = 0
+        self.producer_pauses = 0
+        self.source_pauses = 0
+
+    def set_source_funcs(self, pause_func, resume_func):
+        """Set functions to pause/resume the data sources when the queue is too long"""
+        self.pause_func = pause_func
+        self.resume_func = resume_func
+
+    def _over_high_water(self):
+        return (len(self.lines) >= self.max_lines/HIGH_WATER_DIV or
+                self.bytes >= self.max_bytes/HIGH_WATER_DIV)
+
+    def _under_low_water(self):
+        return (len(self.lines) <= self.max_lines/LOW_WATER_DIV and
+                self.bytes <= self.max_bytes/LOW_WATER_DIV)
+
+    def _check_sources(self):
+        if not self.sources_paused:
+            if self._over_high_water():
+                dbg("output queue is too long. pausing sources")
+                self.sources_paused = True
+                self.source_pauses += 1
+                if self.pause_func:
+                    self.pause_func()
+        elif self._under_low_water():
+            dbg("output queue is short again. resuming sources")
+            self.sources_paused = False
+            if self.resume_func:
+                self.resume_func()
+
+    def write_line(self, line, droppable=False):
+        size = len(line)+len(LINE_DELIMITER)
+        if droppable and (len(self.lines) >= self.max_lines or
+                          self.bytes+size > self.max_bytes):
+            self.dropped_lines += 1
+            self.dropped_bytes += size
+            return
+
+        self.lines.append(line)
+        self.bytes += size
+        if not self.sources_paused:
+            self._check_sources()
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_call is None and not self.holds and not self.producer_paused:
+            self.flush_call = self.clock.callLater(0, self._scheduled_flush)
+
+    def hold(self):
+        """Don't write anything until release() is called
+
+        Calls may be nested.
+        """
+        self.holds += 1
+
+    def release(self):
+        self.holds -= 1
+        if self.holds == 0 and not self.producer_paused:
+            self._write(DRAIN_LINES)
+            if self.lines:
+                self._schedule_flush()
+
+    def _scheduled_flush(self):
+        self.flush_call = None
+        if self.holds or self.producer_paused:
+            return
+        self._write(DRAIN_LINES)
+        if self.lines:
+            self._schedule_flush()
+
+    def _cancel_flush(self):
+        if self.flush_call is not None:
+            if self.flush_call.active():
+                self.flush_call.cancel()
+            self.flush_call = None
+
+    def _write(self, max_lines=None):
+        lines = self.lines
+        if not lines:
+            return
+        n = len(lines)
+        if max_lines is not None and n > max_lines:
+            n = max_lines
+        seq = []
+        size = 0
+        popleft = lines.popleft
+        for i in xrange(n):
+            l = popleft()
+            size += len(l)
+            seq.append(l)
+            seq.append(LINE_DELIMITER)
+        self.bytes -= size+n*len(LINE_DELIMITER)
+        self.lines_written += n
+        self.writes += 1
+        self.transport.writeSequence(seq)
+        if self.sources_paused:
+            self._check_sources()
+
+    def flush(self):
+        """Write all pending lines to the transport immediately
+
+        Ignores holds, pacing and transport pauses.
+        """
+        self._cancel_flush()
+        self._write()
+
+    def discard(self):
+        """Drop all pending lines"""
+        self._cancel_flush()
+        if self.lines:
+            dbg("discarding %d output lines", len(self.lines))
+        self.lines.clear()
+        self.bytes = 0
+
+    def pending_lines(self):
+        return len(self.lines)
+
+    ## IPushProducer methods:
+
+    def pauseProducing(self):
+        dbg("transport buffer full. pausing output")
+        self.producer_paused = True
+        self.producer_pauses += 1
+        self._cancel_flush()
+
+    def resumeProducing(self):
+        dbg("resuming output")
+        self.producer_paused = False
+        self._schedule_flush()
+
+    def stopProducing(self):
+        self.discard()
+
+    def stats(self):
+        """Return a list of (name, value) pairs with queue statistics"""
+        return [('pending lines', len(self.lines)),
+                ('pending bytes', self.bytes),
+                ('lines written', self.lines_written),
+                ('transport writes', self.writes),
+                ('dropped lines', self.dropped_lines),
+                ('dropped bytes', self.dropped_bytes),
+                ('transport pauses', self.producer_pauses),
+                ('feed pauses', self.source_pauses)]
+
+
+__all__ = ['OutputBuffer']
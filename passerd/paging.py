@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Passerd - An IRC server as a gateway to Twitter
+#
+# Paging of cursor-based Twitter API calls
+#
+# Author: Eduardo Habkost <ehabkost@raisama.net>
+#
+# Copyright (c) 2009 Eduardo Pereira Habkost <ehabkost@raisama.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import logging
+
+from twisted.internet import reactor, defer
+from twisted.python import failure
+
+logger = logging.getLogger('passerd.paging')
+dbg = logger.debug
+
+# number of times a failed page request is retried:
+PAGE_RETRIES = 2
+# seconds between retries of a failed page request:
+RETRY_DELAY = 5
+
+FIRST_CURSOR = '-1'
+
+
+class CursorPaginator:
+    """Fetches the pages of a cursor-based API call
+
+    `request(delegate, cursor, page_delegate)` must start the request of a
+    single page, calling delegate() for each item and page_delegate(next,
+    prev) with the cursors, and return a Deferred.
+
+    The items of each page are delivered to page_cb(items) only when the
+    whole page was fetched, so a failed request doesn't deliver the same
+    items twice. Unless `keep_items` is False, the items fetched so far are
+    also kept on self.items.
+
+    Failed page requests are retried up to `retries` times. After that,
+    the Deferred returned by start() fails, but the cursor of the page is
+    kept, and start() can be called again to resume from that page. If
+    page_cb() raises an exception, the Deferred fails the same way, and the
+    page is fetched again on resume.
+
+    The Deferred returned by start() fires with the list of items when the
+    last page arrives, when `max_pages` pages were fetched, or when cancel()
+    is called. self.complete tells if the last page was reached.
+    """
+    def __init__(self, request, page_cb=None, max_pages=None, keep_items=True,
+                 retries=PAGE_RETRIES, retry_delay=RETRY_DELAY, clock=reactor):
+        self.request = request
+        self.page_cb = page_cb
+        self.keep_items = keep_items
+        self.max_pages = max_pages
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.clock = clock
+
+        # cursor of the next page to be fetched:
+        self.cursor = FIRST_CURSOR
+        self.items = []
+        self.pages = 0
+        self.complete = False
+        self.cancelled = False
+        self.running = False
+
+        self._d = None
+        self._retry_call = None
+        self._failures = 0
+        # incremented on every start(), so replies to requests made before
+        # a cancel() are ignored:
+        self._run_id = 0
+
+    def start(self):
+        """Start fetching pages, or resume after a failure
+
+        Returns a Deferred that fires with the list of items.
+        """
+        assert not self.running
+        self.running = True
+        self.cancelled = False
+        self._failures = 0
+        self._run_id += 1
+        d = self._d = defer.Deferred()
+        self._fetch()
+        return d
+
+    def _fetch(self):
+        self._retry_call = None
+        cursor = self.cursor
+        page = []
+        next = []
+        def page_delegate(n, prev):
+            next.append(n)
+        dbg("requesting page %r", cursor)
+        defer.maybeDeferred(self.request, page.append, cursor, page_delegate).addCallbacks(
+                self._got_page, self._page_error,
+                callbackArgs=(self._run_id, page, next),
+                errbackArgs=(self._run_id,))
+
+    def _got_page(self, r, run_id, page, next):
+        if run_id != self._run_id or not self.running:
+            return
+        self._failures = 0
+        # kept in case page_cb fails:
+        state = (self.cursor, self.pages, self.complete, len(self.items))
+        self.pages += 1
+        if self.keep_items:
+            self.items.extend(page)
+        if next and next[0] and next[0] != '0':
+            self.cursor = next[0]
+        else:
+            self.cursor = None
+            self.complete = True
+
+        if self.page_cb is not None:
+            try:
+                self.page_cb(page)
+            except:
+                logger.exception("error handling page %r", state[0])
+                self.cursor, self.pages, self.complete, n = state
+                del self.items[n:]
+                if self.running:
+                    self._fail(failure.Failure())
+                return
+        # page_cb may have cancelled us:
+        if self.cancelled:
+            return
+
+        if self.complete or (self.max_pages is not None and self.pages >= self.max_pages):
+            self._finish()
+        else:
+            self._fetch()
+
+    def _page_error(self, e, run_id):
+        if run_id != self._run_id or not self.running:
+            return
+        self._failures += 1
+        if self._failures > self.retries:
+            logger.info("page request failed, giving up: %s", e.value)
+            self._fail(e)
+            return
+        dbg("page request failed (%d), retrying: %s", self._failures, e.value)
+        self._retry_call = self.clock.callLater(self.retry_delay, self._fetch)
+
+    def _fail(self, e):
+        self.running = False
+        d, self._d = self._d, None
+        d.errback(e)
+
+    def _finish(self):
+        self.running = False
+        d, self._d = self._d, None
+        d.callback(self.items)
+
+    def cancel(self):
+        """Stop fetching pages. The items fetched so far are returned"""
+        if not self.running:
+            return
+        self.cancelled = True
+        if self._retry_call is not None:
+            self._retry_call.cancel()
+            self._retry_call = None
+        self._finish()
+
+
+__all__ = ['CursorPaginator']
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#
+# Passerd - An IRC server as a gateway to Twitter
+#
+# Queue of outgoing posts
+#
+# Author: Eduardo Habkost <ehabkost@raisama.net>
+#
+# Copyright (c) 2009 Eduardo Pereira Habkost <ehabkost@raisama.net>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import logging
+from collections import deque
+
+from twisted.internet import reactor, defer, error
+from twisted.python import failure
+import twisted.web.error
+
+logger = logging.getLogger('passerd.postqueue')
+dbg = logger.debug
+
+# number of post requests running at the same time. Posts are started in
+# order, but two requests running at the same time may be handled by
+# Twitter in any order, so keep this at 1 unless ordering doesn't matter:
+POST_CONCURRENCY = 1
+# number of times a post is retried after a failure where it surely didn't
+# reach Twitter (see is_transient()):
+POST_RETRIES = 3
+# seconds before the first retry. The delay doubles on every retry:
+RETRY_DELAY = 2
+MAX_RETRY_DELAY = 60
+# number of recent posts used for the latency info:
+LATENCY_SAMPLES = 20
+
+# errors that happen before the request is sent:
+TRANSIENT_ERRORS = (error.ConnectError, error.DNSLookupError)
+# timeouts are not retried, as they may happen after the request was sent
+# (error.TimeoutError is a ConnectError subclass):
+TIMEOUT_ERRORS = (error.TimeoutError, defer.TimeoutError)
+
+def is_transient(e):
+    """Check if a failed post is worth retrying
+
+    Posting is not idempotent: after a lost connection, a timeout or most
+    server errors, the post may have been accepted already, and a retry
+    would post it twice. Only errors where the request surely never reached
+    Twitter are retried: connection failures (except timeouts), and 503
+    (service unavailable).
+    """
+    if e.check(twisted.web.error.Error):
+        return str(e.value.status) == '503'
+    if e.check(*TIMEOUT_ERRORS):
+        return False
+    return e.check(*TRANSIENT_ERRORS) is not None
+
+
+class QueuedPost:
+    def __init__(self, args, queued):
+        self.args = args
+        self.queued = queued
+        self.d = defer.Deferred()
+        self.tries = 0
+        self.done = False
+        self.result = None
+        self.ok = False
+
+
+class PostQueue:
+    """Sends posts in order, with bounded concurrency
+
+    send(*args) must start the request of a single post and return a
+    Deferred. The Deferreds returned by post() fire in the same order the
+    posts were queued.
+
+    Posts that failed with a transient error (see is_transient()) are
+    retried up to `retries` times, with exponential backoff. No new post is
+    started while a post waits for a retry, so later posts never overtake
+    it.
+    """
+    def __init__(self, send, concurrency=POST_CONCURRENCY, retries=POST_RETRIES,
+                 retry_delay=RETRY_DELAY, max_retry_delay=MAX_RETRY_DELAY,
+                 clock=reactor):
+        self.send = send
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.clock = clock
+
+        # posts not started yet:
+        self._pending = deque()
+        # started posts, in order, until their results are delivered:
+        self._active = deque()
+        self._running = 0
+        self._retry_calls = {}
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def post(self, *args):
+        """Queue a post. Returns a Deferred that fires with the send() result"""
+        p = QueuedPost(args, self.clock.seconds())
+        self._pending.append(p)
+        self._pump()
+        return p.d
+
+    def __len__(self):
+        return len(self._pending)+len(self._active)
+
+    def in_flight(self):
+        return self._running
+
+    def _pump(self):
+        while self._pending and self._running < self.concurrency \
+                and not self._retry_calls:
+            p = self._pending.popleft()
+            self._active.append(p)
+            self._start(p)
+
+    def _start(self, p):
+        self._retry_calls.pop(p, None)
+        self._running += 1
+        p.tries += 1
+        defer.maybeDeferred(self.send, *p.args).addCallbacks(
+                self._sent, self._failed, callbackArgs=(p,), errbackArgs=(p,))
+
+    def _sent(self, r, p):
+        self._running -= 1
+        self.sent += 1
+        self._finish(p, True, r)
+
+    def _failed(self, e, p):
+        self._running -= 1
+        if p.tries <= self.retries and is_transient(e):
+            delay = min(self.retry_delay*(2**(p.tries-1)), self.max_retry_delay)
+            dbg("post failed (%d), retrying in %d seconds: %s", p.tries, delay, e.value)
+            self.retried += 1
+            self._retry_calls[p] = self.clock.callLater(delay, self._retry, p)
+            return
+        logger.info("post failed: %s", e.value)
+        self.failed += 1
+        self._finish(p, False, e)
+
+    def _retry(self, p):
+        self._start(p)
+        # other posts may wait for the same retry slot:
+        self._pump()
+
+    def _finish(self, p, ok, result):
+        p.done = True
+        p.ok = ok
+        p.result = result
+        self.latencies.append(self.clock.seconds()-p.queued)
+        # deliver the results of the finished posts at the head of the queue:
+        while self._active and self._active[0].done:
+            p = self._active.popleft()
+            if p.ok:
+                p.d.callback(p.result)
+            else:
+                p.d.errback(p.result)
+        self._pump()
+
+    def latency(self):
+        """Average and maximum latency of the recent posts, or None"""
+        if not self.latencies:
+            return None
+        l = self.latencies
+        return sum(l)/len(l), max(l)
+
+    def stop(self):
+        """Drop the posts not sent yet, and cancel the pending retries
+
+        The Deferreds of the dropped posts, and of the posts being sent, fail
+        with ConnectionLost.
+        """
+        for c in self._retry_calls.values():
+            c.cancel()
+        self._retry_calls.clear()
+        dropped = list(self._active)+list(self._pending)
+        self._pending.clear()
+        self._active.clear()
+        for p in dropped:
+            p.d.errback(failure.Failure(error.ConnectionLost('connection closed before the post was sent')))
+
+
+__all__ = ['PostQueue', 'is_transient']
@@ -77,6 +77,7 @@ class ApiScheduler:
         self.pending_queue = []
         self.next_call = None
         self.running = False
+        self.paused = False
         self.shots_available = 0
 
     def new_updater(self, fn, active=True):
@@ -103,6 +104,9 @@ class ApiScheduler:
         self._dbg_dump()
 
     def _run_shots(self):
+        if self.paused:
+            dbg("paused. not running pending updaters")
+            return
         while self.shots_available > 0 and self.pending_queue:
             self.shots_available -= 1
             u = self.pending_queue.pop(0)
@@ -156,6 +160,20 @@ class ApiScheduler:
         self.running = False
         self._cancel_next()
 
+    def pause(self):
+        """Stop running updaters until resume() is called
+
+        The regular schedule keeps going, so the pending updaters run as
+        soon as the scheduler is resumed.
+        """
+        dbg("pausing scheduler")
+        self.paused = True
+
+    def resume(self):
+        dbg("resuming scheduler")
+        self.paused = False
+        self._run_shots()
+
     def wait_rate_limit(self):
         delay = int(self.api.rate_limit_reset - time.time())
         reset = time.ctime(self.api.rate_limit_reset)
@@ -1,6 +1,6 @@
 import unittest, doctest
 
-modules = 'dialogs formatting encoding errors'.split()
+modules = 'dialogs formatting encoding errors feeds usercache output entities history memory callbacks members paging postqueue'.split()
 docmodules = []
 
 def suite():
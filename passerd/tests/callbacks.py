@@ -0,0 +1,101 @@
+import unittest
+import gc
+
+from passerd.callbacks import CallbackList
+
+
+class Target:
+    def __init__(self):
+        self.calls = []
+
+    def method(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+
+
+class TestCallbackList(unittest.TestCase):
+    def setUp(self):
+        self.cbs = CallbackList(print_exceptions=False)
+        self.calls = []
+
+    def cb(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+
+    def testNoExtraArgs(self):
+        self.cbs.addCallback(self.cb)
+        self.cbs.callback(1, 2, a=3)
+        self.assertEquals(self.calls, [((1, 2), {'a':3})])
+
+    def testExtraArgs(self):
+        self.cbs.addCallback(self.cb, 'x', b=4)
+        self.cbs.callback(1, a=3)
+        self.cbs.callback(2)
+        self.assertEquals(self.calls, [((1, 'x'), {'a':3, 'b':4}),
+                                       ((2, 'x'), {'b':4})])
+
+    def testExceptions(self):
+        def fail(*args):
+            raise ValueError()
+        self.cbs.addCallback(fail)
+        self.cbs.addCallback(self.cb)
+        self.cbs.callback(1)
+        self.assertEquals(self.calls, [((1,), {})])
+
+        cbs = CallbackList(ignore_exceptions=False)
+        cbs.addCallback(fail)
+        self.assertRaises(ValueError, cbs.callback, 1)
+
+    def testRemove(self):
+        t = Target()
+        self.cbs.addCallback(self.cb)
+        self.cbs.addWeakCallback(t.method)
+        self.cbs.addCallback(self.cb, 'x')
+        self.cbs.removeCallback(self.cb)
+        self.assertEquals(len(self.cbs), 1)
+        self.cbs.removeCallback(t.method)
+        self.assertEquals(len(self.cbs), 0)
+        self.cbs.callback(1)
+        self.assertEquals(self.calls, [])
+        self.assertEquals(t.calls, [])
+
+    def testRemoveWhileDispatching(self):
+        def remove(*args):
+            self.cbs.removeCallback(self.cb)
+        self.cbs.addCallback(remove)
+        self.cbs.addCallback(self.cb)
+        self.cbs.callback(1)
+        self.cbs.callback(2)
+        self.assertEquals(self.calls, [((1,), {})])
+
+    def testWeak(self):
+        t = Target()
+        self.cbs.addWeakCallback(t.method, 'x')
+        self.cbs.callback(1)
+        self.assertEquals(t.calls, [((1, 'x'), {})])
+        del t
+        gc.collect()
+        self.cbs.callback(2)
+        self.assertEquals(len(self.cbs), 0)
+
+    def testWeakFunction(self):
+        # plain functions are not bound to any object, so they are kept
+        self.cbs.addWeakCallback(lambda *args: self.calls.append(args))
+        gc.collect()
+        self.cbs.callback(1)
+        self.assertEquals(self.calls, [(1,)])
+
+    def testTiming(self):
+        cbs = CallbackList(timing=True)
+        t = Target()
+        cbs.addWeakCallback(t.method)
+        cbs.addCallback(self.cb, 'x')
+        cbs.callback(1)
+        cbs.callback(2)
+        stats = dict((name, calls) for name, calls, secs in cbs.stats())
+        self.assertEquals(stats, {'Target.method':2, 'TestCallbackList.cb':2})
+        self.assertEquals(len(self.calls), 2)
+        cbs.reset_stats()
+        self.assertEquals(cbs.stats(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from passerd.utils import htmlentitydecode, full_entity_decode
+
+
+SAMPLES = [
+    u'',
+    u'no entities at all',
+    u'caf\xe9 & co',
+    u'&lt;b&gt;',
+    u'&amp;lt;b&amp;gt;',
+    u'&amp;',
+    u'&amp;amp;',
+    u'&amp;amp;amp;',
+    u'&amp;&amp;lt;',
+    u'&#38;lt;',
+    u'&#0038;amp;',
+    u'&#x26;gt;',
+    u'&amp;#65;&amp;#x42;',
+    u'&amp;unknown; &unknown;',
+    u'&eacute;t&eacute; &amp;eacute;',
+    u'&#99999999999; &amp;#99999999999;',
+    u'& amp; &; &#; &#x;',
+    u'&amp;frac12; &sup2;',
+    u'AT&amp;T',
+]
+
+class EntityTests(unittest.TestCase):
+    def testSingle(self):
+        self.assertEquals(htmlentitydecode(u'&lt;&#65;&#x42;&amp;lt;'), u'<AB&lt;')
+
+    def testDouble(self):
+        self.assertEquals(full_entity_decode(u'&amp;lt;3 &amp;amp; caf&amp;eacute;'),
+                          u'<3 & caf\xe9')
+
+    def testSameAsTwoPasses(self):
+        for s in SAMPLES:
+            self.assertEquals(full_entity_decode(s), htmlentitydecode(htmlentitydecode(s)),
+                              'mismatch for %r' % (s))
+
+    def testNoAmpersand(self):
+        s = u'nothing to decode here'
+        self.assertTrue(full_entity_decode(s) is s)
+
+
+if __name__ == '__main__':
+    unittest.main()
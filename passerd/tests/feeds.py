@@ -0,0 +1,159 @@
+import unittest
+
+from twisted.internet import defer
+
+from passerd.feeds import TwitterFeed
+
+
+class O:
+    """Automatic kwargs->attributes object"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeProto:
+    def __init__(self):
+        self.vars = {}
+        self.var_sets = []
+        self.paused = False
+        self.resume_funcs = []
+
+    def output_paused(self):
+        return self.paused
+
+    def when_output_resumed(self, fn):
+        self.resume_funcs.append(fn)
+
+    def user_var(self, var):
+        return self.vars.get(var)
+
+    def set_user_var(self, var, value):
+        self.var_sets.append( (var, value) )
+        self.vars[var] = value
+
+
+class FakeUpdater:
+    def __init__(self, fn):
+        self.fn = fn
+        self.destroyed = False
+
+    def resched(self):
+        pass
+
+    def destroy(self):
+        self.destroyed = True
+
+
+class FakeScheduler:
+    def new_updater(self, fn):
+        return FakeUpdater(fn)
+
+
+class FakeFeed(TwitterFeed):
+    LAST_ID_VAR = 'fake_last_id'
+
+    def __init__(self, proto, page):
+        TwitterFeed.__init__(self, proto)
+        self.page = page
+        self.requests = []
+
+    def _timeline(self, delegate, args):
+        self.requests.append(args)
+        # the API sends the newest entries first
+        for e in self.page:
+            delegate(e)
+        return defer.succeed(None)
+
+
+class TestBatchDelivery(unittest.TestCase):
+    def setUp(self):
+        self.proto = FakeProto()
+        self.page = [O(id=str(i)) for i in (30, 20, 10)]
+        self.feed = FakeFeed(self.proto, self.page)
+        self.batches = []
+        self.entries = []
+        self.feed.addBatchCallback(self.batches.append)
+        self.feed.addEntryCallback(self.entries.append)
+
+    def ids(self, l):
+        return [e.id for e in l]
+
+    def testChronologicalOrder(self):
+        self.feed._refresh()
+        self.assertEquals(len(self.batches), 1)
+        self.assertEquals(self.ids(self.batches[0]), ['10', '20', '30'])
+        self.assertEquals(self.ids(self.entries), ['10', '20', '30'])
+
+    def testLastIdUpdatedOnce(self):
+        self.feed._refresh()
+        self.assertEquals(self.proto.var_sets, [('fake_last_id', '30')])
+        self.feed._refresh()
+        self.assertEquals(self.feed.requests[-1]['since_id'], '30')
+
+    def testOlderPageKeepsLastId(self):
+        self.proto.vars['fake_last_id'] = '100'
+        self.feed._refresh(last_id=0)
+        self.assertEquals(self.proto.var_sets, [])
+        self.assertEquals(self.feed.last_id, '100')
+
+    def testPausedOutput(self):
+        self.proto.paused = True
+        self.feed._refresh()
+        self.assertEquals(self.batches, [])
+        self.assertEquals(self.proto.var_sets, [])
+        self.proto.paused = False
+        for fn in self.proto.resume_funcs:
+            fn()
+        self.assertEquals(self.ids(self.batches[0]), ['10', '20', '30'])
+        self.assertEquals(self.proto.var_sets, [('fake_last_id', '30')])
+
+    def testEmptyPage(self):
+        self.feed.page = []
+        self.feed._refresh()
+        self.assertEquals(self.batches, [])
+        self.assertEquals(self.proto.var_sets, [])
+
+
+class TestRouting(unittest.TestCase):
+    def setUp(self):
+        self.proto = FakeProto()
+        self.proto.scheduler = FakeScheduler()
+        self.home = FakeFeed(self.proto, [])
+        self.home.LAST_ID_VAR = 'home_last_id'
+        self.user = FakeFeed(self.proto, [O(id='5', user=O(id='2'))])
+        self.batches = []
+        self.user.addBatchCallback(self.batches.append)
+        self.home.start_refreshing()
+
+    def page(self, *entries):
+        return [O(id=str(id), user=O(id=str(uid))) for id,uid in entries]
+
+    def testRouted(self):
+        self.user.start_routed(self.home, lambda e: e.user.id == '2')
+        # refreshed once, for the older posts, but not polling:
+        self.assertEquals(len(self.user.requests), 1)
+        self.assertFalse(self.user.is_refreshing())
+        self.home.deliver_entries(self.page((10, 1), (11, 2), (12, 2)))
+        self.home.deliver_entries(self.page((13, 1)))
+        self.assertEquals([[e.id for e in b] for b in self.batches], [['5'], ['11', '12']])
+        self.assertEquals(self.user.last_id, '12')
+
+    def testSourceStopped(self):
+        self.user.start_routed(self.home, lambda e: True)
+        self.home.stop_refreshing()
+        self.assertTrue(self.user.is_refreshing())
+        self.assertEquals(self.user.routed_from, None)
+        self.home.deliver_entries(self.page((10, 2)))
+        # only the feed's own requests:
+        self.assertEquals(len(self.batches), len(self.user.requests))
+
+    def testStopped(self):
+        self.user.start_routed(self.home, lambda e: True)
+        self.user.stop_refreshing()
+        self.assertEquals(self.home._routes, [])
+        self.home.deliver_entries(self.page((10, 2)))
+        self.assertEquals(len(self.batches), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,12 @@
 
 import unittest
 
+from twisted.internet import defer
+
 from passerd import ircd
+from passerd.util import LRUCache
+from passerd.history import SeenIds, StatusStore, ChannelHistory
+from passerd.tests.feeds import FakeFeed, FakeScheduler
 
 
 class FakeProto(ircd.PasserdProtocol):
@@ -12,6 +17,7 @@ class FakeProto(ircd.PasserdProtocol):
         self.privmsg_log = []
         self.fake_users = {}
         self.passerd_bot = 'this_is_passerd-bot'
+        self.render_cache = LRUCache(10)
 
     def user_cfg_var_b(self, var):
         return self.user_cfg_vars.get(var, False)
@@ -19,12 +25,16 @@ class FakeProto(ircd.PasserdProtocol):
     def get_twitter_user(self, twid):
         return self.fake_users[twid]
 
-    def send_privmsg(self, sender, target, msg):
+    def send_privmsg(self, sender, target, msg, droppable=False):
+        # rendered text is already encoded
+        if isinstance(msg, str):
+            msg = msg.decode('utf-8')
         self.privmsg_log.append( (sender, target, msg) )
 
 class FakeChannel(ircd.TwitterChannel):
     def __init__(self, proto):
         self.proto = proto
+        self.seen_ids = SeenIds()
 
 
 class O:
@@ -84,3 +94,267 @@ class TestMsgFormatting(unittest.TestCase):
         self.sendAliceBobRT()
         self.assertEquals(self.proto.privmsg_log,
                           [(self.alice_u, self.chan, u'this is über cool! \x02[RT by @bob]\x02')])
+
+
+class TestRenderCache(unittest.TestCase):
+    def setUp(self):
+        self.proto = FakeProto()
+        self.proto.fake_users[1] = 'this_is_alice'
+        self.renders = []
+        render_text = self.proto.render_text
+        def counting_render(text, multiline):
+            self.renders.append(text)
+            return render_text(text, multiline)
+        self.proto.render_text = counting_render
+
+    def testRenderOnce(self):
+        alice = O(screen_name='alice', id=1)
+        e = O(id=123, text=u'&amp;lt;3 über', user=alice, retweeted_status=None)
+        chan1 = FakeChannel(self.proto)
+        chan2 = FakeChannel(self.proto)
+        chan1.printEntry(e)
+        chan2.printEntry(e)
+        self.assertEquals(len(self.renders), 1)
+        self.assertEquals(self.proto.privmsg_log,
+                          [('this_is_alice', chan1, u'<3 über'),
+                           ('this_is_alice', chan2, u'<3 über')])
+
+    def testOptionsChange(self):
+        alice = O(screen_name='alice', id=1)
+        e = O(id=123, text=u'a\nb', user=alice, retweeted_status=None)
+        chan = FakeChannel(self.proto)
+        chan.printEntry(e)
+        self.proto.user_cfg_vars['multiline'] = True
+        chan.printEntry(e)
+        self.assertEquals(len(self.renders), 2)
+        self.assertEquals([m for s,t,m in self.proto.privmsg_log],
+                          [u'a b', u'a', u'[...] b'])
+
+    def testLRU(self):
+        c = LRUCache(2)
+        c.put(1, 'a')
+        c.put(2, 'b')
+        c.get(1)
+        c.put(3, 'c')
+        self.assertTrue(1 in c)
+        self.assertFalse(2 in c)
+        self.assertEquals(len(c), 2)
+
+
+class FakeUserCache:
+    def __init__(self):
+        self.updates = []
+
+    def got_api_users_info(self, users):
+        self.updates.extend([u.screen_name for u in users])
+
+
+class ChannelTestMixin:
+    def setUp(self):
+        self.proto = FakeProto()
+        self.proto.fake_users[1] = 'this_is_alice'
+        self.proto.seen_ids = SeenIds()
+        self.proto.status_store = StatusStore()
+        self.proto.global_twuser_cache = FakeUserCache()
+        self.proto.hold_output = self.proto.release_output = lambda: None
+        self.proto.user_cfg_var = self.proto.user_cfg_vars.get
+        alice = O(screen_name='alice', id=1)
+        self.entries = [O(id=str(i), text=u'post %d' % (i), user=alice, retweeted_status=None,
+                          created_at=None, in_reply_to_status_id=None)
+                        for i in (1, 2)]
+
+    def newChannel(self):
+        chan = FakeChannel(self.proto)
+        chan.name = '#fake'
+        chan.history = ChannelHistory(10)
+        return chan
+
+    def texts(self):
+        return [m for s,t,m in self.proto.privmsg_log]
+
+
+class TestDuplicates(ChannelTestMixin, unittest.TestCase):
+    def testHide(self):
+        c = self.newChannel()
+        c.got_entries(self.entries)
+        c.got_entries(self.entries)
+        self.assertEquals(self.texts(), [u'post 1', u'post 2'])
+        self.assertEquals(len(c.history), 2)
+
+    def testOtherChannel(self):
+        self.newChannel().got_entries(self.entries)
+        c2 = self.newChannel()
+        c2.got_entries(self.entries)
+        self.assertEquals(self.texts(), [u'post 1', u'post 2']*2)
+        self.assertEquals(len(c2.history), 2)
+        # the user info is updated only once:
+        self.assertEquals(self.proto.global_twuser_cache.updates, ['alice', 'alice'])
+
+    def testShow(self):
+        self.proto.user_cfg_vars['duplicates'] = 'show'
+        c1 = self.newChannel()
+        c1.got_entries(self.entries[:1])
+        c1.got_entries(self.entries)
+        self.assertEquals(self.texts(), [u'post 1', u'post 1 \x02[re-sent]\x02', u'post 2'])
+        self.assertEquals(self.proto.global_twuser_cache.updates, ['alice', 'alice'])
+        # both channels share the same history record:
+        c2 = self.newChannel()
+        c2.got_entries(self.entries)
+        self.assertTrue(c1.history.posts()[0] is c2.history.posts()[0])
+
+    def testReplyToHidden(self):
+        self.entries[1].text = u'something else'
+        self.newChannel().got_entries(self.entries)
+        c = self.newChannel()
+        c.got_entries(self.entries)
+        c.got_entries(self.entries)
+        posts = []
+        def send_twitter_post(msg, args):
+            posts.append( (msg, args) )
+            return defer.succeed('100')
+        self.proto.send_twitter_post = send_twitter_post
+        cmds = ircd.PasserdCommands(self.proto, c)
+        messages = []
+        cmds.set_message_func(messages.append)
+        cmds.command_re('alice post hi there')
+        self.assertEquals(posts, [('@alice hi there', {'in_reply_to_status_id':'1'})])
+
+
+class TestRoutedChannel(ChannelTestMixin, unittest.TestCase):
+    """#twitter and a #@alice channel fed from the home timeline"""
+    def setUp(self):
+        ChannelTestMixin.setUp(self)
+        self.proto.fake_users[2] = 'this_is_bob'
+        vars = {}
+        self.proto.user_var = vars.get
+        self.proto.set_user_var = vars.__setitem__
+        self.proto.output_paused = lambda: False
+        self.proto.scheduler = FakeScheduler()
+
+        self.twitter = self.newChannel()
+        self.home = FakeFeed(self.proto, [])
+        self.home.LAST_ID_VAR = 'home_last_id'
+        self.home.addBatchCallback(self.twitter.got_entries)
+        self.home.start_refreshing()
+
+        self.alice = self.newChannel()
+        self.user_feed = FakeFeed(self.proto, [])
+        self.user_feed.addBatchCallback(self.alice.got_entries)
+
+    def page(self, *entries):
+        users = {1:O(screen_name='alice', id=1), 2:O(screen_name='bob', id=2)}
+        return [O(id=str(id), text=u'post %d' % (id), user=users[uid], retweeted_status=None,
+                  created_at=None, in_reply_to_status_id=None)
+                for id,uid in entries]
+
+    def shown(self, chan):
+        return [m for s,t,m in self.proto.privmsg_log if t is chan]
+
+    def testHomePage(self):
+        self.home.deliver_entries(self.page((10, 1)))
+        # the backfill of the user feed has a post already shown on #twitter:
+        self.user_feed.page = self.page((10, 1))
+        self.user_feed.start_routed(self.home, lambda e: e.user.id == 1)
+        self.home.deliver_entries(self.page((11, 1), (12, 2)))
+        self.assertEquals(self.shown(self.twitter), [u'post 10', u'post 11', u'post 12'])
+        self.assertEquals(self.shown(self.alice), [u'post 10', u'post 11'])
+        self.assertEquals(len(self.alice.history), 2)
+
+    def testUpdateRoute(self):
+        routed = []
+        self.alice.feeds = [self.user_feed]
+        self.alice.home_route = lambda: routed and (lambda e: e.user.id == 1) or None
+        self.proto.home_feed = lambda: self.home
+        self.proto.joined_channels = set([self.alice])
+        self.alice.update_route()
+        self.assertTrue(self.user_feed.is_refreshing())
+        # e.g. the user followed alice:
+        routed.append(True)
+        self.alice.update_route()
+        self.assertTrue(self.user_feed.routed_from is self.home)
+        self.assertFalse(self.user_feed.is_refreshing())
+        self.user_feed.page = self.page((11, 1))
+        self.home.deliver_entries(self.page((11, 1), (12, 2)))
+        # ...and unfollowed her:
+        del routed[:]
+        self.alice.update_route()
+        self.assertTrue(self.user_feed.routed_from is None)
+        self.assertTrue(self.user_feed.is_refreshing())
+        self.home.deliver_entries(self.page((13, 1)))
+        self.assertEquals(self.shown(self.alice), [u'post 11'])
+
+
+class TestLocalEcho(unittest.TestCase):
+    def setUp(self):
+        self.proto = FakeProto()
+        self.proto.fake_users[1] = 'this_is_alice'
+        self.proto.seen_ids = SeenIds()
+        self.proto.status_store = StatusStore()
+        self.proto.global_twuser_cache = FakeUserCache()
+        self.proto.hold_output = self.proto.release_output = lambda: None
+        self.proto.user_cfg_var = self.proto.user_cfg_vars.get
+        self.proto.authenticated_user = O(id='1', screen_name='alice')
+        self.posts = []
+        self.proto.send_twitter_post = self.send_twitter_post
+        self.chan = FakeChannel(self.proto)
+        self.chan.name = '#fake'
+        self.chan.history = ChannelHistory(10)
+
+    def send_twitter_post(self, msg, args):
+        self.posts.append( (msg, args) )
+        return defer.succeed(str(100+len(self.posts)))
+
+    def testEcho(self):
+        self.chan.send_twitter_post('Hello World')
+        r = self.chan.recent_post('alice', u'hello')
+        self.assertEquals(r.id, 101)
+        # the echo is not shared with other channels and connections:
+        self.assertEquals(self.proto.status_store.get(101), None)
+        # not shown again when it comes back from the API:
+        alice = O(screen_name='alice', id='1')
+        e = O(id='101', text=u'Hello World', user=alice, retweeted_status=None,
+              created_at=None, in_reply_to_status_id=None)
+        self.chan.got_entries([e])
+        self.assertEquals(self.proto.privmsg_log, [])
+
+    def testReply(self):
+        self.chan.send_twitter_post('first')
+        self.chan.send_twitter_post('alice: caf\xc3\xa9')
+        self.assertEquals(self.posts[1], ('@alice: caf\xc3\xa9', {'in_reply_to_status_id':'101'}))
+        self.assertEquals(self.chan.recent_post('alice', u'CAF\xc9').in_reply_to, 101)
+
+    def testReCommand(self):
+        self.proto.fake_users[2] = 'this_is_bob'
+        bob = O(screen_name='bob', id=2)
+        e = O(id='5', text=u'a question', user=bob, retweeted_status=None,
+              created_at=None, in_reply_to_status_id=None)
+        self.chan.got_entries([e])
+        cmds = ircd.PasserdCommands(self.proto, self.chan)
+        messages = []
+        cmds.set_message_func(messages.append)
+        cmds.command_re('bob question the answer')
+        self.assertEquals(self.posts, [('@bob the answer', {'in_reply_to_status_id':'5'})])
+        # the reply is on the channel history, like other posts sent there:
+        self.assertEquals(self.chan.recent_post('alice', u'answer').in_reply_to, 5)
+        self.proto.privmsg_log = []
+        e = O(id='101', text=u'@bob the answer', user=O(screen_name='alice', id=1),
+              retweeted_status=None, created_at=None, in_reply_to_status_id='5')
+        self.chan.got_entries([e])
+        self.assertEquals(self.proto.privmsg_log, [])
+
+    def testOtherChannel(self):
+        self.chan.send_twitter_post('Hello World')
+        # the post is shown and recorded on #twitter when it arrives there:
+        twitter = FakeChannel(self.proto)
+        twitter.name = '#twitter'
+        twitter.history = ChannelHistory(10)
+        alice = O(screen_name='alice', id=1)
+        e = O(id='101', text=u'Hello World', user=alice, retweeted_status=None,
+              created_at=None, in_reply_to_status_id=None)
+        twitter.got_entries([e])
+        self.assertEquals([m for s,t,m in self.proto.privmsg_log], [u'Hello World'])
+        r = twitter.recent_post('alice', u'hello')
+        self.assertTrue(r is self.proto.status_store.get(101))
+        self.assertTrue(r is not self.chan.recent_post('alice', u'hello'))
+        self.assertTrue(r.screen_name is intern('alice'))
+
@@ -0,0 +1,239 @@
+import gc
+import unittest
+
+from passerd.history import SeenIds, HistoryEntry, StatusStore, ChannelHistory, normalize_text
+
+
+class TestSeenIds(unittest.TestCase):
+    def testAdd(self):
+        s = SeenIds(10)
+        self.assertTrue(s.add(5))
+        self.assertTrue(s.add(3))
+        self.assertTrue(s.add(8))
+        self.assertFalse(s.add(3))
+        self.assertTrue(3 in s)
+        self.assertFalse(4 in s)
+
+    def testBounded(self):
+        s = SeenIds(100)
+        for i in range(1000):
+            s.add(i)
+        self.assertEquals(len(s), 100)
+        self.assertTrue(999 in s)
+        self.assertTrue(900 in s)
+        self.assertFalse(899 in s)
+        # too old to be tracked, but not reported as duplicate:
+        self.assertTrue(s.add(10))
+        self.assertEquals(len(s), 100)
+
+    def testTrim(self):
+        s = SeenIds(100)
+        for i in range(50):
+            s.add(i)
+        s.trim(10)
+        self.assertEquals(len(s), 10)
+        self.assertTrue(49 in s)
+        self.assertFalse(39 in s)
+
+    def testOutOfOrder(self):
+        s = SeenIds(5)
+        for i in [10, 2, 7, 1, 9, 8, 3]:
+            s.add(i)
+        self.assertEquals(sorted([i for i in range(12) if i in s]), [3, 7, 8, 9, 10])
+
+
+class O:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class TestHistoryEntry(unittest.TestCase):
+    def status(self, **kwargs):
+        user = O(id='42', screen_name=u'Alice')
+        args = dict(id='1234', user=user, text=u'Caf\xe9 &amp;lt;3',
+                    created_at='Mon Jan 04 12:00:00 +0000 2010',
+                    in_reply_to_status_id='')
+        args.update(kwargs)
+        return O(**args)
+
+    def testFromStatus(self):
+        r = HistoryEntry.from_status(self.status())
+        self.assertEquals(r.id, 1234)
+        self.assertEquals(r.user_id, 42)
+        self.assertEquals(r.screen_name, 'Alice')
+        self.assertTrue(type(r.screen_name) is str)
+        self.assertEquals(r.text, u'caf\xe9 <3')
+        self.assertEquals(r.created_at, 1262606400)
+        self.assertEquals(r.in_reply_to, None)
+
+    def testReply(self):
+        r = HistoryEntry.from_status(self.status(in_reply_to_status_id='99'))
+        self.assertEquals(r.in_reply_to, 99)
+
+    def testBadDate(self):
+        r = HistoryEntry.from_status(self.status(created_at='garbage'))
+        self.assertEquals(r.created_at, None)
+
+    def testNoDict(self):
+        r = HistoryEntry.from_status(self.status())
+        self.assertRaises(AttributeError, setattr, r, 'foo', 1)
+
+
+def post(id, uid, text=None):
+    if text is None:
+        text = u'post %d' % (id)
+    return HistoryEntry(id, uid, 'user%d' % (uid), text)
+
+
+class TestStatusStore(unittest.TestCase):
+    def status(self, id):
+        return O(id=str(id), user=O(id='1', screen_name='alice'),
+                 text=u'post %d' % (id), created_at=None,
+                 in_reply_to_status_id=None)
+
+    def testShared(self):
+        store = StatusStore()
+        r = store.record(self.status(10))
+        self.assertTrue(store.record(self.status(10)) is r)
+        self.assertEquals((store.hits, store.misses), (1, 1))
+        self.assertTrue(store.get(10) is r)
+
+    def testWeak(self):
+        store = StatusStore()
+        h = ChannelHistory(2)
+        for i in range(5):
+            h.add(store.record(self.status(i)))
+        gc.collect()
+        self.assertEquals(len(store), 2)
+        self.assertEquals(store.get(0), None)
+        self.assertEquals(store.get(4).id, 4)
+
+
+class TestChannelHistory(unittest.TestCase):
+    def add_posts(self, h, first, count, users):
+        for i in xrange(first, first+count):
+            h.add(post(i, i % users))
+
+    def ids(self, posts):
+        return [p.id for p in posts]
+
+    def testRing(self):
+        h = ChannelHistory(3)
+        self.add_posts(h, 0, 5, 2)
+        self.assertEquals(len(h), 3)
+        self.assertEquals(self.ids(h.posts()), [2, 3, 4])
+        self.assertEquals(self.ids(h.by_user(0)), [2, 4])
+        self.assertEquals(self.ids(h.by_user(1)), [3])
+        self.assertEquals(h.latest_by_user(0).id, 4)
+
+    def testUsersDropped(self):
+        h = ChannelHistory(3)
+        self.add_posts(h, 0, 3, 3)
+        for i in (3, 4, 5):
+            h.add(post(i, 5))
+        self.assertEquals(h.users(), 1)
+        self.assertEquals(h.by_user(0), [])
+        self.assertEquals(h.latest_by_user(1), None)
+        self.assertEquals(h.user_id('user1'), None)
+        self.assertEquals(h.user_id('User5'), 5)
+
+    def testResize(self):
+        h = ChannelHistory(5)
+        self.add_posts(h, 0, 5, 2)
+        h.resize(2)
+        self.assertEquals(self.ids(h.posts()), [3, 4])
+        self.assertEquals(h.users(), 2)
+        h.resize(4)
+        self.add_posts(h, 5, 1, 2)
+        self.assertEquals(self.ids(h.posts()), [3, 4, 5])
+
+    def testSameRecordTwice(self):
+        h = ChannelHistory(3)
+        p = post(1, 1, u'hello world')
+        h.add(p)
+        h.add(p)
+        h.add(post(2, 2))
+        h.add(post(3, 2))
+        self.assertEquals(self.ids(h.find(1, u'world')), [1])
+        h.add(post(4, 2))
+        self.assertEquals(h.find(1, u'world'), [])
+        self.assertEquals(h._trigrams.get(u'wor'), None)
+        self.assertEquals(h._copies.get(p), None)
+
+    def testApproxBytes(self):
+        h = ChannelHistory(10)
+        empty = h.approx_bytes()
+        self.add_posts(h, 0, 10, 3)
+        full = h.approx_bytes()
+        self.assertTrue(full > empty)
+        self.add_posts(h, 10, 100, 3)
+        self.assertTrue(h.approx_bytes() < 2*full)
+
+    def testSoak(self):
+        h = ChannelHistory(100)
+        self.add_posts(h, 0, 10000, 5000)
+        gc.collect()
+        before = len(gc.get_objects())
+        self.add_posts(h, 10000, 40000, 20000)
+        gc.collect()
+        after = len(gc.get_objects())
+        self.assertEquals(len(h), 100)
+        self.assertEquals(h.users(), 100)
+        self.assertEquals(sum([len(h.by_user(u)) for u in range(20000)]), 100)
+        # allow for some noise, but nothing proportional to the number of
+        # posts or users seen:
+        self.assertTrue(after - before < 100, (before, after))
+        self.assertTrue(len(h._trigrams) < 2000)
+
+
+class TestFind(unittest.TestCase):
+    def setUp(self):
+        self.h = ChannelHistory(4)
+        self.h.add(post(1, 1, u"hello, world! it's me"))
+        self.h.add(post(2, 2, u'hello world'))
+        self.h.add(post(3, 1, u'caf\xe9  au lait'))
+        self.h.add(post(4, 1, u'hello again'))
+
+    def ids(self, posts):
+        return [p.id for p in posts]
+
+    def testNormalize(self):
+        self.assertEquals(normalize_text(u' Hello,  World!! '), u'hello world')
+        self.assertEquals(normalize_text(u'Caf\xe9-au lait'), u'caf\xe9 au lait')
+
+    def testFind(self):
+        self.assertEquals(self.ids(self.h.find(1, u'hello')), [4, 1])
+        self.assertEquals(self.ids(self.h.find(1, u'Hello World')), [1])
+        self.assertEquals(self.ids(self.h.find(2, u'hello world')), [2])
+        self.assertEquals(self.ids(self.h.find(1, u'CAF\xc9 au')), [3])
+        self.assertEquals(self.h.find(1, u'goodbye'), [])
+
+    def testShortSubstring(self):
+        self.assertEquals(self.ids(self.h.find(1, u'me')), [1])
+        # punctuation-only substrings don't match every post:
+        self.assertEquals(self.h.find(1, u'!!'), [])
+        self.assertEquals(self.h.find(1, u':)'), [])
+        self.assertEquals(self.ids(self.h.find(1, u'!')), [1])
+
+    def testEvicted(self):
+        self.h.add(post(5, 2, u'bye'))
+        self.assertEquals(self.h.find(1, u'world'), [])
+        self.assertFalse(u's m' in self.h._trigrams)
+        self.assertEquals(self.ids(self.h.find(2, u'world')), [2])
+
+    def testIndexed(self):
+        h = ChannelHistory(100)
+        for i in range(100):
+            h.add(post(i, i % 2, u'Post number %d!' % (i)))
+        self.assertEquals(self.ids(h.find(1, u'number 51')), [51])
+        self.assertEquals(self.ids(h.find(1, u'number 5')), [59, 57, 55, 53, 51, 5])
+        self.assertEquals(h.find(0, u'number 51'), [])
+        self.assertEquals(h.find(1, u'xyz'), [])
+
+    def testResent(self):
+        self.h.add(post(4, 1, u'hello again'))
+        self.assertEquals(self.ids(self.h.find(1, u'again')), [4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,325 @@
+import random
+import unittest
+
+from twisted.internet import defer
+
+from passerd.data import DataStore
+from passerd.members import MemberLists, id_array, diff_ids
+from passerd import ircd
+from passerd.irc import IrcChannel, MAX_LINE_LENGTH
+
+
+class O:
+    """Automatic kwargs->attributes object"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class TestMemberLists(unittest.TestCase):
+    def setUp(self):
+        self.data = DataStore('sqlite://')
+        self.data.create_tables()
+        self.now = 1000
+        self.lists = MemberLists(self.data, ttl=60, clock=lambda: self.now)
+
+    def testUnknown(self):
+        self.assertEquals(self.lists.get('friends:1'), None)
+        self.assertTrue(self.lists.is_stale('friends:1'))
+
+    def testPersisted(self):
+        self.lists.set('friends:1', ['3', 1, 2])
+        lists = MemberLists(self.data, ttl=60, clock=lambda: self.now)
+        self.assertEquals(list(lists.get('friends:1')), [1, 2, 3])
+        self.assertFalse(lists.is_stale('friends:1'))
+
+    def testTTL(self):
+        self.lists.set('friends:1', [1])
+        self.now += 59
+        self.assertFalse(self.lists.is_stale('friends:1'))
+        self.now += 1
+        self.assertTrue(self.lists.is_stale('friends:1'))
+
+    def testDeltas(self):
+        self.lists.add('friends:1', 5)
+        self.lists.remove('friends:1', 5)
+        self.assertEquals(self.lists.get('friends:1'), None)
+        self.lists.set('friends:1', [1, 2])
+        self.now += 30
+        ids = self.lists.get('friends:1')
+        self.lists.add('friends:1', '5')
+        self.lists.add('friends:1', 5)
+        self.lists.remove('friends:1', 1)
+        self.lists.remove('friends:1', 3)
+        # arrays returned by get() are not changed:
+        self.assertEquals(list(ids), [1, 2])
+        self.lists.clear()
+        self.assertEquals(list(self.lists.get('friends:1')), [2, 5])
+        # deltas don't make the list fresh:
+        self.now += 30
+        self.assertTrue(self.lists.is_stale('friends:1'))
+
+    def testContains(self):
+        self.assertFalse(self.lists.contains('friends:1', 1))
+        self.lists.set('friends:1', [1, 3])
+        self.assertTrue(self.lists.contains('friends:1', '3'))
+        self.assertFalse(self.lists.contains('friends:1', 2))
+        self.assertFalse(self.lists.contains('friends:1', 4))
+        self.lists.add('friends:1', 4)
+        self.assertTrue(self.lists.contains('friends:1', 4))
+
+    def testEmpty(self):
+        self.lists.set('friends:1', [])
+        self.lists.clear()
+        self.assertEquals(list(self.lists.get('friends:1')), [])
+
+
+class TestDiffIds(unittest.TestCase):
+    def diff(self, old, new):
+        added, removed = diff_ids(id_array(old), id_array(new))
+        return list(added), list(removed)
+
+    def testSame(self):
+        self.assertEquals(self.diff(range(5000), range(5000)), ([], []))
+        self.assertEquals(self.diff([], []), ([], []))
+
+    def testChanges(self):
+        self.assertEquals(self.diff([1, 3, 5, 7], [2, 3, 7, 8, 9]), ([2, 8, 9], [1, 5]))
+        self.assertEquals(self.diff([], [1, 2]), ([1, 2], []))
+        self.assertEquals(self.diff([1, 2], []), ([], [1, 2]))
+
+    def testLongPrefix(self):
+        old = range(0, 10000, 2)
+        for i in [0, 1, 1023, 1024, 1025, 4999]:
+            new = old[:i]+old[i+1:]+[20001]
+            self.assertEquals(self.diff(old, new), ([20001], [old[i]]))
+
+    def testScattered(self):
+        rnd = random.Random(1)
+        old = set(rnd.sample(xrange(100000), 5000))
+        new = (old - set(rnd.sample(sorted(old), 50))) | set(rnd.sample(xrange(100000), 50))
+        self.assertEquals(self.diff(old, new),
+                          (sorted(new - old), sorted(old - new)))
+
+    def testLargeIds(self):
+        self.assertEquals(self.diff([2**40, 2**40+1], [2**40+1]), ([], [2**40]))
+
+
+class FakeProto:
+    def __init__(self, lists):
+        self.member_lists = lists
+        self.the_user = 'me'
+        self.passerd_bot = 'bot'
+        self.joined_channels = set()
+        self.route_updates = 0
+
+    def update_routes(self):
+        self.route_updates += 1
+
+    def get_twitter_user(self, id, watch=False):
+        return id
+
+    def dbg(self, msg):
+        pass
+
+
+class FriendsChannel(ircd.FriendIDsMixIn, ircd.FriendlistMixIn):
+    name = '#twitter'
+
+    def __init__(self, proto, ids):
+        self.proto = proto
+        self.ids = ids
+        self.reqs = []
+        self.changes = []
+        self.init_members()
+
+    def member_list_key(self):
+        return 'friends:1'
+
+    def notifyJoin(self, who):
+        self.changes.append(('JOIN', who))
+
+    def notifyPart(self, who, reason):
+        self.changes.append(('PART', who))
+
+    def _friendList(self, delegate, params={}, page_delegate=None):
+        d = defer.Deferred()
+        self.reqs.append(d)
+        def finish(r):
+            for id in self.ids:
+                delegate(str(id))
+            page_delegate('0', '0')
+        return d.addCallback(finish)
+
+
+class TestFriendList(unittest.TestCase):
+    def setUp(self):
+        data = DataStore('sqlite://')
+        data.create_tables()
+        self.now = 1000
+        self.lists = MemberLists(data, ttl=60, clock=lambda: self.now)
+        self.chan = FriendsChannel(FakeProto(self.lists), [1, 2])
+
+    def members(self):
+        r = []
+        self.chan.list_members().addCallback(r.append)
+        return r
+
+    def testFetchOnce(self):
+        r1 = self.members()
+        r2 = self.members()
+        self.assertEquals(len(self.chan.reqs), 1)
+        self.chan.reqs[0].callback(None)
+        self.assertEquals(r1, [['me', 'bot', 1, 2]])
+        self.assertEquals(r2, r1)
+        # served from the cache, now:
+        self.assertEquals(self.members(), r1)
+        self.assertEquals(len(self.chan.reqs), 1)
+
+    def testStale(self):
+        self.lists.set('friends:1', [1])
+        self.now += 60
+        self.chan.ids = [1, 3]
+        # the old list is returned, while the new one is fetched:
+        self.assertEquals(self.members(), [['me', 'bot', 1]])
+        self.assertEquals(len(self.chan.reqs), 1)
+        self.chan.reqs[0].callback(None)
+        self.assertEquals(list(self.lists.get('friends:1')), [1, 3])
+        # not joined, no JOIN/PART messages:
+        self.assertEquals(self.chan.changes, [])
+
+    def testJoinPart(self):
+        self.lists.set('friends:1', [1, 2, 4])
+        self.chan.proto.joined_channels.add(self.chan)
+        self.chan.ids = [1, 3, 4, 5]
+        self.chan.refresh_members()
+        self.chan.reqs[0].callback(None)
+        self.assertEquals(self.chan.changes, [('PART', 2), ('JOIN', 3), ('JOIN', 5)])
+        # channels fed from the home timeline may need to poll now:
+        self.assertEquals(self.chan.proto.route_updates, 1)
+
+    def testStoreError(self):
+        orig_set = self.lists.set
+        def failing_set(key, ids):
+            raise IOError('database is locked')
+        self.lists.set = failing_set
+        errors = []
+        self.chan.refresh_members().addErrback(errors.append)
+        self.chan.reqs[0].callback(None)
+        self.assertEquals(len(errors), 1)
+        self.assertTrue(errors[0].check(IOError))
+        # the next refresh isn't stuck waiting for the failed one:
+        self.lists.set = orig_set
+        r = self.members()
+        self.assertEquals(len(self.chan.reqs), 2)
+        self.chan.reqs[1].callback(None)
+        self.assertEquals(r, [['me', 'bot', 1, 2]])
+
+
+class User:
+    def __init__(self, nick):
+        self.nick = nick
+
+    def irc_prefix(self):
+        return self.nick
+
+
+class NamesProto(FakeProto):
+    def __init__(self, lists):
+        FakeProto.__init__(self, lists)
+        self.the_user = User('me')
+        self.passerd_bot = User('passerd-bot')
+        self.my_irc_server = User('passerd.server')
+        self.lines = []
+        self.fetched = []
+
+    def get_twitter_user(self, id, watch=False):
+        return User('user%010d' % (id))
+
+    def send_reply(self, cmd, *params):
+        line = ' '.join([':passerd.server', cmd, self.the_user.nick]+list(params))
+        self.lines.append(line)
+
+    def notice(self, msg):
+        pass
+
+
+class PagedChannel(ircd.FriendIDsMixIn, ircd.FriendlistMixIn, IrcChannel):
+    """Channel whose member list has a page of 100 IDs for each request"""
+    def __init__(self, proto, pages):
+        IrcChannel.__init__(self, proto, '#twitter')
+        self.init_members()
+        self.pages = pages
+        self.reqs = []
+
+    def member_list_key(self):
+        return 'friends:1'
+
+    def _fetch_user_info(self, users):
+        self.proto.fetched.append(len(users))
+
+    def _friendList(self, delegate, params={}, page_delegate=None):
+        d = defer.Deferred()
+        self.reqs.append(d)
+        n = len(self.reqs)
+        def finish(r):
+            for id in range(n*100, n*100+100):
+                delegate(str(id))
+            if n < self.pages:
+                page_delegate(str(n+1), '0')
+            else:
+                page_delegate('0', '0')
+        return d.addCallback(finish)
+
+
+class TestNames(unittest.TestCase):
+    def setUp(self):
+        data = DataStore('sqlite://')
+        data.create_tables()
+        self.lists = MemberLists(data)
+        self.proto = NamesProto(self.lists)
+        self.chan = PagedChannel(self.proto, 3)
+
+    def names(self):
+        r = []
+        for l in self.proto.lines:
+            self.assertTrue(len(l)+2 <= MAX_LINE_LENGTH)
+            if ' 353 ' in l:
+                r.extend(l.split(' :', 1)[1].split())
+        return r
+
+    def testStreaming(self):
+        self.chan.sendNames()
+        # lines are sent only when full:
+        self.assertEquals(self.names(), [])
+        self.chan.reqs[0].callback(None)
+        self.assertTrue(0 < len(self.names()) < 102)
+        self.chan.reqs[1].callback(None)
+        self.chan.reqs[2].callback(None)
+        names = self.names()
+        self.assertEquals(len(names), 302)
+        self.assertEquals(names[:3], ['me', 'passerd-bot', 'user0000000100'])
+        self.assertTrue(' 366 ' in self.proto.lines[-1])
+        # all lines but the last one are nearly full:
+        for l in self.proto.lines[:-2]:
+            self.assertTrue(len(l)+2 > MAX_LINE_LENGTH-16)
+        self.assertEquals(self.proto.fetched, [300])
+
+    def testCached(self):
+        self.lists.set('friends:1', range(100))
+        self.chan.sendNames()
+        self.assertEquals(len(self.names()), 102)
+        self.assertEquals(self.chan.reqs, [])
+        self.assertTrue(' 366 ' in self.proto.lines[-1])
+
+    def testStale(self):
+        self.lists.set('friends:1', range(100))
+        self.lists.ttl = 0
+        self.chan.sendNames()
+        self.assertEquals(len(self.names()), 102)
+        # a single refresh, with a single waiter:
+        self.assertEquals(len(self.chan.reqs), 1)
+        self.assertEquals(len(self.chan._members_waiting), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
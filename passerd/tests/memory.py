@@ -0,0 +1,77 @@
+import unittest
+
+from twisted.internet.task import Clock
+
+from passerd.memory import MemoryGovernor
+
+
+class FakeConnection:
+    def __init__(self, last_activity, history, cache):
+        self.last_activity = last_activity
+        self.history = history
+        self.cache = cache
+        self.shrinks = 0
+
+    def memory_usage(self):
+        return [('history', self.history), ('cache', self.cache)]
+
+    def shrink_memory(self):
+        self.shrinks += 1
+        self.history /= 10
+        self.cache = 0
+
+
+class TestMemoryGovernor(unittest.TestCase):
+    def setUp(self):
+        self.gov = MemoryGovernor(budget=10000, clock=Clock())
+        self.vars = 1000
+        self.gov.register('vars', lambda: self.vars, self.clear_vars)
+        self.gov.register('records', lambda: 500)
+        self.old = FakeConnection(10, 3000, 1000)
+        self.new = FakeConnection(20, 3000, 1000)
+        self.gov.add_connection(self.new)
+        self.gov.add_connection(self.old)
+
+    def clear_vars(self):
+        self.vars = 0
+
+    def testUsage(self):
+        self.assertEquals(self.gov.usage(), [('cache', 2000), ('history', 6000),
+                                             ('records', 500), ('vars', 1000)])
+        self.assertEquals(self.gov.total(), 9500)
+
+    def testUnderBudget(self):
+        self.assertEquals(self.gov.enforce(), 9500)
+        self.assertEquals(self.old.shrinks, 0)
+
+    def testOldestFirst(self):
+        self.gov.budget = 8000
+        self.assertEquals(self.gov.enforce(), 5800)
+        self.assertEquals((self.old.shrinks, self.new.shrinks), (1, 0))
+        self.assertEquals(self.vars, 1000)
+
+    def testGlobalCaches(self):
+        self.gov.budget = 2000
+        self.assertEquals(self.gov.enforce(), 1100)
+        self.assertEquals((self.old.shrinks, self.new.shrinks), (1, 1))
+        self.assertEquals(self.vars, 0)
+        self.assertEquals(self.gov.shrunk_subsystems, 1)
+
+    def testRemoveConnection(self):
+        self.gov.remove_connection(self.old)
+        self.assertEquals(self.gov.total(), 5500)
+
+    def testPeriodicCheck(self):
+        clock = self.gov.clock
+        self.gov.budget = 8000
+        self.gov.start(60)
+        clock.advance(59)
+        self.assertEquals(self.old.shrinks, 0)
+        clock.advance(1)
+        self.assertEquals(self.old.shrinks, 1)
+        self.gov.stop()
+        self.assertEquals(clock.getDelayedCalls(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
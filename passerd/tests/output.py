@@ -0,0 +1,149 @@
+import unittest
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from passerd.output import OutputBuffer, DRAIN_LINES
+from passerd import ircd
+
+
+class SeqTransport(StringTransport):
+    """StringTransport that logs writeSequence() calls"""
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.seqs = []
+
+    def writeSequence(self, seq):
+        self.seqs.append(list(seq))
+        StringTransport.writeSequence(self, seq)
+
+
+class TestOutputBuffer(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.t = SeqTransport()
+        self.buf = OutputBuffer(self.t, clock=self.clock)
+
+    def testOneWritePerTurn(self):
+        self.buf.write_line('a')
+        self.buf.write_line('b')
+        self.assertEquals(self.t.value(), '')
+        self.clock.advance(0)
+        self.assertEquals(self.t.value(), 'a\r\nb\r\n')
+        self.assertEquals(len(self.t.seqs), 1)
+        self.buf.write_line('c')
+        self.clock.advance(0)
+        self.assertEquals(len(self.t.seqs), 2)
+        self.assertEquals(self.buf.lines_written, 3)
+
+    def testHold(self):
+        self.buf.hold()
+        self.buf.write_line('a')
+        self.buf.hold()
+        self.buf.write_line('b')
+        self.buf.release()
+        self.clock.advance(0)
+        self.assertEquals(self.t.value(), '')
+        self.buf.release()
+        self.assertEquals(self.t.value(), 'a\r\nb\r\n')
+        self.assertEquals(len(self.t.seqs), 1)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testFlush(self):
+        self.buf.write_line('a')
+        self.buf.flush()
+        self.assertEquals(self.t.value(), 'a\r\n')
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testDiscard(self):
+        self.buf.write_line('a')
+        self.buf.discard()
+        self.clock.advance(0)
+        self.assertEquals(self.t.value(), '')
+        self.assertEquals(self.t.seqs, [])
+
+    def testUnicodeLine(self):
+        p = ircd.PasserdProtocol()
+        p._aborted = False
+        p.output = self.buf
+        p.sendLine(u'PRIVMSG #twitter :caf\xe9')
+        self.clock.advance(0)
+        self.assertEquals(self.t.value(), 'PRIVMSG #twitter :caf\xc3\xa9\r\n')
+
+    def testCloseConnection(self):
+        p = ircd.PasserdProtocol()
+        p.output = self.buf
+        p.transport = self.t
+        self.t.registerProducer(self.buf, True)
+        self.buf.pauseProducing()
+        self.buf.write_line('ERROR :bye')
+        p.close_connection()
+        self.assertEquals(self.t.value(), 'ERROR :bye\r\n')
+        self.assertEquals(self.t.producer, None)
+        self.assertTrue(self.t.disconnecting)
+
+
+class TestFlowControl(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.t = SeqTransport()
+        self.buf = OutputBuffer(self.t, clock=self.clock, max_lines=8, max_bytes=1000)
+        self.log = []
+        self.buf.set_source_funcs(lambda: self.log.append('pause'),
+                                  lambda: self.log.append('resume'))
+
+    def testDrop(self):
+        for i in range(10):
+            self.buf.write_line('line %d' % (i), droppable=True)
+        self.assertEquals(self.buf.pending_lines(), 8)
+        self.assertEquals(self.buf.dropped_lines, 2)
+        self.clock.advance(0)
+        self.assertEquals(self.t.value().split('\r\n')[-2], 'line 7')
+
+    def testByteLimit(self):
+        self.buf.write_line('x'*900, droppable=True)
+        self.buf.write_line('y'*200, droppable=True)
+        self.assertEquals(self.buf.pending_lines(), 1)
+        self.assertEquals(self.buf.dropped_bytes, 202)
+
+    def testControlLinesKept(self):
+        for i in range(8):
+            self.buf.write_line('line %d' % (i), droppable=True)
+        self.buf.write_line('PONG passerd')
+        self.buf.write_line('x'*1000)
+        self.buf.write_line('line 8', droppable=True)
+        self.assertEquals(self.buf.pending_lines(), 10)
+        self.assertEquals(self.buf.dropped_lines, 1)
+        self.clock.advance(0)
+        self.assertEquals(self.t.value().split('\r\n')[-3], 'PONG passerd')
+
+    def testSourcePause(self):
+        for i in range(4):
+            self.buf.write_line('a')
+        self.assertEquals(self.log, ['pause'])
+        self.assertEquals(self.buf.source_pauses, 1)
+        self.clock.advance(0)
+        self.assertEquals(self.log, ['pause', 'resume'])
+
+    def testProducerPause(self):
+        self.t.registerProducer(self.buf, True)
+        self.buf.pauseProducing()
+        self.buf.write_line('a')
+        self.clock.advance(0)
+        self.assertEquals(self.t.value(), '')
+        self.buf.resumeProducing()
+        self.clock.advance(0)
+        self.assertEquals(self.t.value(), 'a\r\n')
+        self.assertEquals(self.buf.producer_pauses, 1)
+
+    def testPacedDrain(self):
+        buf = OutputBuffer(self.t, clock=self.clock)
+        for i in range(DRAIN_LINES+10):
+            buf.write_line('a')
+        self.clock.advance(0)
+        self.assertEquals(buf.pending_lines(), 0)
+        self.assertEquals([len(seq)/2 for seq in self.t.seqs], [DRAIN_LINES, 10])
+
+
+if __name__ == '__main__':
+    unittest.main()
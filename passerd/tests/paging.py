@@ -0,0 +1,146 @@
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from passerd.paging import CursorPaginator
+
+
+class FakeApi:
+    """Cursor-based API call returning `pages` pages of 3 items"""
+    def __init__(self, pages):
+        self.pages = pages
+        self.reqs = []
+        self.fail = set()
+
+    def request(self, delegate, cursor, page_delegate):
+        self.reqs.append(cursor)
+        if cursor == '-1':
+            n = 0
+        else:
+            n = int(cursor)
+        # the page items arrive before the failure:
+        for i in range(n*3, n*3+3):
+            delegate(i)
+        if cursor in self.fail:
+            self.fail.discard(cursor)
+            return defer.fail(IOError('failed'))
+        if n+1 < self.pages:
+            page_delegate(str(n+1), str(n-1))
+        else:
+            page_delegate('0', str(n-1))
+        return defer.succeed(None)
+
+
+class TestCursorPaginator(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeApi(4)
+        self.clock = Clock()
+        self.pages = []
+        self.results = []
+        self.errors = []
+
+    def pager(self, **kwargs):
+        return CursorPaginator(self.api.request, self.pages.append,
+                               clock=self.clock, **kwargs)
+
+    def start(self, p):
+        p.start().addCallbacks(self.results.append, self.errors.append)
+
+    def testAllPages(self):
+        p = self.pager()
+        self.start(p)
+        self.assertEquals(self.results, [range(12)])
+        self.assertEquals(self.pages, [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10, 11]])
+        self.assertEquals(self.api.reqs, ['-1', '1', '2', '3'])
+        self.assertTrue(p.complete)
+
+    def testMaxPages(self):
+        p = self.pager(max_pages=2)
+        self.start(p)
+        self.assertEquals(self.results, [range(6)])
+        self.assertFalse(p.complete)
+
+    def testRetry(self):
+        self.api.fail.add('2')
+        p = self.pager(retry_delay=5)
+        self.start(p)
+        self.assertEquals(self.results, [])
+        self.assertEquals(p.items, range(6))
+        self.clock.advance(5)
+        # the items of the failed request were not delivered:
+        self.assertEquals(self.results, [range(12)])
+        self.assertEquals(len(self.pages), 4)
+        self.assertEquals(self.api.reqs, ['-1', '1', '2', '2', '3'])
+
+    def testResume(self):
+        self.api.fail.add('2')
+        p = self.pager(retries=0)
+        self.start(p)
+        self.assertEquals(len(self.errors), 1)
+        self.assertEquals(p.cursor, '2')
+        self.start(p)
+        self.assertEquals(self.results, [range(12)])
+        self.assertEquals(self.api.reqs, ['-1', '1', '2', '2', '3'])
+
+    def testRequestRaises(self):
+        def request(delegate, cursor, page_delegate):
+            if cursor == '1' and self.api.reqs.count('1') == 0:
+                self.api.reqs.append(cursor)
+                raise IOError('not connected')
+            return self.api.request(delegate, cursor, page_delegate)
+        p = CursorPaginator(request, self.pages.append, retries=0, clock=self.clock)
+        self.start(p)
+        self.assertEquals(len(self.errors), 1)
+        self.assertTrue(self.errors[0].check(IOError))
+        self.assertFalse(p.running)
+        self.start(p)
+        self.assertEquals(self.results, [range(12)])
+        self.assertEquals(self.api.reqs, ['-1', '1', '1', '2', '3'])
+
+    def testPageCallbackRaises(self):
+        p = self.pager()
+        def got_page(page):
+            if page[0] == 3 and not self.errors:
+                raise ValueError('bad id')
+            self.pages.append(page)
+        p.page_cb = got_page
+        self.start(p)
+        self.assertEquals(len(self.errors), 1)
+        self.assertTrue(self.errors[0].check(ValueError))
+        self.assertEquals(p.cursor, '1')
+        self.assertEquals(p.items, range(3))
+        # the failed page is fetched again:
+        self.start(p)
+        self.assertEquals(self.results, [range(12)])
+        self.assertEquals(self.pages, [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10, 11]])
+        self.assertEquals(self.api.reqs, ['-1', '1', '1', '2', '3'])
+
+    def testCancel(self):
+        p = self.pager()
+        def got_page(page):
+            if page[0] == 3:
+                p.cancel()
+        p.page_cb = got_page
+        self.start(p)
+        self.assertEquals(self.results, [range(6)])
+        self.assertEquals(self.api.reqs, ['-1', '1'])
+        self.assertFalse(p.complete)
+
+    def testCancelRetry(self):
+        self.api.fail.add('1')
+        p = self.pager()
+        self.start(p)
+        p.cancel()
+        self.assertEquals(self.results, [range(3)])
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+    def testNoItems(self):
+        p = self.pager(keep_items=False)
+        self.start(p)
+        self.assertEquals(self.results, [[]])
+        self.assertEquals(len(self.pages), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
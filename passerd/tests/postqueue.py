@@ -0,0 +1,142 @@
+import unittest
+
+from twisted.internet import defer, error
+from twisted.internet.task import Clock
+import twisted.web.error
+
+from passerd.postqueue import PostQueue
+
+
+class FakeApi:
+    """Post requests that are answered only when reply() is called"""
+    def __init__(self):
+        self.reqs = []
+
+    def send(self, msg):
+        d = defer.Deferred()
+        self.reqs.append((msg, d))
+        return d
+
+    def reply(self, i, e=None):
+        msg,d = self.reqs[i]
+        if e is None:
+            d.callback('id-%s' % (msg))
+        else:
+            d.errback(e)
+
+
+class TestPostQueue(unittest.TestCase):
+    def setUp(self):
+        self.api = FakeApi()
+        self.clock = Clock()
+        self.results = []
+
+    def make_queue(self, **kwargs):
+        self.q = PostQueue(self.api.send, clock=self.clock, **kwargs)
+
+    def post(self, msg):
+        def done(r):
+            self.results.append(r)
+        def error(e):
+            self.results.append('error: %s' % (e.value))
+        self.q.post(msg).addCallbacks(done, error)
+
+    def sent(self):
+        return [m for m,d in self.api.reqs]
+
+    def testOrder(self):
+        self.make_queue()
+        for m in 'abc':
+            self.post(m)
+        # only one request at a time:
+        self.assertEquals(self.sent(), ['a'])
+        self.assertEquals(len(self.q), 3)
+        self.api.reply(0)
+        self.assertEquals(self.sent(), ['a', 'b'])
+        self.api.reply(1)
+        self.api.reply(2)
+        self.assertEquals(self.results, ['id-a', 'id-b', 'id-c'])
+        self.assertEquals(len(self.q), 0)
+        self.assertEquals(self.q.sent, 3)
+
+    def testConcurrency(self):
+        self.make_queue(concurrency=2)
+        for m in 'abc':
+            self.post(m)
+        self.assertEquals(self.sent(), ['a', 'b'])
+        self.assertEquals(self.q.in_flight(), 2)
+        # the results are still delivered in order:
+        self.api.reply(1)
+        self.assertEquals(self.results, [])
+        self.assertEquals(self.sent(), ['a', 'b', 'c'])
+        self.api.reply(0)
+        self.assertEquals(self.results, ['id-a', 'id-b'])
+        self.api.reply(2)
+        self.assertEquals(self.results, ['id-a', 'id-b', 'id-c'])
+
+    def testRetry(self):
+        self.make_queue(retry_delay=2)
+        self.post('a')
+        self.post('b')
+        self.api.reply(0, twisted.web.error.Error('503'))
+        # 'b' waits for the retry of 'a':
+        self.assertEquals(self.sent(), ['a'])
+        self.clock.advance(2)
+        self.assertEquals(self.sent(), ['a', 'a'])
+        self.api.reply(1, error.ConnectionRefusedError())
+        # the delay doubles:
+        self.clock.advance(2)
+        self.assertEquals(self.sent(), ['a', 'a'])
+        self.clock.advance(2)
+        self.assertEquals(self.sent(), ['a', 'a', 'a'])
+        self.api.reply(2)
+        self.assertEquals(self.sent(), ['a', 'a', 'a', 'b'])
+        self.api.reply(3)
+        self.assertEquals(self.results, ['id-a', 'id-b'])
+        self.assertEquals(self.q.retried, 2)
+        # both were queued at the beginning:
+        self.assertEquals(self.q.latency(), (6.0, 6.0))
+
+    def testGiveUp(self):
+        self.make_queue(retries=1, retry_delay=1)
+        self.post('a')
+        self.post('b')
+        self.api.reply(0, twisted.web.error.Error('503'))
+        self.clock.advance(1)
+        self.api.reply(1, twisted.web.error.Error('503'))
+        self.api.reply(2)
+        self.assertEquals(self.results, ['error: 503 Service Unavailable', 'id-b'])
+        self.assertEquals(self.q.failed, 1)
+
+    def testPermanentError(self):
+        self.make_queue()
+        self.post('a')
+        self.post('b')
+        self.api.reply(0, twisted.web.error.Error('403'))
+        self.api.reply(1)
+        self.assertEquals(self.results, ['error: 403 Forbidden', 'id-b'])
+        self.assertEquals(self.q.retried, 0)
+
+    def testMaybePosted(self):
+        # the post may have been accepted already. Don't post it twice:
+        self.make_queue()
+        for m in 'abc':
+            self.post(m)
+        self.api.reply(0, error.ConnectionLost())
+        self.api.reply(1, error.TimeoutError())
+        self.api.reply(2, twisted.web.error.Error('502'))
+        self.assertEquals(self.sent(), ['a', 'b', 'c'])
+        self.assertEquals(self.q.retried, 0)
+        self.assertEquals(self.q.failed, 3)
+
+    def testStop(self):
+        self.make_queue()
+        self.post('a')
+        self.post('b')
+        self.api.reply(0, error.ConnectError())
+        self.q.stop()
+        self.clock.advance(60)
+        self.assertEquals(self.sent(), ['a'])
+        self.assertEquals(len(self.q), 0)
+        self.assertEquals(len(self.results), 2)
+        self.assertTrue(self.results[0].startswith('error: Connection to the other side was lost'))
@@ -0,0 +1,345 @@
+import gc
+import unittest
+
+from twisted.internet import defer
+
+from passerd.data import DataStore
+from passerd import ircd
+from passerd.irc import IrcUser, build_line
+
+
+class O:
+    """Automatic kwargs->attributes object"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeFactory:
+    def __init__(self):
+        self.data = DataStore('sqlite://')
+        self.data.create_tables()
+
+
+class TestBulkUserInfo(unittest.TestCase):
+    def setUp(self):
+        self.cache = ircd.TwitterUserCache(FakeFactory())
+        self.changes = []
+        self.cache.addCallback(lambda *args: self.changes.append(args))
+
+    def testNewUsers(self):
+        self.cache.got_api_users_info([O(id='1', screen_name='alice', name='Alice'),
+                                       O(id='2', screen_name='bob', name='Bob')])
+        self.assertEquals(self.cache.lookup_id(1).twitter_screen_name, 'alice')
+        self.assertEquals(self.cache.lookup_id(2).twitter_screen_name, 'bob')
+        self.assertEquals([c[0] for c in self.changes], [1, 2])
+
+    def testNoOpUpdate(self):
+        alice = O(id='1', screen_name='alice', name='Alice')
+        self.cache.got_api_users_info([alice, alice])
+        self.cache.got_api_users_info([alice])
+        self.assertEquals(len(self.changes), 1)
+
+    def testRename(self):
+        self.cache.got_api_users_info([O(id='1', screen_name='alice', name='Alice')])
+        self.cache.got_api_users_info([O(id='1', screen_name='alice2', name='Alice')])
+        self.assertEquals(self.cache.lookup_id(1).twitter_screen_name, 'alice2')
+        old, new = self.changes[-1][1:]
+        self.assertEquals(old.screen_name, 'alice')
+        self.assertEquals(new.screen_name, 'alice2')
+
+    def testLookupIds(self):
+        self.cache.got_api_users_info([O(id=str(i), screen_name='u%d' % (i), name='U')
+                                       for i in range(1200)])
+        found = self.cache.lookup_ids(range(1000, 1300))
+        self.assertEquals(sorted([d.twitter_id for d in found]), range(1000, 1200))
+
+
+class ShowApi:
+    """API with only /users/show"""
+    def __init__(self):
+        self.reqs = []
+        self.pending = []
+
+    def show_user(self, id):
+        self.reqs.append([id])
+        d = defer.Deferred()
+        self.pending.append( (d, O(id=id, screen_name='u'+id, name='U')) )
+        return d
+
+    def list_friends(self, delegate, user=None, params={}, page_delegate=None):
+        self.reqs.append('friends')
+        page = int(params['cursor'])
+        if page < 0:
+            page = 0
+        for i in range(page*100, page*100+100):
+            delegate(O(id=str(i), screen_name='u%d' % (i), name='U'))
+        page_delegate(str(page+1), '0')
+        return defer.succeed(None)
+
+    def finish(self):
+        while self.pending:
+            d, u = self.pending.pop(0)
+            d.callback(u)
+
+
+class FetchProto:
+    def __init__(self, cache, api):
+        self.global_twuser_cache = cache
+        self.api = api
+        self.notices = []
+
+    def notice(self, msg):
+        self.notices.append(msg)
+
+    def dbg(self, msg):
+        pass
+
+
+class TestFetchUserInfo(unittest.TestCase):
+    def setUp(self):
+        self.cache = ircd.TwitterUserCache(FakeFactory())
+
+    def fetch(self, api, friends, unknown):
+        proto = FetchProto(self.cache, api)
+        users = ircd.TwitterIrcUserCache(proto, self.cache)
+        self.cache.got_api_users_info([O(id=str(i), screen_name='u%d' % (i), name='U')
+                                       for i in range(unknown, friends)])
+        users.fetch_friend_info('me', [users.get_user(i) for i in range(friends)])
+        return proto
+
+    def testFewUnknown(self):
+        api = ShowApi()
+        proto = self.fetch(api, 1200, 3)
+        self.assertEquals(api.reqs, [['0'], ['1'], ['2']])
+        api.finish()
+        self.assertEquals(self.cache.lookup_id(2).twitter_screen_name, 'u2')
+        self.assertEquals(proto.notices[-1], "I know all those 3 users, now!")
+
+    def testConcurrency(self):
+        api = ShowApi()
+        self.fetch(api, 1200, 8)
+        self.assertEquals(len(api.reqs), ircd.USER_LOOKUP_CONCURRENCY)
+        api.finish()
+        self.assertEquals(len(api.reqs), 8)
+        self.assertEquals(len(self.cache.lookup_ids(range(8))), 8)
+
+    def testManyUnknown(self):
+        api = ShowApi()
+        proto = self.fetch(api, 1200, 250)
+        # stops as soon as all unknown users are fetched:
+        self.assertEquals(api.reqs, ['friends']*3)
+        self.assertEquals(self.cache.unknown_ids(range(1200)), set())
+        self.assertEquals(proto.notices[-1], "I know all friends of me, now!")
+
+    def testSmallFriendList(self):
+        # 3 lookups, but a single page of friends:
+        api = ShowApi()
+        self.fetch(api, 50, 3)
+        self.assertEquals(api.reqs, ['friends'])
+
+    def testUnknownIds(self):
+        self.cache.got_api_users_info([O(id=str(i), screen_name='u%d' % (i), name='U')
+                                       for i in range(0, 1200, 2)])
+        self.assertEquals(self.cache.unknown_ids(['1', 2, 3, 4, 1201]), set([1, 3, 1201]))
+        self.assertEquals(len(self.cache.unknown_ids(range(1200))), 600)
+        # IDs loaded from the database are remembered, too:
+        self.cache.clear_known_ids()
+        self.assertEquals(self.cache.unknown_ids([2, 3]), set([3]))
+        self.assertEquals(self.cache.cached_known_ids(), 1)
+
+
+class Watcher:
+    def __init__(self):
+        self.changes = []
+
+    def user_changed(self, id, old_info, new_info):
+        self.changes.append( (id, new_info.screen_name) )
+
+
+class TestWatchers(unittest.TestCase):
+    def setUp(self):
+        self.cache = ircd.TwitterUserCache(FakeFactory())
+
+    def testOnlyWatchedIds(self):
+        w1 = Watcher()
+        w2 = Watcher()
+        self.cache.watch(1, w1)
+        self.cache.watch('2', w2)
+        self.cache.update_user_info(1, 'alice', 'Alice')
+        self.cache.update_user_info(2, 'bob', 'Bob')
+        self.cache.update_user_info(3, 'carol', 'Carol')
+        self.assertEquals(w1.changes, [(1, 'alice')])
+        self.assertEquals(w2.changes, [(2, 'bob')])
+
+    def testUnwatch(self):
+        w = Watcher()
+        self.cache.watch(1, w)
+        self.cache.watch(2, w)
+        self.cache.unwatch(1, w)
+        self.assertEquals(self.cache.watched_ids(), 1)
+        self.cache.unwatch_all(w)
+        self.assertEquals(self.cache.watched_ids(), 0)
+        self.cache.update_user_info(2, 'bob', 'Bob')
+        self.assertEquals(w.changes, [])
+
+    def testDeadWatcher(self):
+        w = Watcher()
+        for i in range(10):
+            self.cache.watch(i, w)
+        del w
+        gc.collect()
+        self.assertEquals(self.cache.watched_ids(), 0)
+        self.assertEquals(self.cache._watcher_refs, {})
+
+    def testDisconnectedIrcUsers(self):
+        proto = FakeProto(self.cache)
+        users = ircd.TwitterIrcUserCache(proto, self.cache)
+        users.watch_user_ids([1, 2, 3])
+        self.assertEquals(self.cache.watched_ids(), 3)
+        del proto, users
+        gc.collect()
+        self.assertEquals(self.cache.watched_ids(), 0)
+
+
+class TestScreenNameIndex(unittest.TestCase):
+    def setUp(self):
+        self.cache = ircd.TwitterUserCache(FakeFactory())
+        self.cache.got_api_users_info([O(id='1', screen_name='Alice', name='Alice')])
+
+    def testLookup(self):
+        self.assertEquals(self.cache.screen_name_id('alice'), 1)
+        self.assertEquals(self.cache.screen_name_id('ALICE'), 1)
+        self.assertEquals(self.cache.screen_name_id('bob'), None)
+
+    def testRename(self):
+        self.cache.got_api_users_info([O(id='1', screen_name='alice2', name='Alice')])
+        self.assertEquals(self.cache.screen_name_id('alice'), None)
+        self.assertEquals(self.cache.screen_name_id('alice2'), 1)
+
+    def testReusedName(self):
+        # bob took the 'alice' screen name before we got the new name of
+        # user 1:
+        self.cache.got_api_users_info([O(id='2', screen_name='alice', name='Bob')])
+        self.assertEquals(self.cache.screen_name_id('alice'), None)
+        self.assertEquals(self.cache.lookup_screen_name('alice'), None)
+        self.cache.got_api_users_info([O(id='1', screen_name='alice2', name='Alice')])
+        self.assertEquals(self.cache.screen_name_id('alice'), 2)
+        self.assertEquals(self.cache.screen_name_id('alice2'), 1)
+
+    def testFromDatabase(self):
+        self.cache.clear_names()
+        self.assertEquals(self.cache.cached_names(), 0)
+        self.assertEquals(self.cache.screen_name_id('alice'), 1)
+        self.assertEquals(self.cache.cached_names(), 1)
+
+
+class NickProto(ircd.PasserdProtocol):
+    """PasserdProtocol with just enough state for user lookups"""
+    def __init__(self, cache):
+        self.global_twuser_cache = cache
+        self.twitter_users = ircd.TwitterIrcUserCache(self, cache)
+        self.the_user = O(nick='guest')
+        self.passerd_bot = O(nick='passerd-bot')
+        self.users = {'guest': self.the_user, 'passerd-bot': self.passerd_bot}
+        self.authenticated = True
+
+    def is_authenticated(self):
+        return self.authenticated
+
+
+class TestGetUser(unittest.TestCase):
+    def setUp(self):
+        self.cache = ircd.TwitterUserCache(FakeFactory())
+        self.cache.update_user_info(1, 'alice', 'Alice')
+        self.proto = NickProto(self.cache)
+
+    def testLocalUsers(self):
+        self.assertTrue(self.proto.get_user('Passerd-Bot') is self.proto.passerd_bot)
+        self.proto.the_user.nick = 'me'
+        self.proto.user_nick_changed(self.proto.the_user, 'guest')
+        self.assertTrue(self.proto.get_user('ME') is self.proto.the_user)
+        self.assertTrue(isinstance(self.proto.get_user('guest'), ircd.UnknownTwitterUser))
+
+    def testForceNick(self):
+        u = self.proto.the_user = IrcUser(self.proto)
+        u.nick = 'guest'
+        u.username = u.hostname = 'x'
+        self.proto.users['guest'] = u
+        self.proto.send_message = lambda *args: None
+        self.proto.force_nick('Me')
+        self.assertTrue(self.proto.get_user('me') is u)
+        self.assertFalse('guest' in self.proto.users)
+
+    def testCachedTwitterUser(self):
+        u = self.proto.get_user('Alice')
+        self.assertTrue(isinstance(u, ircd.CachedTwitterIrcUser))
+        self.assertEquals(u.nick, 'alice')
+        self.assertTrue(isinstance(self.proto.get_user('bob'), ircd.UnknownTwitterUser))
+
+    def testNotAuthenticated(self):
+        self.proto.authenticated = False
+        self.assertEquals(self.proto.get_user('alice'), None)
+
+
+class FakeProto:
+    def __init__(self, cache):
+        self.global_twuser_cache = cache
+        self.messages = []
+
+    def send_message(self, sender, *params):
+        self.messages.append( (sender.irc_prefix(),)+params )
+
+
+class TestPrefixCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ircd.TwitterUserCache(FakeFactory())
+        self.proto = FakeProto(self.cache)
+        self.users = ircd.TwitterIrcUserCache(self.proto, self.cache)
+        self.cache.update_user_info(1, 'alice', 'Alice')
+
+    def testPrefix(self):
+        u = self.users.get_user(1)
+        self.assertEquals(u.irc_prefix(), 'alice!alice@twitter.com')
+        self.assertTrue(self.users.get_user(1).irc_prefix() is u.irc_prefix())
+
+    def testRename(self):
+        self.users.watch_user_id(1)
+        self.users.get_user(1).irc_prefix()
+        self.cache.update_user_info(1, 'alice2', 'Alice')
+        self.assertEquals(self.proto.messages, [('alice!alice@twitter.com', 'NICK', 'alice2')])
+        self.assertEquals(self.users.get_user(1).irc_prefix(), 'alice2!alice2@twitter.com')
+
+    def testBuildLine(self):
+        self.assertEquals(build_line('a!b@c', 'PRIVMSG', '#twitter', 'hi there'),
+                          ':a!b@c PRIVMSG #twitter :hi there')
+
+
+class TestInterning(unittest.TestCase):
+    def setUp(self):
+        self.cache = ircd.TwitterUserCache(FakeFactory())
+        self.proto = FakeProto(self.cache)
+        self.users = ircd.TwitterIrcUserCache(self.proto, self.cache)
+
+    def testSameObject(self):
+        u = self.users.get_user(1)
+        self.assertTrue(self.users.get_user('1') is u)
+
+    def testSlots(self):
+        self.assertFalse(hasattr(self.users.get_user(1), '__dict__'))
+
+    def testUnreferenced(self):
+        self.users.get_user(2)
+        gc.collect()
+        self.assertEquals(len(self.users._users), 0)
+
+    def testWatchedKept(self):
+        self.users.watch_user_id('3')
+        gc.collect()
+        u = self.users.get_user(3)
+        self.cache.update_user_info(3, 'carol', 'Carol')
+        self.assertEquals(self.proto.messages, [('user-id-3!user-id-3@twitter.com', 'NICK', 'carol')])
+        self.assertEquals(u.nick, 'carol')
+
+
+if __name__ == '__main__':
+    unittest.main()
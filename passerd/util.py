@@ -1,4 +1,6 @@
 
+from collections import OrderedDict
+
 ENCODINGS = ['utf-8', 'windows-1252']
 
 def hooks(fn):
@@ -39,3 +41,39 @@ def to_str(s, enc):
         raise Exception("%r is not str (type: %r)" % (s, type(s)))
 
 
+class LRUCache:
+    """A simple mapping that keeps only the `size` most recently used items"""
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        items = self._items
+        try:
+            v = items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        items[key] = v
+        self.hits += 1
+        return v
+
+    def put(self, key, value):
+        items = self._items
+        items.pop(key, None)
+        items[key] = value
+        if len(items) > self.size:
+            items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+
@@ -1,7 +1,7 @@
 """
 Random utility functions
 
-`htmlentitydecode` based on example from:
+Entity decoding originally based on example from:
     http://wiki.python.org/moin/EscapingHtml
 """
 
@@ -9,12 +9,47 @@ Random utility functions
 import re
 from htmlentitydefs import name2codepoint
 
+# named, decimal or hex entity:
+_ENTITY = r'(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);'
+
+ENTITY_RE = re.compile('&'+_ENTITY)
+
+# an entity, optionally preceded by an encoded "&" (as in "&amp;lt;"):
+DOUBLE_ENTITY_RE = re.compile(r'&(amp;|#0*38;|#[xX]0*26;)?'+_ENTITY)
+
+def _entity_char(name):
+    """Return the character for an entity name, or None if unknown"""
+    if name[0] == '#':
+        try:
+            if name[1] in 'xX':
+                return unichr(int(name[2:], 16))
+            return unichr(int(name[1:]))
+        except (ValueError, OverflowError):
+            return None
+    cp = name2codepoint.get(name)
+    if cp is None:
+        return None
+    return unichr(cp)
+
+def _decode_entity(m):
+    c = _entity_char(m.group(1))
+    if c is None:
+        return m.group(0)
+    return c
+
+def _decode_double_entity(m):
+    c = _entity_char(m.group(2))
+    if c is None:
+        if m.group(1):
+            # decode just the "&amp;" part
+            return '&%s;' % (m.group(2))
+        return m.group(0)
+    return c
+
 def htmlentitydecode(s):
-    s = re.sub(
-        '&(%s);' % '|'.join(name2codepoint), 
-        lambda m: unichr(name2codepoint[m.group(1)]), s)
-    s = re.sub('&#([0-9]+);', lambda m: unichr(int(m.group(1))), s)
-    return s
+    if '&' not in s:
+        return s
+    return ENTITY_RE.sub(_decode_entity, s)
 
 def undo_xss_escaping(s):
     # undo the '<' and '>' escaping done by Twitter
@@ -23,8 +58,11 @@ def undo_xss_escaping(s):
 def full_entity_decode(s):
     """Undo the stupid entity encoding done by Twitter
 
-    Data is entity-encoded twice!
+    Data is entity-encoded twice! This gives the same result as calling
+    htmlentitydecode() twice, but using a single pass.
     """
-    return htmlentitydecode(htmlentitydecode(s))
+    if '&' not in s:
+        return s
+    return DOUBLE_ENTITY_RE.sub(_decode_double_entity, s)
 
 __all__ = ["htmlentitydecode", "undo_xss_escaping", "full_entity_decode"]